@@ -1,9 +1,21 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from Backend.services.document_processor import DocumentProcessor
+from fastapi.responses import StreamingResponse
+from Backend.services.document_processor import DocumentProcessor, DocumentProcessingError, ENGINE_MODEL
+from Backend.services.upload_stream import MultipartUpload, read_multipart_upload, RSSTracker
+from Backend.services.jobs import JobManager, JobQueueFullError
+from Backend.services.rate_limiter import request_context
+from Backend.services.chat_pipeline import ChatPipeline
 from Backend.services.monetization import MonetizationService
-from Backend.models.document import DocumentAnalysis, UserTier, TokenBalance, TrustScore
-import tempfile
+from Backend.services.metering import Reservation
+from Backend.monetization import token_access_router, freemium_router, b2b_licensing_router
+from Backend.models.document import (
+    DocumentAnalysis, UserTier, TokenBalance, TrustScore,
+    BatchVerificationRequest, BatchVerificationResponse
+)
+from typing import List, Optional, Tuple
+import asyncio
+import json
 import os
 import logging
 import traceback
@@ -14,6 +26,13 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Document Analysis API")
 
+# Number of retrieved chunks sent to the model per chat question
+CHAT_TOP_K = int(os.getenv("CHAT_TOP_K", "3"))
+# Chat is interactive: give up on queued or retried model calls after this many seconds
+CHAT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "30"))
+# Engine for free-tier analyses: "local" (no model calls) or "model"
+FREE_TIER_ENGINE = os.getenv("FREE_TIER_ENGINE", "local")
+
 # Enable CORS with more permissive settings
 app.add_middleware(
     CORSMiddleware,
@@ -29,12 +48,79 @@ app.add_middleware(
 try:
     document_processor = DocumentProcessor()
     monetization_service = MonetizationService()
+    job_manager = JobManager(document_processor)
+    chat_pipeline = ChatPipeline(
+        document_processor.client, document_processor.rate_limiter, document_processor.count_tokens
+    )
     logger.info("Services initialized successfully")
 except Exception as e:
     logger.error(f"Failed to initialize services: {str(e)}")
     logger.error(f"Traceback: {traceback.format_exc()}")
     raise
 
+# Prefixed so their routes (token_access has its own /usage/{user_id}) don't collide with the
+# app's; mounting them also runs their startup hooks, which seed the state store
+app.include_router(token_access_router, prefix="/tokens", tags=["tokens"])
+app.include_router(freemium_router, prefix="/freemium", tags=["freemium"])
+app.include_router(b2b_licensing_router, prefix="/b2b", tags=["b2b"])
+
+@app.on_event("startup")
+async def start_services():
+    # Spawn extraction workers up front so the first upload doesn't pay for it
+    document_processor.extraction_pool.start()
+    await document_processor.masumi_client.start()
+    job_manager.start()
+    # Give back tokens held by requests that died in a previous run
+    monetization_service.meter.expire()
+    monetization_service.ledger.start()
+
+@app.on_event("shutdown")
+async def stop_services():
+    await job_manager.stop()
+    document_processor.extraction_pool.shutdown()
+    await document_processor.masumi_client.close()
+    monetization_service.ledger.close()
+
+async def _read_pdf_upload(request: Request) -> MultipartUpload:
+    """
+    Read the multipart upload (a "file" PDF part plus form fields) from the
+    request body, mapping bad or oversized uploads to 4xx responses
+    """
+    try:
+        upload = await read_multipart_upload(request)
+    except DocumentProcessingError as e:
+        if e.error_code == "UPLOAD_TOO_LARGE":
+            logger.warning(f"Rejected oversized upload: {str(e)}")
+            raise HTTPException(status_code=413, detail=str(e))
+        if e.error_code == "INVALID_UPLOAD":
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+    if not upload.filename.endswith('.pdf'):
+        logger.warning(f"Invalid file type: {upload.filename}")
+        raise HTTPException(status_code=400, detail="Only PDF files are allowed")
+    if not upload.fields.get("category"):
+        raise HTTPException(status_code=422, detail="Form field 'category' is required")
+    return upload
+
+def _analysis_engine(user_tier: UserTier) -> str:
+    return FREE_TIER_ENGINE if user_tier == UserTier.FREE else ENGINE_MODEL
+
+async def _cancel_on_disconnect(request: Request, coro, poll_interval: float = 0.5):
+    """Run coro, cancelling it if the client goes away before it finishes"""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.warning("Client disconnected, cancelling work")
+                task.cancel()
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
+
 @app.get("/")
 async def root():
     return {
@@ -42,62 +128,98 @@ async def root():
         "version": "1.0.0",
         "endpoints": [
             "/upload - Upload and analyze PDF documents",
+            "/upload/stream - Upload a PDF and stream per-chunk results as NDJSON",
+            "/jobs - Submit a PDF for background analysis and follow its progress",
             "/chat - Chat with document content",
+            "/verify-batch - Verify trust scores for many documents",
             "/token-balance - Check token balance"
         ]
     }
 
 @app.post("/upload")
 async def upload_document(
-    file: UploadFile = File(...),
-    category: str = Form(...),
+    request: Request,
+    response: Response,
     user_tier: UserTier = UserTier.FREE,
     user_id: str = "default"
 ):
-    temp_path = None
+    """
+    Analyze a PDF sent as multipart/form-data: a "file" part, a "category"
+    field and an optional "document_id" field.
+    """
+    memory = RSSTracker()
     try:
-        logger.info(f"Received upload request for file: {file.filename} with category: {category}")
-        
-        if not file.filename.endswith('.pdf'):
-            logger.warning(f"Invalid file type: {file.filename}")
-            raise HTTPException(status_code=400, detail="Only PDF files are allowed")
-
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-            try:
-                content = await file.read()
-                temp_file.write(content)
-                temp_path = temp_file.name
-                logger.info(f"File saved temporarily at: {temp_path}")
-            except Exception as e:
-                logger.error(f"Error saving file: {str(e)}")
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                raise HTTPException(status_code=500, detail="Error saving uploaded file")
+        # Parse the upload as it streams in, stopping at the size limit
+        try:
+            upload = await _read_pdf_upload(request)
+            memory.sample("read")
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error reading uploaded file: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            raise HTTPException(status_code=500, detail="Error reading uploaded file")
+        content = upload.content
+        category = upload.fields["category"]
+        document_id = upload.fields.get("document_id") or None
+        logger.info(f"Received upload request for file: {upload.filename} with category: {category}")
 
         try:
             # Extract text from PDF
             logger.info("Extracting text from PDF...")
-            text = document_processor.extract_text_from_pdf(temp_path)
+            try:
+                text = await _cancel_on_disconnect(request, document_processor.extract_text_cached(content))
+            except DocumentProcessingError as e:
+                if e.error_code == "EXTRACTION_TIMEOUT":
+                    raise HTTPException(status_code=504, detail=str(e))
+                raise
+            # The raw PDF is not needed past this point
+            del content
+            memory.sample("extracted")
             logger.info("Text extraction successful")
             
             # Generate summary
             logger.info("Generating document summary...")
-            summary_result = await document_processor.generate_summary(text)
+            engine = _analysis_engine(user_tier)
+            if document_id:
+                # A known document: only re-analyze what changed since its last version
+                summary_result = await document_processor.analyze_revision(
+                    text, document_id, tenant_id=user_id, engine=engine, category=category
+                )
+            else:
+                summary_result = await document_processor.generate_summary(
+                    text, tenant_id=user_id, engine=engine, category=category
+                )
             logger.info("Summary generation successful")
             
             # Format response for frontend
-            response = {
+            session = document_processor.create_session(text, tenant_id=user_id)
+            result = {
+                "document_handle": session.handle,
                 "extracted_text": text,
                 "summary": summary_result["summary"],
                 "flags": {
                     "risks": summary_result["risks"],
                     "rights": summary_result["rights"],
                     "responsibilities": summary_result["responsibilities"]
-                }
+                },
+                "flag_details": summary_result["flag_details"],
+                "failed_chunks": summary_result.get("failed_chunks", []),
+                "fallback_chunks": summary_result.get("fallback_chunks", []),
+                "engine": summary_result.get("engine", engine),
+                "route": summary_result.get("route")
             }
+            if "revision" in summary_result:
+                result["revision"] = summary_result["revision"]
             
-            return response
+            usage = memory.report("summarized")
+            # Whole-process figure: concurrent requests are included
+            response.headers["X-Process-Peak-RSS-KB"] = str(usage["peak_rss_kb"])
+            logger.info(f"Upload memory usage: {usage}")
+            return result
 
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error processing document content: {str(e)}")
             logger.error(f"Traceback: {traceback.format_exc()}")
@@ -105,14 +227,6 @@ async def upload_document(
                 status_code=500,
                 detail=f"Error processing document content: {str(e)}"
             )
-        finally:
-            # Clean up temporary file
-            if temp_path:
-                try:
-                    os.unlink(temp_path)
-                    logger.info("Temporary file cleaned up")
-                except Exception as e:
-                    logger.error(f"Error cleaning up temporary file: {str(e)}")
 
     except HTTPException as he:
         raise he
@@ -124,81 +238,304 @@ async def upload_document(
             detail=f"An unexpected error occurred while processing your request: {str(e)}"
         )
 
-@app.post("/chat")
-async def chat_with_document(
-    question: str,
-    document_text: str,
+@app.post("/upload/stream")
+async def upload_document_stream(
+    request: Request,
     user_tier: UserTier = UserTier.FREE,
     user_id: str = "default"
 ):
+    """
+    Same analysis as /upload, streamed as NDJSON.
+    One "chunk" record is written per chunk as soon as it is analyzed,
+    followed by a "result" record shaped like the /upload response.
+    """
     try:
-        if not monetization_service.can_access_feature(user_tier, "chatbot"):
-            raise HTTPException(status_code=402, detail="Chat feature requires pro tier")
+        # Reading and extraction errors still map to status codes before the stream starts
+        upload = await _read_pdf_upload(request)
+        content = upload.content
+        category = upload.fields["category"]
+        logger.info(f"Received streaming upload request for file: {upload.filename} with category: {category}")
+        try:
+            text = await _cancel_on_disconnect(request, document_processor.extract_text_cached(content))
+        except DocumentProcessingError as e:
+            if e.error_code == "EXTRACTION_TIMEOUT":
+                raise HTTPException(status_code=504, detail=str(e))
+            raise
+        del content
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error preparing streamed analysis: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing document content: {str(e)}"
+        )
 
-        if not monetization_service.use_tokens(user_id, 1):  # Cost 1 token
-            raise HTTPException(status_code=402, detail="Insufficient tokens")
+    async def record_stream():
+        records: asyncio.Queue = asyncio.Queue()
 
-        # Validate input
-        if not question or not document_text:
-            raise HTTPException(status_code=400, detail="Question and document text are required")
+        def on_chunk(index: int, total: int, result) -> None:
+            if isinstance(result, Exception):
+                records.put_nowait({"type": "chunk_error", "chunk": index, "total": total, "error": str(result)})
+                return
+            records.put_nowait({
+                "type": "chunk",
+                "chunk": index,
+                "total": total,
+                "engine": result.get("engine", ENGINE_MODEL),
+                "summary": result.get("summary", ""),
+                "risks": result.get("risks", []),
+                "rights": result.get("rights", []),
+                "responsibilities": result.get("responsibilities", [])
+            })
 
-        # Split document into chunks
+        task = asyncio.ensure_future(
+            document_processor.generate_summary(
+                text, tenant_id=user_id, on_chunk=on_chunk, engine=_analysis_engine(user_tier), category=category
+            )
+        )
+        task.add_done_callback(lambda _: records.put_nowait(None))
         try:
-            chunks = document_processor.split_text_into_chunks(document_text)
-        except Exception as e:
-            logger.error(f"Error splitting document into chunks: {str(e)}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            raise HTTPException(status_code=500, detail="Error processing document content")
-        
-        # Process each chunk and combine answers
-        all_answers = []
-        for chunk in chunks:
+            while True:
+                record = await records.get()
+                if record is None:
+                    break
+                yield json.dumps(record) + "\n"
+
             try:
-                response = document_processor.client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant analyzing a document. Answer questions based on the document content. If the information is not in this chunk, say so."},
-                        {"role": "user", "content": f"Document chunk: {chunk}\n\nQuestion: {question}"}
-                    ]
-                )
-                answer = response.choices[0].message.content
-                if "not in this chunk" not in answer.lower():
-                    all_answers.append(answer)
+                summary_result = task.result()
             except Exception as e:
-                logger.error(f"Error processing chunk with OpenAI: {str(e)}")
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                continue  # Skip this chunk and try the next one
+                logger.error(f"Streamed analysis failed: {str(e)}")
+                yield json.dumps({"type": "error", "detail": f"Error processing document content: {str(e)}"}) + "\n"
+                return
+            session = document_processor.create_session(text, tenant_id=user_id)
+            yield json.dumps({
+                "type": "result",
+                "document_handle": session.handle,
+                "extracted_text": text,
+                "summary": summary_result["summary"],
+                "flags": {
+                    "risks": summary_result["risks"],
+                    "rights": summary_result["rights"],
+                    "responsibilities": summary_result["responsibilities"]
+                },
+                "flag_details": summary_result["flag_details"],
+                "failed_chunks": summary_result.get("failed_chunks", []),
+                "fallback_chunks": summary_result.get("fallback_chunks", []),
+                "engine": summary_result.get("engine", ENGINE_MODEL),
+                "route": summary_result.get("route")
+            }) + "\n"
+        finally:
+            # The client went away mid-stream; stop paying for the remaining chunks
+            if not task.done():
+                logger.warning("Client disconnected, cancelling streamed analysis")
+                task.cancel()
+
+    return StreamingResponse(
+        record_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/jobs", status_code=202)
+async def submit_analysis_job(
+    request: Request,
+    user_tier: UserTier = UserTier.FREE,
+    user_id: str = "default"
+):
+    try:
+        upload = await _read_pdf_upload(request)
+
+        try:
+            job = job_manager.submit(upload.content, upload.filename, upload.fields["category"], tenant_id=user_id,
+                                     engine=_analysis_engine(user_tier))
+        except JobQueueFullError as e:
+            logger.warning(f"Rejected analysis job: {str(e)}")
+            raise HTTPException(status_code=429, detail="Too many documents are waiting for analysis; try again shortly",
+                                headers={"Retry-After": "30"})
+        return {
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "status_url": f"/jobs/{job['job_id']}",
+            "events_url": f"/jobs/{job['job_id']}/events"
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error submitting analysis job: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"An unexpected error occurred while submitting your document: {str(e)}"
+        )
+
+@app.get("/jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
-        # Combine answers if we have multiple relevant ones
-        if not all_answers:
-            return {"answer": "I couldn't find relevant information in the document to answer your question."}
-        elif len(all_answers) == 1:
-            return {"answer": all_answers[0]}
+@app.get("/jobs/{job_id}/events")
+async def stream_analysis_job(job_id: str):
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        async for event in job_manager.subscribe(job_id):
+            yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _chat_chunks(question: str, document_handle: Optional[str], document_text: Optional[str],
+                       user_tier: UserTier, user_id: str) -> Tuple[List[str], Reservation]:
+    """
+    Check access, reserve the question's token and retrieve the chunks most
+    relevant to it. The caller commits the reservation once the question is
+    answered, or refunds it.
+    """
+    if not monetization_service.can_access_feature(user_tier, "chatbot"):
+        raise HTTPException(status_code=402, detail="Chat feature requires pro tier")
+
+    # Validate input
+    if not question or not (document_handle or document_text):
+        raise HTTPException(status_code=400, detail="Question and document handle are required")
+
+    session = None
+    if document_handle:
+        session = document_processor.sessions.get(document_handle, user_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Document session not found or expired; upload the document again")
+
+    reservation = monetization_service.reserve_tokens(user_id, 1)  # Cost 1 token
+    if reservation is None:
+        raise HTTPException(status_code=402, detail="Insufficient tokens")
+
+    # Only send the chunks most relevant to the question
+    try:
+        if session is not None:
+            retriever = await document_processor.get_session_retriever(session)
         else:
+            # Older clients still send the whole text with every question
+            retriever = await document_processor.get_retriever(document_text)
+        return await retriever.top_k(question, CHAT_TOP_K), reservation
+    except BaseException as e:
+        monetization_service.refund_tokens(reservation)
+        if not isinstance(e, Exception):
+            raise
+        logger.error(f"Error retrieving relevant document chunks: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail="Error processing document content")
+
+@app.post("/chat")
+async def chat_with_document(
+    question: str,
+    document_handle: Optional[str] = None,
+    document_text: Optional[str] = None,
+    user_tier: UserTier = UserTier.FREE,
+    user_id: str = "default"
+):
+    try:
+        chunks, reservation = await _chat_chunks(question, document_handle, document_text, user_tier, user_id)
+        try:
+            # Model calls for this question are attributed to the user and share one deadline
+            with request_context(tenant_id=user_id, timeout=CHAT_DEADLINE_SECONDS):
+                answer = await chat_pipeline.answer(question, chunks)
+        except BaseException:
+            monetization_service.refund_tokens(reservation)
+            raise
+        monetization_service.commit_tokens(reservation, "chat")
+        return {"answer": answer}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in chat endpoint: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+@app.post("/chat/stream")
+async def chat_with_document_stream(
+    question: str,
+    document_handle: Optional[str] = None,
+    document_text: Optional[str] = None,
+    user_tier: UserTier = UserTier.FREE,
+    user_id: str = "default"
+):
+    """
+    Same answer as /chat, streamed over SSE.
+    A "status" event is sent at once, then "token" events as the answer is
+    generated and a final "done" event with the whole answer.
+    """
+    try:
+        chunks, reservation = await _chat_chunks(question, document_handle, document_text, user_tier, user_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in chat endpoint: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+    async def event_stream():
+        # The token is only kept once the whole answer was produced; errors and disconnects refund it
+        answered = False
+        try:
+            yield f"event: status\ndata: {json.dumps({'status': 'answering', 'chunks': len(chunks)})}\n\n"
+            pieces = []
             try:
-                # Ask GPT to combine the answers
-                combined_prompt = f"""
-                Combine these answers about the same question into one coherent response:
-                {chr(10).join(all_answers)}
-                """
-                response = document_processor.client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant combining multiple answers into one coherent response."},
-                        {"role": "user", "content": combined_prompt}
-                    ]
-                )
-                return {"answer": response.choices[0].message.content}
+                with request_context(tenant_id=user_id, timeout=CHAT_DEADLINE_SECONDS):
+                    async for piece in chat_pipeline.stream_answer(question, chunks):
+                        pieces.append(piece)
+                        yield f"event: token\ndata: {json.dumps({'text': piece})}\n\n"
             except Exception as e:
-                logger.error(f"Error combining answers: {str(e)}")
+                logger.error(f"Streamed chat answer failed: {str(e)}")
                 logger.error(f"Traceback: {traceback.format_exc()}")
-                # If combining fails, return the first answer
-                return {"answer": all_answers[0]}
+                yield f"event: error\ndata: {json.dumps({'detail': f'An unexpected error occurred: {str(e)}'})}\n\n"
+                return
+            monetization_service.commit_tokens(reservation, "chat")
+            answered = True
+            yield f"event: done\ndata: {json.dumps({'answer': ''.join(pieces)})}\n\n"
+        finally:
+            if not answered:
+                monetization_service.refund_tokens(reservation)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/verify-batch", response_model=BatchVerificationResponse)
+async def verify_documents_batch(
+    request: BatchVerificationRequest,
+    user_tier: UserTier = UserTier.FREE
+):
+    try:
+        if not monetization_service.can_access_feature(user_tier, "trust_verification"):
+            raise HTTPException(status_code=402, detail="Trust verification requires pro tier")
 
+        results = await document_processor.get_trust_scores(request.document_hashes)
+        return BatchVerificationResponse(
+            results=results,
+            requested=len(request.document_hashes),
+            unique=len(results),
+            failed=sum(1 for item in results if item.get("error"))
+        )
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Unexpected error in chat endpoint: {str(e)}")
+        logger.error(f"Unexpected error in batch verification: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(
             status_code=500,
@@ -218,6 +555,40 @@ async def get_token_balance(user_id: str):
             detail=f"Error getting token balance: {str(e)}"
         )
 
+@app.get("/extraction-pool/stats")
+async def get_extraction_pool_stats():
+    return document_processor.extraction_pool.stats()
+
+@app.delete("/documents/{document_handle}")
+async def close_document_session(document_handle: str, user_id: str = "default"):
+    if not document_processor.sessions.delete(document_handle, user_id):
+        raise HTTPException(status_code=404, detail="Document session not found")
+    return {"deleted": True}
+
+@app.get("/document-sessions/stats")
+async def get_document_session_stats():
+    return document_processor.sessions.stats()
+
+@app.get("/routing/stats")
+async def get_routing_stats():
+    return document_processor.router.stats()
+
+@app.get("/metering/stats")
+async def get_metering_stats():
+    return monetization_service.meter.stats()
+
+@app.get("/usage/{user_id}")
+async def get_monthly_usage(user_id: str, month: Optional[str] = None):
+    return {"user_id": user_id, "usage": monetization_service.ledger.monthly_usage(key=user_id, month=month)}
+
+@app.get("/usage-ledger/stats")
+async def get_usage_ledger_stats():
+    return monetization_service.ledger.stats()
+
+@app.get("/rate-limiter/stats")
+async def get_rate_limiter_stats():
+    return document_processor.rate_limiter.stats()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
@@ -1,22 +1,43 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
 from enum import Enum
 
 class UserTier(str, Enum):
     FREE = "free"
     PRO = "pro"
 
+class MergedFlag(BaseModel):
+    text: str
+    chunks: List[int]
+    variants: int
+
 class DocumentSummary(BaseModel):
     summary: str
     risks: List[str]
     rights: List[str]
     responsibilities: List[str]
+    flag_details: Dict[str, List[MergedFlag]] = {}
 
 class TrustScore(BaseModel):
     score: float
     is_verified: bool
     source: str
 
+class BatchVerificationRequest(BaseModel):
+    document_hashes: List[str] = Field(..., min_length=1, max_length=1000)
+
+class BatchVerificationItem(BaseModel):
+    document_hash: str
+    trust_score: Optional[float] = None
+    is_verified: Optional[bool] = None
+    error: Optional[Dict[str, Optional[str]]] = None
+
+class BatchVerificationResponse(BaseModel):
+    results: List[BatchVerificationItem]
+    requested: int
+    unique: int
+    failed: int
+
 class TokenBalance(BaseModel):
     tokens_used: int
     tokens_remaining: int
@@ -1,6 +1,6 @@
-from .token_access import TokenAccess
-from .freemium import FreemiumTier
-from .b2b_licensing import B2BLicensing
-from .vcaas import VCAAS
+from .token_access import router as token_access_router
+from .freemium import router as freemium_router
+from .b2b_licensing import router as b2b_licensing_router
+from .vcaas import router as vcaas_router
 
-__all__ = ['TokenAccess', 'FreemiumTier', 'B2BLicensing', 'VCAAS'] 
\ No newline at end of file
+__all__ = ['token_access_router', 'freemium_router', 'b2b_licensing_router', 'vcaas_router']
@@ -1,12 +1,20 @@
-from fastapi import APIRouter, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Header
 from pydantic import BaseModel
 from typing import Optional, Dict
 import uuid
 from datetime import datetime
+from Backend.services.state_store import StateStore, get_state_store
+from Backend.services.tenant_registry import ORGANIZATIONS, TenantContext, TenantRegistry
+from Backend.services.metering import Account, MeteringError, get_token_meter
+from Backend.services.usage_ledger import get_usage_ledger, usage_entry
 
 router = APIRouter()
+store = get_state_store()
+registry = TenantRegistry(store)
+meter = get_token_meter()
+ledger = get_usage_ledger()
 
-# Mock organization data (in production, this would be stored in a database)
+# Mock organization data, copied into the state store at startup unless already there
 mock_organizations = {
     "org1": {
         "name": "Healthcare Clinic A",
@@ -26,6 +34,58 @@ mock_organizations = {
     }
 }
 
+@router.on_event("startup")
+def seed_organizations():
+    registry.migrate_plaintext_keys()
+    for org_id, org in mock_organizations.items():
+        registry.add_organization(org_id, org)
+
+async def get_tenant(api_key: str = Header(...)) -> TenantContext:
+    """Resolve the calling organization from its API key, once per request"""
+    tenant = registry.resolve(api_key)
+    if tenant is None:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    return tenant
+
+class OrganizationAccount(Account):
+    """
+    An organization's token balance and monthly analysis count, both kept in
+    its record. Debit checks the two limits and charges them in one atomic
+    update; every change replaces the registry's cached context.
+    """
+    def __init__(self, registry: TenantRegistry):
+        self.registry = registry
+
+    def debit(self, store: StateStore, org_id: str, amount: int) -> None:
+        def charge(org: Dict) -> Dict:
+            # Check monthly limit
+            if org["usage_this_month"] >= org["monthly_limit"]:
+                raise MeteringError("Monthly limit exceeded", "monthly_limit_exceeded")
+            
+            # Check token balance
+            if org["token_balance"] < amount:
+                raise MeteringError("Insufficient token balance", "insufficient_balance")
+            
+            # Update usage and balance
+            org["usage_this_month"] += 1
+            org["token_balance"] -= amount
+            return org
+
+        org = store.update(ORGANIZATIONS, org_id, charge)
+        self.registry.refresh(org_id, org)
+        if org is None:
+            raise MeteringError("Organization not found", "account_not_found")
+
+    def credit(self, store: StateStore, org_id: str, amount: int) -> None:
+        def give_back(org: Dict) -> Dict:
+            org["usage_this_month"] = max(org["usage_this_month"] - 1, 0)
+            org["token_balance"] += amount
+            return org
+
+        self.registry.refresh(org_id, store.update(ORGANIZATIONS, org_id, give_back))
+
+meter.register(ORGANIZATIONS, OrganizationAccount(registry))
+
 class OrganizationInfo(BaseModel):
     org_id: str
     name: str
@@ -50,37 +110,32 @@ class AnalysisReceipt(BaseModel):
 
 @router.get("/organization/{org_id}", response_model=OrganizationInfo)
 async def get_organization_info(org_id: str):
-    if org_id not in mock_organizations:
+    org = registry.get(org_id)
+    if org is None:
         raise HTTPException(status_code=404, detail="Organization not found")
     
-    org = mock_organizations[org_id]
     return OrganizationInfo(
         org_id=org_id,
-        name=org["name"],
-        plan=org["plan"],
-        token_balance=org["token_balance"],
-        monthly_limit=org["monthly_limit"],
-        usage_this_month=org["usage_this_month"]
+        name=org.name,
+        plan=org.plan,
+        token_balance=org.token_balance,
+        monthly_limit=org.monthly_limit,
+        usage_this_month=org.usage_this_month
     )
 
+@router.get("/usage")
+async def get_organization_usage(month: Optional[str] = None, tenant: TenantContext = Depends(get_tenant)):
+    """Analyses and tokens per month for the calling organization"""
+    return ledger.monthly_usage(key=tenant.org_id, account=ORGANIZATIONS, month=month)
+
 @router.post("/embed-sdk")
-async def get_embed_sdk(api_key: str = Header(...)):
-    # Find organization by API key
-    org_id = None
-    for oid, org in mock_organizations.items():
-        if org["api_key"] == api_key:
-            org_id = oid
-            break
-    
-    if not org_id:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
+async def get_embed_sdk(tenant: TenantContext = Depends(get_tenant)):
     # Generate iframe URL with token
     iframe_token = str(uuid.uuid4())
     iframe_url = f"https://consentiq.com/embed/{iframe_token}"
     
     return EmbedResponse(
-        org_id=org_id,
+        org_id=tenant.org_id,
         iframe_url=iframe_url,
         token_cost=5,  # 5 tokens per document analysis
         timestamp=datetime.now().isoformat()
@@ -89,36 +144,26 @@ async def get_embed_sdk(api_key: str = Header(...)):
 @router.post("/analyze-document")
 async def analyze_document(
     document_id: str,
-    api_key: str = Header(...)
+    tenant: TenantContext = Depends(get_tenant)
 ):
-    # Find organization by API key
-    org_id = None
-    for oid, org in mock_organizations.items():
-        if org["api_key"] == api_key:
-            org_id = oid
-            break
-    
-    if not org_id:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
-    org = mock_organizations[org_id]
-    
-    # Check monthly limit
-    if org["usage_this_month"] >= org["monthly_limit"]:
-        raise HTTPException(status_code=400, detail="Monthly limit exceeded")
-    
-    # Check token balance
+    org_id = tenant.org_id
     token_cost = 5  # 5 tokens per document analysis
-    if org["token_balance"] < token_cost:
-        raise HTTPException(status_code=400, detail="Insufficient token balance")
+
+    # Both limits are checked and charged in one transaction across workers,
+    # and given back if the analysis fails
+    try:
+        async with meter.hold(ORGANIZATIONS, org_id, token_cost) as reservation:
+            analysis = "Document analysis results here"
+    except MeteringError as e:
+        if e.error_code == "account_not_found":
+            raise HTTPException(status_code=404, detail="Organization not found")
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # Update usage and balance
-    org["usage_this_month"] += 1
-    org["token_balance"] -= token_cost
+    ledger.record(usage_entry(reservation, "document_analysis", document_id))
     
     # Generate receipt
     receipt = AnalysisReceipt(
-        receipt_id=str(uuid.uuid4()),
+        receipt_id=reservation.reservation_id,
         org_id=org_id,
         document_id=document_id,
         token_cost=token_cost,
@@ -128,5 +173,5 @@ async def analyze_document(
     
     return {
         "receipt": receipt,
-        "analysis": "Document analysis results here"
+        "analysis": analysis
     } 
\ No newline at end of file
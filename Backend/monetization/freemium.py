@@ -3,16 +3,23 @@ from pydantic import BaseModel
 from typing import Optional, List
 import uuid
 from datetime import datetime
+from Backend.services.state_store import get_state_store
 
 router = APIRouter()
+store = get_state_store()
 
-# Mock user tiers (in production, this would be stored in a database)
+# Mock user tiers, copied into the state store at startup unless already there
 mock_user_tiers = {
     "user1": "pro",
     "user2": "free",
     "user3": "pro"
 }
 
+@router.on_event("startup")
+def seed_user_tiers():
+    for user_id, tier in mock_user_tiers.items():
+        store.put_if_absent("user_tier", user_id, tier)
+
 class UserTier(BaseModel):
     user_id: str
     tier: str
@@ -43,10 +50,10 @@ def get_tier_features(tier: str) -> List[str]:
 
 @router.get("/tier/{user_id}", response_model=UserTier)
 async def get_user_tier(user_id: str):
-    if user_id not in mock_user_tiers:
+    tier = store.get("user_tier", user_id)
+    if tier is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    tier = mock_user_tiers[user_id]
     features = get_tier_features(tier)
     
     return UserTier(
@@ -57,10 +64,10 @@ async def get_user_tier(user_id: str):
 
 @router.get("/check-access/{user_id}/{feature}", response_model=FeatureAccess)
 async def check_feature_access(user_id: str, feature: str):
-    if user_id not in mock_user_tiers:
+    tier = store.get("user_tier", user_id)
+    if tier is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    tier = mock_user_tiers[user_id]
     available_features = get_tier_features(tier)
     
     access_granted = feature in available_features
@@ -75,13 +82,14 @@ async def check_feature_access(user_id: str, feature: str):
 
 @router.post("/upgrade/{user_id}")
 async def upgrade_to_pro(user_id: str):
-    if user_id not in mock_user_tiers:
+    def upgrade(tier: str) -> str:
+        if tier == "pro":
+            raise HTTPException(status_code=400, detail="User already has pro tier")
+        return "pro"
+
+    # Checked and changed in one transaction, so two upgrade requests cannot both succeed
+    if store.update("user_tier", user_id, upgrade) is None:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    if mock_user_tiers[user_id] == "pro":
-        raise HTTPException(status_code=400, detail="User already has pro tier")
-    
-    mock_user_tiers[user_id] = "pro"
     return {
         "user_id": user_id,
         "new_tier": "pro",
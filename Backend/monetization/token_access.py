@@ -1,18 +1,32 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from typing import Optional
-import uuid
+from typing import AsyncIterator, Optional
+from contextlib import asynccontextmanager
 from datetime import datetime
+from Backend.services.state_store import get_state_store
+from Backend.services.metering import CounterAccount, MeteringError, Reservation, get_token_meter
+from Backend.services.usage_ledger import get_usage_ledger, usage_entry
 
 router = APIRouter()
+store = get_state_store()
+meter = get_token_meter()
+ledger = get_usage_ledger()
+# Meter account holding the balances in token_balance
+TOKEN_BALANCE = "token_balance"
+meter.register(TOKEN_BALANCE, CounterAccount("token_balance"))
 
-# Mock token balances (in production, this would be stored in a database)
+# Mock token balances, copied into the state store at startup unless already there
 mock_token_balances = {
     "user1": 1000,
     "user2": 500,
     "user3": 200
 }
 
+@router.on_event("startup")
+def seed_token_balances():
+    for user_id, balance in mock_token_balances.items():
+        store.init_counter("token_balance", user_id, balance)
+
 class TokenReceipt(BaseModel):
     receipt_id: str
     user_id: str
@@ -27,32 +41,49 @@ class TokenBalance(BaseModel):
 
 @router.get("/balance/{user_id}", response_model=TokenBalance)
 async def get_token_balance(user_id: str):
-    if user_id not in mock_token_balances:
+    balance = store.get_counter("token_balance", user_id)
+    if balance is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return TokenBalance(user_id=user_id, balance=mock_token_balances[user_id])
+    return TokenBalance(user_id=user_id, balance=balance)
 
-@router.post("/deduct/{user_id}/{amount}")
-async def deduct_tokens(user_id: str, amount: int, feature: str):
-    if user_id not in mock_token_balances:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    if mock_token_balances[user_id] < amount:
-        raise HTTPException(status_code=400, detail="Insufficient token balance")
-    
-    # Deduct tokens
-    mock_token_balances[user_id] -= amount
-    
-    # Generate receipt
-    receipt = TokenReceipt(
-        receipt_id=str(uuid.uuid4()),
-        user_id=user_id,
-        amount=amount,
+def metering_http_error(e: MeteringError) -> HTTPException:
+    if e.error_code == "account_not_found":
+        return HTTPException(status_code=404, detail="User not found")
+    return HTTPException(status_code=400, detail=str(e))
+
+@asynccontextmanager
+async def hold_tokens(user_id: str, amount: int) -> AsyncIterator[Reservation]:
+    """Reserve tokens for a feature: kept if the block completes, refunded if it fails"""
+    try:
+        async with meter.hold(TOKEN_BALANCE, user_id, amount) as reservation:
+            yield reservation
+    except MeteringError as e:
+        raise metering_http_error(e)
+
+def token_receipt(reservation: Reservation, feature: str) -> TokenReceipt:
+    """Receipt for a committed reservation, kept in the usage ledger"""
+    ledger.record(usage_entry(reservation, feature))
+    return TokenReceipt(
+        receipt_id=reservation.reservation_id,
+        user_id=reservation.key,
+        amount=reservation.amount,
         feature=feature,
         timestamp=datetime.now().isoformat(),
         status="completed"
     )
-    
-    return receipt
+
+@router.post("/deduct/{user_id}/{amount}")
+async def deduct_tokens(user_id: str, amount: int, feature: str):
+    # Check and deduct in one atomic step so concurrent requests cannot overdraw
+    try:
+        reservation = meter.charge(TOKEN_BALANCE, user_id, amount)
+    except MeteringError as e:
+        raise metering_http_error(e)
+    return token_receipt(reservation, feature)
+
+@router.get("/usage/{user_id}")
+async def get_token_usage(user_id: str, month: Optional[str] = None):
+    return ledger.monthly_usage(key=user_id, account=TOKEN_BALANCE, month=month)
 
 # Feature-specific endpoints
 @router.post("/premium-summary/{user_id}")
@@ -60,18 +91,21 @@ async def premium_summary(user_id: str, document_length: int):
     if document_length <= 5:
         raise HTTPException(status_code=400, detail="Document must be longer than 5 pages for premium summary")
     
-    # Deduct 10 tokens for premium summary
-    receipt = await deduct_tokens(user_id, 10, "premium_summary")
-    return {"receipt": receipt, "summary": "Premium summary content here"}
+    # 10 tokens for premium summary
+    async with hold_tokens(user_id, 10) as reservation:
+        summary = "Premium summary content here"
+    return {"receipt": token_receipt(reservation, "premium_summary"), "summary": summary}
 
 @router.post("/voice-readout/{user_id}")
 async def voice_readout(user_id: str):
-    # Deduct 5 tokens for voice readout
-    receipt = await deduct_tokens(user_id, 5, "voice_readout")
-    return {"receipt": receipt, "audio_url": "mock_audio_url"}
+    # 5 tokens for voice readout
+    async with hold_tokens(user_id, 5) as reservation:
+        audio_url = "mock_audio_url"
+    return {"receipt": token_receipt(reservation, "voice_readout"), "audio_url": audio_url}
 
 @router.post("/legal-review/{user_id}")
 async def legal_review(user_id: str):
-    # Deduct 20 tokens for legal review
-    receipt = await deduct_tokens(user_id, 20, "legal_review")
-    return {"receipt": receipt, "review": "Legal expert review content here"} 
\ No newline at end of file
+    # 20 tokens for legal review
+    async with hold_tokens(user_id, 20) as reservation:
+        review = "Legal expert review content here"
+    return {"receipt": token_receipt(reservation, "legal_review"), "review": review} 
\ No newline at end of file
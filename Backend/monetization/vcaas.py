@@ -5,6 +5,7 @@ import uuid
 from datetime import datetime
 import hashlib
 from Backend.services.masumi_client import MasumiClient
+from Backend.services.state_store import get_state_store
 import logging
 
 # Set up logging
@@ -13,9 +14,7 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 masumi_client = MasumiClient()
-
-# Mock certificate storage (in production, this would be stored in a database)
-mock_certificates = {}
+store = get_state_store()
 
 class ConsentCertificate(BaseModel):
     certificate_id: str
@@ -84,25 +83,27 @@ async def certify_consent(request: ConsentRequest):
     )
     
     # Store certificate
-    mock_certificates[certificate_id] = certificate
+    store.put("certificate", certificate_id, certificate.model_dump())
     
     return certificate
 
 @router.get("/certificate/{certificate_id}", response_model=ConsentCertificate)
 async def get_certificate(certificate_id: str):
-    if certificate_id not in mock_certificates:
+    certificate = store.get("certificate", certificate_id)
+    if certificate is None:
         raise HTTPException(status_code=404, detail="Certificate not found")
     
-    return mock_certificates[certificate_id]
+    return ConsentCertificate(**certificate)
 
 @router.post("/revoke/{certificate_id}", response_model=CertificateStatus)
 async def revoke_certificate(certificate_id: str):
-    if certificate_id not in mock_certificates:
+    def revoke(certificate: Dict) -> Dict:
+        certificate["status"] = "revoked"
+        return certificate
+
+    if store.update("certificate", certificate_id, revoke) is None:
         raise HTTPException(status_code=404, detail="Certificate not found")
     
-    certificate = mock_certificates[certificate_id]
-    certificate.status = "revoked"
-    
     # Generate new verifiable hash for revocation
     revocation_data = f"{certificate_id}:revoked:{datetime.now().isoformat()}"
     verifiable_hash = await generate_verifiable_hash(revocation_data)
@@ -116,10 +117,10 @@ async def revoke_certificate(certificate_id: str):
 
 @router.get("/verify/{certificate_id}/{hash}")
 async def verify_certificate(certificate_id: str, hash: str):
-    if certificate_id not in mock_certificates:
+    certificate = store.get("certificate", certificate_id)
+    if certificate is None:
         raise HTTPException(status_code=404, detail="Certificate not found")
-    
-    certificate = mock_certificates[certificate_id]
+    certificate = ConsentCertificate(**certificate)
     
     # Verify the hash matches
     verification_data = f"{certificate_id}:{certificate.document_hash}:{certificate.user_id}"
@@ -4,5 +4,7 @@ Services module containing core business logic components
 
 from .document_processor import DocumentProcessor
 from .masumi_client import MasumiClient, MasumiClientError
+from .chunk_scheduler import ChunkScheduler
+from .analysis_cache import AnalysisCache
 
-__all__ = ['DocumentProcessor', 'MasumiClient', 'MasumiClientError'] 
\ No newline at end of file
+__all__ = ['DocumentProcessor', 'MasumiClient', 'MasumiClientError', 'ChunkScheduler', 'AnalysisCache'] 
\ No newline at end of file
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(ABC):
+    """Persistent key/value store behind the in-memory cache layer"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """Return (value, expires_at) or None"""
+
+    @abstractmethod
+    def set(self, key: str, value: str, expires_at: float) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    SQLite-backed cache store.
+    Expired rows are dropped on read and the table is trimmed to max_entries
+    by least recent access.
+    """
+    def __init__(self, path: str, max_entries: int = 100000):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed_at)")
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+
+    def set(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, time.time())
+            )
+            self._writes += 1
+            # Trimming needs a count, so only do it every so often
+            if self._writes % 100 == 0:
+                self._trim()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def _trim(self) -> None:
+        self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed_at ASC LIMIT ?)",
+                (excess,)
+            )
+            logger.info(f"Evicted {excess} entries from {self.path}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class TTLCache:
+    """
+    In-memory LRU cache with per-entry TTL, optionally backed by a CacheBackend.
+    Values must be JSON serialisable.
+    With max_bytes set, the memory layer also holds at most that many bytes
+    of values (string length for text); a value larger than that on its own
+    is only kept in the backend.
+    """
+    def __init__(self, namespace: str, max_entries: int = 1024, ttl: float = 86400,
+                 backend: Optional[CacheBackend] = None, max_bytes: Optional[int] = None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        # key -> (value, expires_at, size)
+        self._entries: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _backend_key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._drop(key)
+
+        if self.backend is not None:
+            try:
+                stored = self.backend.get(self._backend_key(key))
+            except Exception as e:
+                logger.error(f"Cache backend read failed for {self.namespace}: {str(e)}")
+                stored = None
+            if stored is not None:
+                value = json.loads(stored[0])
+                self._remember(key, value, stored[1])
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        self._remember(key, value, expires_at)
+        if self.backend is not None:
+            try:
+                self.backend.set(self._backend_key(key), json.dumps(value), expires_at)
+            except Exception as e:
+                logger.error(f"Cache backend write failed for {self.namespace}: {str(e)}")
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._drop(key)
+        if self.backend is not None:
+            self.backend.delete(self._backend_key(key))
+
+    @staticmethod
+    def _size(value: Any) -> int:
+        return len(value) if isinstance(value, str) else len(json.dumps(value))
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _remember(self, key: str, value: Any, expires_at: float) -> None:
+        size = self._size(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._drop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+        if self.max_bytes is not None:
+            stats.update(bytes=self._bytes, max_bytes=self.max_bytes)
+        return stats
+
+
+def create_backend(kind: str, path: str, max_entries: int) -> Optional[CacheBackend]:
+    """Build the persistent backend named by ANALYSIS_CACHE_BACKEND"""
+    if kind == "memory":
+        return None
+    if kind == "sqlite":
+        return SQLiteCacheBackend(path, max_entries=max_entries)
+    raise ValueError(f"Unknown cache backend: {kind}")
+
+
+class AnalysisCache:
+    """
+    Content-addressed cache for document analysis.
+
+    - extractions: extracted text keyed by the SHA-256 of the uploaded file,
+      bounded in memory by ANALYSIS_CACHE_EXTRACTION_MAX_BYTES of text
+    - documents: merged summaries keyed by the text hash plus model/prompt version
+    - chunks: per-chunk analysis keyed by the chunk hash plus model/prompt version
+    - summaries: summary-tree nodes keyed by the hash of their children plus model version
+    """
+    def __init__(self, model_version: str, backend: Optional[CacheBackend] = None,
+                 ttl: Optional[float] = None, max_entries: Optional[int] = None):
+        if ttl is None:
+            ttl = float(os.getenv("ANALYSIS_CACHE_TTL", "604800"))  # 7 days
+        if max_entries is None:
+            max_entries = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "2048"))
+        if backend is None:
+            backend = create_backend(
+                os.getenv("ANALYSIS_CACHE_BACKEND", "memory"),
+                os.getenv("ANALYSIS_CACHE_PATH", os.path.join("cache", "analysis.sqlite3")),
+                max_entries=int(os.getenv("ANALYSIS_CACHE_DISK_MAX_ENTRIES", "200000"))
+            )
+        self.model_version = model_version
+        self.backend = backend
+        # Whole document texts: bound by size, or a few large contracts would fill memory
+        self.extractions = TTLCache(
+            "extraction", max_entries=max_entries, ttl=ttl, backend=backend,
+            max_bytes=int(os.getenv("ANALYSIS_CACHE_EXTRACTION_MAX_BYTES", str(64 * 1024 * 1024)))
+        )
+        self.documents = TTLCache("document", max_entries=max_entries, ttl=ttl, backend=backend)
+        # A document has many chunks, so give the chunk level more room
+        self.chunks = TTLCache("chunk", max_entries=max_entries * 8, ttl=ttl, backend=backend)
+        self.summaries = TTLCache("summary", max_entries=max_entries * 2, ttl=ttl, backend=backend)
+
+    @staticmethod
+    def content_hash(data: Any) -> str:
+        if isinstance(data, str):
+            data = data.encode()
+        return hashlib.sha256(data).hexdigest()
+
+    def versioned_key(self, content_hash: str) -> str:
+        return f"{self.model_version}:{content_hash}"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self.backend).__name__ if self.backend else "memory",
+            "extractions": self.extractions.stats(),
+            "documents": self.documents.stats(),
+            "chunks": self.chunks.stats(),
+            "summaries": self.summaries.stats()
+        }
+
+    def close(self) -> None:
+        if self.backend is not None:
+            self.backend.close()
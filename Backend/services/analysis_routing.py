@@ -0,0 +1,195 @@
+"""
+Category-aware routing of chunk analysis.
+
+A route fixes the prompt template, model and chunk size used to analyze a
+document. Routes are chosen by an ordered rule table on the document's
+category and size; the first matching rule wins and "default" applies when
+none does. The table can be replaced with a JSON file (ANALYSIS_ROUTES_PATH)
+shaped like DEFAULT_ROUTING. Every model call records its latency and token
+use against its route, so the table can be tuned from /routing/stats.
+"""
+import json
+import logging
+import os
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Prompt templates: the system message and what the model should pay most attention to
+PROMPTS: Dict[str, Dict[str, str]] = {
+    "general": {
+        "system": "You are an expert at analyzing legal documents and contracts. Extract key information about rights, responsibilities, and risks.",
+        "focus": ""
+    },
+    "legal": {
+        "system": "You are an expert at analyzing legal documents and contracts. Extract key information about rights, responsibilities, and risks.",
+        "focus": "Pay particular attention to liability, indemnities, termination, dispute resolution and waivers of rights. "
+    },
+    "medical": {
+        "system": "You are an expert at analyzing medical and healthcare documents such as consent forms, patient agreements and insurance policies. Extract key information about rights, responsibilities, and risks.",
+        "focus": "Pay particular attention to consent, treatment risks, privacy of health data, costs not covered and deadlines for claims. "
+    },
+    "finance": {
+        "system": "You are an expert at analyzing financial agreements such as loans, credit cards and investment terms. Extract key information about rights, responsibilities, and risks.",
+        "focus": "Pay particular attention to interest rates, fees, penalties, repayment terms, collateral and variable terms. "
+    },
+    "consumer": {
+        "system": "You are an expert at explaining everyday agreements such as leases, purchase contracts and terms of service to consumers. Extract key information about rights, responsibilities, and risks.",
+        "focus": "Pay particular attention to payments, deposits, renewals, cancellation and what happens on late payment. "
+    }
+}
+
+DEFAULT_ROUTING: Dict[str, Any] = {
+    "routes": {
+        "default": {"model": "gpt-4-turbo-preview", "prompt": "general", "chunk_tokens": 3000},
+        "legal": {"model": "gpt-4-turbo-preview", "prompt": "legal", "chunk_tokens": 3000},
+        "medical": {"model": "gpt-4-turbo-preview", "prompt": "medical", "chunk_tokens": 3000},
+        "finance": {"model": "gpt-4-turbo-preview", "prompt": "finance", "chunk_tokens": 3000},
+        # Short everyday documents are well within a small model's reach
+        "consumer-fast": {"model": "gpt-4o-mini", "prompt": "consumer", "chunk_tokens": 4000},
+        # Very long documents: fewer, larger chunks on the cheaper model
+        "bulk": {"model": "gpt-4o-mini", "prompt": "general", "chunk_tokens": 8000}
+    },
+    "rules": [
+        {"categories": ["housing", "automobile", "education", "it"], "max_document_tokens": 20000,
+         "route": "consumer-fast"},
+        {"categories": ["medical", "healthcare"], "route": "medical"},
+        {"categories": ["finance"], "route": "finance"},
+        {"min_document_tokens": 200000, "route": "bulk"},
+        {"categories": ["legal", "industrial"], "route": "legal"}
+    ],
+    # USD per 1K prompt and completion tokens, for the cost estimates in stats
+    "prices": {
+        "gpt-4-turbo-preview": [0.01, 0.03],
+        "gpt-4o-mini": [0.00015, 0.0006]
+    }
+}
+
+
+class Route(NamedTuple):
+    """How to analyze a document"""
+    name: str
+    model: str
+    prompt: str
+    chunk_tokens: int
+
+    @property
+    def key(self) -> str:
+        """Identifies the model and prompt in cache keys, so routes never share results"""
+        return f"{self.model}:{self.prompt}"
+
+    @property
+    def system_prompt(self) -> str:
+        return PROMPTS[self.prompt]["system"]
+
+    @property
+    def focus(self) -> str:
+        return PROMPTS[self.prompt]["focus"]
+
+
+class _RouteStats:
+    def __init__(self, window: int):
+        self.calls = 0
+        self.errors = 0
+        self.chunks = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+
+class AnalysisRouter:
+    """
+    Chooses a Route per document and keeps per-route call statistics.
+    Latency percentiles cover the last window calls of each route.
+    """
+    def __init__(self, table: Optional[Dict[str, Any]] = None, window: int = 512):
+        if table is None:
+            path = os.getenv("ANALYSIS_ROUTES_PATH")
+            if path:
+                with open(path) as f:
+                    table = json.load(f)
+                logger.info(f"Loaded analysis routing table from {path}")
+            else:
+                table = DEFAULT_ROUTING
+        self.routes = {
+            name: Route(name, spec["model"], spec["prompt"], int(spec["chunk_tokens"]))
+            for name, spec in table["routes"].items()
+        }
+        self.rules: List[Dict[str, Any]] = table.get("rules", [])
+        self.prices: Dict[str, List[float]] = table.get("prices", {})
+        self._validate()
+        self.window = window
+        self._stats: Dict[str, _RouteStats] = {}
+        self._lock = threading.Lock()
+
+    def _validate(self) -> None:
+        if "default" not in self.routes:
+            raise ValueError("Routing table needs a 'default' route")
+        for route in self.routes.values():
+            if route.prompt not in PROMPTS:
+                raise ValueError(f"Route {route.name} uses unknown prompt {route.prompt}")
+            if route.chunk_tokens <= 0:
+                raise ValueError(f"Route {route.name} needs a positive chunk_tokens")
+        for rule in self.rules:
+            if rule.get("route") not in self.routes:
+                raise ValueError(f"Routing rule points at unknown route {rule.get('route')}")
+
+    def route(self, category: Optional[str], document_tokens: int) -> Route:
+        """First rule matching the category (case-insensitive) and document size"""
+        category = (category or "").strip().lower()
+        for rule in self.rules:
+            categories = rule.get("categories")
+            if categories is not None and category not in categories:
+                continue
+            if document_tokens < rule.get("min_document_tokens", 0):
+                continue
+            if "max_document_tokens" in rule and document_tokens > rule["max_document_tokens"]:
+                continue
+            return self.routes[rule["route"]]
+        return self.routes["default"]
+
+    def record(self, route: Route, latency: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+               chunks: int = 1, error: bool = False) -> None:
+        """Account one model call analyzing chunks chunks"""
+        with self._lock:
+            stats = self._stats.get(route.name)
+            if stats is None:
+                stats = self._stats[route.name] = _RouteStats(self.window)
+            stats.calls += 1
+            stats.chunks += chunks
+            stats.errors += int(error)
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.latencies.append(latency)
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+        """Estimated USD cost, or None when the model has no price"""
+        price = self.prices.get(model)
+        if price is None:
+            return None
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1000
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            report = {}
+            for name, stats in self._stats.items():
+                route = self.routes[name]
+                latencies = sorted(stats.latencies)
+                cost = self.cost(route.model, stats.prompt_tokens, stats.completion_tokens)
+                report[name] = {
+                    "model": route.model,
+                    "prompt": route.prompt,
+                    "chunk_tokens": route.chunk_tokens,
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "chunks": stats.chunks,
+                    "prompt_tokens": stats.prompt_tokens,
+                    "completion_tokens": stats.completion_tokens,
+                    "cost_usd": round(cost, 4) if cost is not None else None,
+                    "cost_per_chunk_usd": round(cost / stats.chunks, 6) if cost is not None and stats.chunks else None,
+                    "latency_p50": round(latencies[len(latencies) // 2], 3) if latencies else None,
+                    "latency_p95": round(latencies[int(len(latencies) * 0.95)], 3) if latencies else None
+                }
+            return report
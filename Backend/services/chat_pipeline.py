@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Callable, List, Optional
+
+from .rate_limiter import AdaptiveRateLimiter, chat_completion, stream_chat_completion
+
+logger = logging.getLogger(__name__)
+
+# Chunk answers containing this marker (or the older phrasing) found nothing relevant
+NOT_FOUND_MARKER = "NOT_IN_CHUNK"
+NO_ANSWER = "I couldn't find relevant information in the document to answer your question."
+
+# Rough size of a chat answer, used to budget tokens before the call
+CHAT_COMPLETION_TOKENS = 500
+
+
+class ChatPipeline:
+    """
+    Answers a question from the retrieved chunks of a document.
+
+    Every chunk is asked concurrently on the fast chunk model. Chunk answers
+    are taken as they arrive, and once enough_answers of them are relevant
+    the remaining chunk queries are cancelled. Several relevant answers are
+    then combined on the answer model, with the combined answer streamed
+    token by token; a single relevant answer is returned as it is.
+    """
+    def __init__(self, client, rate_limiter: AdaptiveRateLimiter, count_tokens: Callable[[str], int],
+                 model: Optional[str] = None, chunk_model: Optional[str] = None,
+                 enough_answers: Optional[int] = None, chunk_answer_tokens: int = 300):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.count_tokens = count_tokens
+        self.model = model or os.getenv("CHAT_MODEL", "gpt-4")
+        # Chunk answers only feed the combine step, so a faster model keeps first-token latency down
+        self.chunk_model = chunk_model or os.getenv("CHAT_CHUNK_MODEL", "gpt-4o-mini")
+        self.enough_answers = enough_answers or int(os.getenv("CHAT_ENOUGH_ANSWERS", "2"))
+        self.chunk_answer_tokens = chunk_answer_tokens
+
+    async def _ask_chunk(self, question: str, chunk: str) -> Optional[str]:
+        """The chunk's answer to question, or None when the chunk does not contain one"""
+        response = await chat_completion(
+            self.client, self.rate_limiter,
+            self.count_tokens(chunk) + self.count_tokens(question) + self.chunk_answer_tokens,
+            model=self.chunk_model,
+            messages=[
+                {"role": "system", "content": f"You are a helpful assistant analyzing a document. Answer questions based on the document content, briefly. If the information is not in this chunk, reply only with {NOT_FOUND_MARKER}."},
+                {"role": "user", "content": f"Document chunk: {chunk}\n\nQuestion: {question}"}
+            ],
+            max_tokens=self.chunk_answer_tokens
+        )
+        answer = (response.choices[0].message.content or "").strip()
+        if not answer or NOT_FOUND_MARKER in answer or "not in this chunk" in answer.lower():
+            return None
+        return answer
+
+    async def gather_answers(self, question: str, chunks: List[str]) -> List[str]:
+        """
+        Relevant chunk answers, in the order of chunks (ranked most relevant
+        first by retrieval).
+        Stops as soon as enough_answers relevant answers are in.
+        """
+        tasks = [asyncio.ensure_future(self._ask_chunk(question, chunk)) for chunk in chunks]
+        index_of = {task: i for i, task in enumerate(tasks)}
+        answers = {}
+        pending = set(tasks)
+        try:
+            while pending and len(answers) < self.enough_answers:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        answer = task.result()
+                    except Exception as e:
+                        logger.error(f"Error processing chunk with OpenAI: {str(e)}")
+                        continue
+                    if answer is not None:
+                        answers[index_of[task]] = answer
+            if pending:
+                logger.info(f"Have {len(answers)} relevant answers, skipping {len(pending)} remaining chunks")
+        finally:
+            for task in pending:
+                task.cancel()
+        return [answers[i] for i in sorted(answers)]
+
+    async def stream_answer(self, question: str, chunks: List[str]) -> AsyncIterator[str]:
+        """Yield the answer as text pieces as soon as they are available"""
+        answers = await self.gather_answers(question, chunks)
+        if not answers:
+            yield NO_ANSWER
+            return
+        if len(answers) == 1:
+            yield answers[0]
+            return
+
+        combined_prompt = "Combine these answers about the same question into one coherent response:\n" + "\n".join(answers)
+        events = stream_chat_completion(
+            self.client, self.rate_limiter,
+            self.count_tokens(combined_prompt), CHAT_COMPLETION_TOKENS,
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant combining multiple answers into one coherent response."},
+                {"role": "user", "content": f"Question: {question}\n\n{combined_prompt}"}
+            ]
+        )
+        started = False
+        try:
+            async for event in events:
+                started = True
+                if not event.choices:
+                    continue
+                delta = event.choices[0].delta.content
+                if delta:
+                    yield delta
+        except Exception as e:
+            if started:
+                raise
+            logger.error(f"Error combining answers: {str(e)}")
+            # If combining fails, return the most relevant answer
+            yield answers[0]
+        finally:
+            # Hands the limiter slot back even when the reader stops early
+            await events.aclose()
+
+    async def answer(self, question: str, chunks: List[str]) -> str:
+        """The complete answer"""
+        return "".join([piece async for piece in self.stream_answer(question, chunks)])
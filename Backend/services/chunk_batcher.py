@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from .rate_limiter import DeadlineExceededError, current_request, request_context
+
+logger = logging.getLogger(__name__)
+
+
+class _Item(NamedTuple):
+    text: str
+    tokens: int
+    future: asyncio.Future
+    deadline: Optional[float]
+
+
+class ChunkBatcher:
+    """
+    Packs small chunks into shared model requests.
+
+    Chunks one tenant submits within max_wait seconds of each other are
+    grouped, from any of its documents, until the group reaches max_tokens of
+    input or max_items chunks. Each group is handed to analyze_batch, which
+    returns one result (or exception) per chunk in order; every submitter then
+    gets its own result back.
+
+    Groups never mix tenants: a batch is one model request, admitted through
+    its tenant's fair queue and charged only for that tenant's chunks. It runs
+    in a fresh context rather than that of whichever submitter filled it, and
+    each submitter still gives up at its own deadline.
+    """
+    def __init__(
+        self,
+        analyze_batch: Callable[[List[str]], Awaitable[List[Any]]],
+        max_tokens: Optional[int] = None,
+        max_items: Optional[int] = None,
+        max_wait: Optional[float] = None
+    ):
+        self.analyze_batch = analyze_batch
+        self.max_tokens = max_tokens or int(os.getenv("CHUNK_BATCH_MAX_TOKENS", "4000"))
+        self.max_items = max_items or int(os.getenv("CHUNK_BATCH_MAX_ITEMS", "8"))
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv("CHUNK_BATCH_MAX_WAIT", "0.025"))
+        self._pending: Dict[str, List[_Item]] = {}
+        self._pending_tokens: Dict[str, int] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks = set()
+        self.batches = 0
+        self.batched_chunks = 0
+
+    async def submit(self, text: str, tokens: int) -> Dict[str, Any]:
+        """Queue a chunk for the current tenant and wait for its analysis"""
+        tenant_id, deadline = current_request()
+        if self._pending.get(tenant_id) and self._pending_tokens[tenant_id] + tokens > self.max_tokens:
+            self._flush(tenant_id)
+
+        loop = asyncio.get_running_loop()
+        item = _Item(text, tokens, loop.create_future(), deadline)
+        pending = self._pending.setdefault(tenant_id, [])
+        pending.append(item)
+        self._pending_tokens[tenant_id] = self._pending_tokens.get(tenant_id, 0) + tokens
+        # A caller that gives up takes its chunk out of the group at once
+        item.future.add_done_callback(partial(self._discard, tenant_id, item))
+        if self._pending_tokens[tenant_id] >= self.max_tokens or len(pending) >= self.max_items:
+            self._flush(tenant_id)
+        elif tenant_id not in self._timers:
+            self._timers[tenant_id] = loop.call_later(self.max_wait, self._flush, tenant_id)
+
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+        try:
+            return await asyncio.wait_for(item.future, timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError("Deadline passed while waiting for a batched analysis") from None
+
+    def _discard(self, tenant_id: str, item: _Item, future: asyncio.Future) -> None:
+        if not future.cancelled():
+            return
+        pending = self._pending.get(tenant_id, [])
+        for i, queued in enumerate(pending):
+            if queued is item:
+                del pending[i]
+                self._pending_tokens[tenant_id] -= item.tokens
+                break
+
+    def _flush(self, tenant_id: str) -> None:
+        timer = self._timers.pop(tenant_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = [item for item in self._pending.pop(tenant_id, []) if not item.future.done()]
+        self._pending_tokens.pop(tenant_id, None)
+        if batch:
+            # A fresh context, so the batch does not inherit the tenant and
+            # deadline of whichever submitter happened to trigger the flush
+            task = contextvars.Context().run(asyncio.ensure_future, self._run(tenant_id, batch))
+            # Keep a reference so the task is not collected mid-flight
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, tenant_id: str, batch: List[_Item]) -> None:
+        self.batches += 1
+        self.batched_chunks += len(batch)
+        logger.info(f"Analyzing batch of {len(batch)} chunks in one request for tenant {tenant_id}")
+        # Run as long as the most patient submitter waits; the others give up
+        # at their own deadlines in submit
+        deadlines = [item.deadline for item in batch]
+        deadline = None if None in deadlines else max(deadlines)
+        try:
+            with request_context(tenant_id=tenant_id, deadline=deadline):
+                results = await self.analyze_batch([item.text for item in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch returned {len(results)} results for {len(batch)} chunks")
+        except Exception as e:
+            results = [e] * len(batch)
+        for item, result in zip(batch, results):
+            if item.future.done():
+                continue
+            if isinstance(result, Exception):
+                item.future.set_exception(result)
+            else:
+                item.future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "batched_chunks": self.batched_chunks,
+            "pending": sum(len(items) for items in self._pending.values())
+        }
@@ -0,0 +1,148 @@
+import asyncio
+import contextvars
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Gives back the slots of the job running in this context
+_release_slots: contextvars.ContextVar[Optional[Callable[[], None]]] = contextvars.ContextVar(
+    "release_slots", default=None
+)
+
+
+class _TenantSlot:
+    """Concurrency slot for a single tenant, dropped once it goes idle"""
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0
+
+
+class ChunkScheduler:
+    """
+    Bounded scheduler for concurrent chunk work.
+
+    Every job first takes a slot from its tenant and then a slot from the
+    process-wide pool, so one tenant can never hold more than its share of
+    the global limit. Callers beyond the limit wait (backpressure) instead
+    of piling more requests onto the upstream API.
+
+    A job that hands its request to work admitted elsewhere, such as a chunk
+    queued in a ChunkBatcher whose batch runs as a job of its own, calls
+    release_slot() first. Otherwise the queued chunks would hold their
+    tenant's slots, and no batch could grow past max_in_flight_per_tenant.
+    """
+    def __init__(self, max_in_flight: Optional[int] = None, max_in_flight_per_tenant: Optional[int] = None):
+        self.max_in_flight = max_in_flight or int(os.getenv("CHUNK_MAX_IN_FLIGHT", "8"))
+        self.max_in_flight_per_tenant = max_in_flight_per_tenant or int(
+            os.getenv("CHUNK_MAX_IN_FLIGHT_PER_TENANT", "4")
+        )
+        if self.max_in_flight < 1 or self.max_in_flight_per_tenant < 1:
+            raise ValueError("Scheduler limits must be at least 1")
+
+        # Semaphores are created lazily so they bind to the running event loop
+        self._global: Optional[asyncio.Semaphore] = None
+        self._tenants: Dict[str, _TenantSlot] = {}
+        self.in_flight = 0
+        self.waiting = 0
+
+    def _global_semaphore(self) -> asyncio.Semaphore:
+        if self._global is None:
+            self._global = asyncio.Semaphore(self.max_in_flight)
+        return self._global
+
+    async def run(self, func: Callable[..., Awaitable[Any]], *args: Any, tenant_id: str = "default") -> Any:
+        """Run a single coroutine function once a tenant and a global slot are free"""
+        slot = self._tenants.get(tenant_id)
+        if slot is None:
+            slot = self._tenants[tenant_id] = _TenantSlot(self.max_in_flight_per_tenant)
+        slot.users += 1
+
+        self.waiting += 1
+        started = False
+        held = False
+
+        def release() -> None:
+            nonlocal held
+            if held:
+                held = False
+                self.in_flight -= 1
+                self._global_semaphore().release()
+                slot.semaphore.release()
+
+        if self.in_flight >= self.max_in_flight:
+            logger.debug(f"Scheduler saturated ({self.in_flight} in flight), tenant {tenant_id} waiting")
+        try:
+            await slot.semaphore.acquire()
+            try:
+                await self._global_semaphore().acquire()
+            except BaseException:
+                slot.semaphore.release()
+                raise
+            started = held = True
+            self.waiting -= 1
+            self.in_flight += 1
+            token = _release_slots.set(release)
+            try:
+                return await func(*args)
+            finally:
+                _release_slots.reset(token)
+                release()
+        finally:
+            if not started:
+                # Cancelled while still queued
+                self.waiting -= 1
+            slot.users -= 1
+            if slot.users == 0:
+                self._tenants.pop(tenant_id, None)
+
+    @staticmethod
+    def release_slot() -> None:
+        """Give back the current job's slots before it finishes; does nothing outside a job"""
+        release = _release_slots.get()
+        if release is not None:
+            release()
+
+    async def map(
+        self,
+        func: Callable[[Any], Awaitable[Any]],
+        items: Iterable[Any],
+        tenant_id: str = "default",
+        on_result: Optional[Callable[[int, Any], None]] = None
+    ) -> List[Any]:
+        """
+        Apply func to every item concurrently.
+        Results keep the order of items; a failed item yields its exception in place.
+        on_result(index, result_or_exception) is called as each item finishes.
+        """
+        async def _run_one(index: int, item: Any) -> Any:
+            try:
+                result = await self.run(func, item, tenant_id=tenant_id)
+            except Exception as e:
+                result = e
+            if on_result is not None:
+                try:
+                    on_result(index, result)
+                except Exception as e:
+                    logger.error(f"Result callback failed for item {index}: {str(e)}")
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        tasks = [asyncio.ensure_future(_run_one(i, item)) for i, item in enumerate(items)]
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_in_flight_per_tenant": self.max_in_flight_per_tenant,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "active_tenants": len(self._tenants)
+        }
@@ -0,0 +1,186 @@
+import logging
+import re
+import zlib
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+class ChunkSpan(NamedTuple):
+    """A chunk as character offsets into the source text"""
+    start: int
+    end: int
+    tokens: int
+
+    def text(self, source: str) -> str:
+        return source[self.start:self.end]
+
+
+class TextChunker:
+    """
+    Token-bounded chunker that works on offsets instead of copied strings.
+
+    The document is encoded once, and every cut is made at a token index of
+    that encoding: after each paragraph, and for paragraphs that are too
+    long at sentence ends, then every max_tokens tokens within sentences
+    that are still too long. A span's token count is then the distance
+    between its cuts, not a sum of separately encoded pieces, so no chunk
+    exceeds max_tokens. Segments are packed greedily into chunks. Nothing is
+    concatenated, so chunking stays linear in the input size.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._token_lengths: Optional[List[int]] = None
+
+    def _lengths(self) -> List[int]:
+        """Byte length of every token id, built on first use"""
+        if self._token_lengths is None:
+            lengths = []
+            for token in range(self.encoding.n_vocab):
+                try:
+                    lengths.append(len(self.encoding.decode_single_token_bytes(token)))
+                except KeyError:
+                    lengths.append(0)
+            self._token_lengths = lengths
+        return self._token_lengths
+
+    def _token_starts(self, text: str) -> List[int]:
+        """Character offset at which each token of text starts, plus len(text)"""
+        tokens = self.encoding.encode_ordinary(text)
+        if text.isascii():
+            # One byte per character, so offsets are running sums of token lengths
+            return list(accumulate(map(self._lengths().__getitem__, tokens), initial=0))
+        _, starts = self.encoding.decode_with_offsets(tokens)
+        starts.append(len(text))
+        return starts
+
+    def _segments(self, text: str, starts: List[int], max_tokens: int) -> List[Tuple[int, int, int]]:
+        """(start, end, tokens) for each paragraph, split further where needed"""
+        n_tokens = len(starts) - 1
+        # Paragraph ends, moved to the next token boundary; the newline stays
+        # with its paragraph so spans tile the text
+        cuts = [0]
+        offset = 0
+        for paragraph in text.split("\n")[:-1]:
+            offset += len(paragraph) + 1
+            cut = bisect_left(starts, offset, 0, n_tokens)
+            if cut > cuts[-1]:
+                cuts.append(cut)
+        if n_tokens > cuts[-1]:
+            cuts.append(n_tokens)
+
+        segments = []
+        for first, stop in zip(cuts, cuts[1:]):
+            if stop - first <= max_tokens:
+                segments.append((starts[first], starts[stop], stop - first))
+            else:
+                logger.warning(f"Found paragraph exceeding max tokens: {stop - first} tokens")
+                segments.extend(self._split_paragraph(text, starts, first, stop, max_tokens))
+        return segments
+
+    @staticmethod
+    def _split_paragraph(text: str, starts: List[int], first: int, stop: int,
+                         max_tokens: int) -> List[Tuple[int, int, int]]:
+        """Cut tokens first..stop at sentence ends, and sentences every max_tokens tokens"""
+        cuts = [first]
+        for match in _SENTENCE_END.finditer(text, starts[first], starts[stop]):
+            cut = bisect_left(starts, match.end(), first, stop)
+            if cut > cuts[-1]:
+                cuts.append(cut)
+        cuts.append(stop)
+
+        segments = []
+        for i, sentence_stop in zip(cuts, cuts[1:]):
+            while i < sentence_stop:
+                end = min(i + max_tokens, sentence_stop)
+                if end < sentence_stop:
+                    # Tokens sharing a start offset are pieces of one character; keep them together
+                    snapped = bisect_left(starts, starts[end], i, end)
+                    end = snapped if snapped > i else bisect_right(starts, starts[end], end, sentence_stop)
+                segments.append((starts[i], starts[end], end - i))
+                i = end
+        return segments
+
+    def split(self, text: str, max_tokens: int = 3000, overlap_tokens: int = 0,
+              content_defined: bool = False) -> List[ChunkSpan]:
+        """
+        Split text into spans of at most max_tokens tokens.
+        With overlap_tokens, each chunk repeats up to that many tokens of
+        whole trailing segments from the previous chunk.
+        With content_defined, chunks also end after anchor segments chosen by
+        a hash of their text (see _is_anchor). An edit then only moves the
+        boundaries next to it, so the other chunks of a revised document keep
+        their exact text and their cached analysis.
+        """
+        if max_tokens < 1:
+            raise ValueError("max_tokens must be positive")
+        if not 0 <= overlap_tokens < max_tokens:
+            raise ValueError("overlap_tokens must be between 0 and max_tokens")
+        if not text:
+            return []
+
+        starts = self._token_starts(text)
+        segments = self._segments(text, starts, max_tokens)
+        # Chunks never end at an anchor below half the limit, and an anchor
+        # turns up about every quarter of the limit after that
+        min_tokens = max_tokens // 2
+        target_tokens = max(1, max_tokens // 4)
+        spans: List[ChunkSpan] = []
+        first = 0
+        tokens = 0
+        carried = 0
+        for i, (_, _, seg_tokens) in enumerate(segments):
+            full = tokens + seg_tokens > max_tokens
+            # Overlap carried in from the previous chunk does not count towards the minimum
+            anchored = (
+                content_defined and i > first and tokens - carried >= min_tokens
+                and self._is_anchor(text, segments[i - 1], target_tokens)
+            )
+            if (full or anchored) and i > first:
+                spans.append(self._span(text, starts, segments, first, i, tokens))
+                # Start the next chunk with whole trailing segments of this one
+                next_first = i
+                overlap = 0
+                while next_first - 1 > first:
+                    prev_tokens = segments[next_first - 1][2]
+                    if overlap + prev_tokens > overlap_tokens or overlap + prev_tokens + seg_tokens > max_tokens:
+                        break
+                    next_first -= 1
+                    overlap += prev_tokens
+                first = next_first
+                tokens = carried = overlap
+            tokens += seg_tokens
+        if first < len(segments):
+            spans.append(self._span(text, starts, segments, first, len(segments), tokens))
+        return [span for span in spans if span.end > span.start]
+
+    @staticmethod
+    def _is_anchor(text: str, segment: Tuple[int, int, int], target_tokens: int) -> bool:
+        """
+        Whether a chunk may end after this segment.
+        A segment qualifies with probability proportional to its token count,
+        decided by a hash of its text alone, so anchors turn up about every
+        target_tokens tokens and the decision survives edits elsewhere.
+        """
+        start, end, seg_tokens = segment
+        return zlib.crc32(text[start:end].encode()) < (seg_tokens / target_tokens) * 0xFFFFFFFF
+
+    @staticmethod
+    def _span(text: str, starts: List[int], segments: List[Tuple[int, int, int]],
+              first: int, stop: int, tokens: int) -> ChunkSpan:
+        start = segments[first][0]
+        end = segments[stop - 1][1]
+        # Trim surrounding whitespace, but only whole tokens of it: cutting
+        # into a token such as " landlord" can make the chunk re-encode longer
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if end > start:
+            start = starts[bisect_right(starts, start) - 1]
+            end = starts[bisect_right(starts, end - 1)]
+        return ChunkSpan(start, end, tokens)
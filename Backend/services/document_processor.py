@@ -1,16 +1,31 @@
 import fitz
 import openai
-from typing import Tuple, List, Dict, Any, Optional
+from typing import Tuple, List, Dict, Any, Optional, Callable
 from Backend.models.document import DocumentSummary, TrustScore
+import asyncio
 import hashlib
 import os
 from dotenv import load_dotenv
 import logging
 import tiktoken
 from .masumi_client import MasumiClient, MasumiClientError
+from .chunk_scheduler import ChunkScheduler
+from .chunk_batcher import ChunkBatcher
+from .rate_limiter import AdaptiveRateLimiter, chat_completion, current_request, request_context
+from .analysis_cache import AnalysisCache
+from .retrieval import DocumentRetriever, OpenAIEmbedder, RetrievalIndexCache
+from .extraction_pool import ExtractionPool, ExtractionTimeoutError
+from .pdf_extraction import PDFParseError, get_engine, join_pages
+from .chunker import ChunkSpan, TextChunker
+from .flag_merge import FLAG_CATEGORIES, FlagMerger, MERGE_VERSION
+from .document_versions import DocumentVersionStore
+from .document_sessions import DocumentSession, DocumentSessionStore
+from .summary_tree import SummaryTree, truncate_words
+from .local_analysis import LOCAL_ANALYSIS_VERSION, LocalAnalyzer
+from .analysis_routing import AnalysisRouter, Route
 import traceback
 import json
-import PyPDF2
+from functools import partial
 from openai import AsyncOpenAI
 import time
 
@@ -41,6 +56,16 @@ console_handler.setFormatter(
 )
 logger.addHandler(console_handler)
 
+# Bump ANALYSIS_PROMPT_VERSION whenever the chunk prompts change so cached results are not reused.
+# The chunk model and prompt come from the document's route; ANALYSIS_MODEL reduces summaries.
+ANALYSIS_MODEL = "gpt-4-turbo-preview"
+ANALYSIS_PROMPT_VERSION = "2"
+# Rough size of one chunk's JSON analysis, used to budget tokens before the call
+ANALYSIS_COMPLETION_TOKENS = 500
+# Analysis engines: the model, or the deterministic local analyzer
+ENGINE_MODEL = "model"
+ENGINE_LOCAL = "local"
+
 class DocumentProcessingError(Exception):
     """Custom exception for document processing errors"""
     def __init__(self, message: str, error_code: str = None, details: Dict = None):
@@ -61,9 +86,38 @@ class DocumentProcessor:
             )
         
         try:
-            self.client = AsyncOpenAI(api_key=self.openai_api_key)
+            # Retries are left to the rate limiter, which knows about every other call in flight
+            self.client = AsyncOpenAI(api_key=self.openai_api_key, max_retries=0)
+            self.rate_limiter = AdaptiveRateLimiter()
+            self.analysis_deadline = float(os.getenv("ANALYSIS_DEADLINE_SECONDS", "600"))
             self.masumi_client = MasumiClient()
             self.encoding = tiktoken.get_encoding("cl100k_base")
+            self.chunker = TextChunker(self.encoding)
+            self.chunk_overlap_tokens = int(os.getenv("CHUNK_OVERLAP_TOKENS", "0"))
+            self.scheduler = ChunkScheduler()
+            self.flag_merger = FlagMerger()
+            self.local_analyzer = LocalAnalyzer()
+            # Chunks the model fails on, or takes longer than this on, get a local analysis instead
+            self.local_fallback = os.getenv("LOCAL_ANALYSIS_FALLBACK", "1") == "1"
+            self.model_chunk_timeout = float(os.getenv("MODEL_CHUNK_TIMEOUT_SECONDS", "120"))
+            # Chunks scoring below this locally have too little clause language to be worth a model call
+            self.prefilter_min_score = int(os.getenv("LOCAL_PREFILTER_MIN_SCORE", "2"))
+            self.router = AnalysisRouter()
+            # One batcher per route, since a batch shares its model and prompt
+            self.batchers: Dict[str, ChunkBatcher] = {}
+            # Chunks up to this size are batched; CHUNK_BATCH_MAX_ITEMS=1 turns batching off
+            self.batch_chunk_tokens = int(os.getenv("CHUNK_BATCH_CHUNK_TOKENS", "1000"))
+            self.cache = AnalysisCache(model_version=f"{ANALYSIS_MODEL}:{ANALYSIS_PROMPT_VERSION}")
+            self.versions = DocumentVersionStore(backend=self.cache.backend)
+            self.summary_tree = SummaryTree(
+                self.client, self.rate_limiter, ANALYSIS_MODEL, self.cache, self.scheduler, self.count_tokens
+            )
+            self.retrieval_indexes = RetrievalIndexCache(max_entries=int(os.getenv("RETRIEVAL_INDEX_CACHE_SIZE", "64")))
+            self.retrieval_chunk_tokens = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "800"))
+            self.sessions = DocumentSessionStore()
+            self.pdf_engine = get_engine()
+            self.extraction_pool = ExtractionPool()
+            self.embedder = OpenAIEmbedder(self.client) if os.getenv("RETRIEVAL_EMBEDDINGS") == "openai" else None
             logger.info("DocumentProcessor initialized successfully")
         except Exception as e:
             raise DocumentProcessingError(
@@ -79,9 +133,7 @@ class DocumentProcessor:
             return 0
             
         try:
-            token_count = len(self.encoding.encode(text))
-            logger.debug(f"Token count: {token_count} for text length: {len(text)}")
-            return token_count
+            return len(self.encoding.encode(text))
         except Exception as e:
             raise DocumentProcessingError(
                 message=f"Failed to count tokens: {str(e)}",
@@ -89,6 +141,71 @@ class DocumentProcessor:
                 details={"text_length": len(text)}
             )
 
+    async def extract_text_cached(self, content: bytes,
+                                  on_progress: Optional[Callable[[int, int], None]] = None) -> str:
+        """
+        Extract text from an uploaded PDF in the extraction pool,
+        reusing earlier extractions of identical files
+        """
+        cache_key = self.cache.content_hash(content)
+        text = self.cache.extractions.get(cache_key)
+        if text is not None:
+            logger.info("PDF text served from extraction cache")
+            return text
+        text = await self.extract_text_async(content, on_progress=on_progress)
+        self.cache.extractions.set(cache_key, text)
+        return text
+
+    async def extract_text_async(self, content: bytes,
+                                 on_progress: Optional[Callable[[int, int], None]] = None) -> str:
+        """Extract text from an in-memory PDF without blocking the event loop"""
+        if not content:
+            raise DocumentProcessingError(
+                message="PDF content cannot be empty",
+                error_code="EMPTY_UPLOAD"
+            )
+
+        start_time = time.time()
+        source = f"<upload: {len(content)} bytes>"
+        try:
+            logger.info(f"Starting pooled PDF text extraction: {source}")
+            total_pages, pages = await self.extraction_pool.extract_pages(content, on_progress=on_progress)
+            text = join_pages(pages)
+        except ExtractionTimeoutError as e:
+            raise DocumentProcessingError(
+                message=str(e),
+                error_code="EXTRACTION_TIMEOUT",
+                details={"path": source, "timeout": self.extraction_pool.job_timeout}
+            )
+        except PDFParseError as e:
+            raise DocumentProcessingError(
+                message=f"Error reading PDF file: {str(e)}",
+                error_code="PDF_READ_ERROR",
+                details={"path": source, "error": str(e)}
+            )
+        except asyncio.CancelledError:
+            logger.warning(f"PDF extraction cancelled: {source}")
+            raise
+        except Exception as e:
+            raise DocumentProcessingError(
+                message=f"Unexpected error processing PDF: {str(e)}",
+                error_code="PDF_PROCESSING_ERROR",
+                details={
+                    "path": source,
+                    "error": str(e),
+                    "processing_time": time.time() - start_time
+                }
+            )
+
+        if not text.strip():
+            raise DocumentProcessingError(
+                message="Extracted empty text from PDF",
+                error_code="EMPTY_PDF",
+                details={"path": source, "total_pages": total_pages}
+            )
+        logger.info(f"Extracted {len(text)} characters from {total_pages} pages in {time.time() - start_time:.2f} seconds")
+        return text
+
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """Extract text from a PDF file"""
         if not pdf_path:
@@ -97,177 +214,363 @@ class DocumentProcessor:
                 error_code="INVALID_PATH"
             )
             
-        start_time = time.time()
-        try:
-            logger.info(f"Starting PDF text extraction: {pdf_path}")
-            with open(pdf_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                total_pages = len(reader.pages)
-                logger.info(f"PDF has {total_pages} pages")
-                
-                text = ""
-                for i, page in enumerate(reader.pages, 1):
-                    try:
-                        page_text = page.extract_text()
-                        text += page_text + "\n"
-                        logger.debug(f"Extracted {len(page_text)} characters from page {i}/{total_pages}")
-                    except Exception as page_error:
-                        logger.error(f"Failed to extract text from page {i}: {str(page_error)}")
-                        continue
-                
-                if not text.strip():
-                    raise DocumentProcessingError(
-                        message="Extracted empty text from PDF",
-                        error_code="EMPTY_PDF",
-                        details={"path": pdf_path, "total_pages": total_pages}
-                    )
-                
-                processing_time = time.time() - start_time
-                logger.info(f"PDF processing completed in {processing_time:.2f} seconds")
-                logger.info(f"Extracted {len(text)} characters from {total_pages} pages")
-                return text
-                
-        except FileNotFoundError as e:
+        if not os.path.isfile(pdf_path):
             raise DocumentProcessingError(
                 message=f"PDF file not found: {pdf_path}",
                 error_code="FILE_NOT_FOUND",
                 details={"path": pdf_path}
             )
-        except PyPDF2.PdfReadError as e:
+        return self._extract_text(pdf_path, source=pdf_path)
+
+    def extract_text_from_bytes(self, content: bytes) -> str:
+        """Extract text from an in-memory PDF"""
+        if not content:
+            raise DocumentProcessingError(
+                message="PDF content cannot be empty",
+                error_code="EMPTY_UPLOAD"
+            )
+        return self._extract_text(content, source=f"<upload: {len(content)} bytes>")
+
+    def _extract_text(self, pdf_source, source: str) -> str:
+        """Extract text from PDF bytes or a PDF path with the configured engine"""
+        start_time = time.time()
+        try:
+            logger.info(f"Starting PDF text extraction with {self.pdf_engine.name}: {source}")
+            total_pages, pages = self.pdf_engine.read_pages(pdf_source)
+            logger.info(f"PDF has {total_pages} pages")
+            text = join_pages(pages)
+            
+            if not text.strip():
+                raise DocumentProcessingError(
+                    message="Extracted empty text from PDF",
+                    error_code="EMPTY_PDF",
+                    details={"path": source, "total_pages": total_pages}
+                )
+            
+            processing_time = time.time() - start_time
+            logger.info(f"PDF processing completed in {processing_time:.2f} seconds")
+            logger.info(f"Extracted {len(text)} characters from {total_pages} pages")
+            return text
+                
+        except DocumentProcessingError:
+            raise
+        except PDFParseError as e:
             raise DocumentProcessingError(
                 message=f"Error reading PDF file: {str(e)}",
                 error_code="PDF_READ_ERROR",
-                details={"path": pdf_path, "error": str(e)}
+                details={"path": source, "error": str(e)}
             )
         except Exception as e:
             raise DocumentProcessingError(
                 message=f"Unexpected error processing PDF: {str(e)}",
                 error_code="PDF_PROCESSING_ERROR",
                 details={
-                    "path": pdf_path,
+                    "path": source,
                     "error": str(e),
                     "processing_time": time.time() - start_time
                 }
             )
 
-    def split_text_into_chunks(self, text: str, max_tokens: int = 3000) -> List[str]:
-        """Split text into chunks that fit within token limit"""
+    def split_text_into_spans(self, text: str, max_tokens: int = 3000,
+                              overlap_tokens: Optional[int] = None,
+                              content_defined: bool = False) -> List[ChunkSpan]:
+        """Split text into token-bounded chunk spans (character offsets into text)"""
+        if overlap_tokens is None:
+            overlap_tokens = self.chunk_overlap_tokens
         try:
-            logger.info(f"Splitting text into chunks (max tokens: {max_tokens})")
-            chunks = []
-            current_chunk = ""
-            current_tokens = 0
-            
-            for paragraph in text.split("\n"):
-                paragraph_tokens = self.count_tokens(paragraph)
-                
-                if paragraph_tokens > max_tokens:
-                    logger.warning(f"Found paragraph exceeding max tokens: {paragraph_tokens} tokens")
-                    # Split paragraph into sentences
-                    sentences = paragraph.split(". ")
-                    for sentence in sentences:
-                        sentence_tokens = self.count_tokens(sentence)
-                        if current_tokens + sentence_tokens <= max_tokens:
-                            current_chunk += sentence + ". "
-                            current_tokens += sentence_tokens
-                        else:
-                            if current_chunk:
-                                chunks.append(current_chunk.strip())
-                            current_chunk = sentence + ". "
-                            current_tokens = sentence_tokens
-                else:
-                    if current_tokens + paragraph_tokens <= max_tokens:
-                        current_chunk += paragraph + "\n"
-                        current_tokens += paragraph_tokens
-                    else:
-                        if current_chunk:
-                            chunks.append(current_chunk.strip())
-                        current_chunk = paragraph + "\n"
-                        current_tokens = paragraph_tokens
-            
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            
-            logger.info(f"Split text into {len(chunks)} chunks")
-            return chunks
+            start_time = time.time()
+            spans = self.chunker.split(text, max_tokens=max_tokens, overlap_tokens=overlap_tokens,
+                                       content_defined=content_defined)
+            logger.info(
+                f"Split {len(text)} characters into {len(spans)} chunks "
+                f"(max tokens: {max_tokens}, overlap: {overlap_tokens}) in {(time.time() - start_time) * 1000:.1f} ms"
+            )
+            return spans
         except Exception as e:
             error_msg = f"Error splitting text into chunks: {str(e)}"
             logger.error(error_msg)
             logger.error(f"Traceback: {traceback.format_exc()}")
             raise DocumentProcessingError(error_msg) from e
 
-    async def process_chunk(self, chunk: str) -> Dict[str, Any]:
+    def split_text_into_chunks(self, text: str, max_tokens: int = 3000,
+                               overlap_tokens: Optional[int] = None,
+                               content_defined: bool = False) -> List[str]:
+        """Split text into chunks that fit within token limit"""
+        spans = self.split_text_into_spans(text, max_tokens, overlap_tokens, content_defined)
+        return [span.text(text) for span in spans]
+
+    def route_for(self, text: str, category: Optional[str]) -> Route:
+        """Route for a document; size is estimated at four characters per token to avoid a tokenizer pass"""
+        return self.router.route(category, len(text) // 4)
+
+    def _chunk_cache_key(self, chunk_hash: str, route: Route) -> str:
+        return self.cache.versioned_key(f"{route.key}:{chunk_hash}")
+
+    def _batcher(self, route: Route) -> ChunkBatcher:
+        batcher = self.batchers.get(route.name)
+        if batcher is None:
+            batcher = self.batchers[route.name] = ChunkBatcher(partial(self._scheduled_batch, route))
+        return batcher
+
+    async def _scheduled_batch(self, route: Route, chunks: List[str]) -> List[Any]:
+        """A batch is one request, so it takes one scheduler slot of its tenant"""
+        tenant_id, _ = current_request()
+        return await self.scheduler.run(self._analyze_batch, route, chunks, tenant_id=tenant_id)
+
+    async def process_chunk(self, chunk: str, route: Optional[Route] = None) -> Dict[str, Any]:
         """Process a single chunk of text using OpenAI API"""
+        route = route or self.router.routes["default"]
+        cache_key = self._chunk_cache_key(self.cache.content_hash(chunk), route)
+        cached = self.cache.chunks.get(cache_key)
+        if cached is not None:
+            logger.debug("Chunk analysis served from cache")
+            return cached
+
         try:
             logger.info(f"Processing chunk of {len(chunk)} characters")
             logger.debug(f"Chunk content: {chunk[:200]}...")  # Log first 200 chars
             
-            response = await self.client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "You are an expert at analyzing legal documents and contracts. Extract key information about rights, responsibilities, and risks."},
-                    {"role": "user", "content": f"Analyze this text and provide a JSON response with the following structure: {{'summary': 'brief summary', 'risks': ['list of risks'], 'rights': ['list of rights'], 'responsibilities': ['list of responsibilities']}}\n\nText:\n{chunk}"}
-                ],
-                response_format={"type": "json_object"}
-            )
+            # Small chunks share a request with other small chunks
+            tokens = self.count_tokens(chunk)
+            if tokens <= self.batch_chunk_tokens:
+                # The batch takes its own slot; holding this one would cap batches
+                # at the tenant's scheduler limit
+                self.scheduler.release_slot()
+                result = await self._batcher(route).submit(chunk, tokens)
+            else:
+                result = await self._analyze_chunk(chunk, route)
             
-            result = json.loads(response.choices[0].message.content)
+            self.cache.chunks.set(cache_key, result)
             logger.info("Successfully processed chunk")
             logger.debug(f"Chunk analysis result: {json.dumps(result, indent=2)}")
             return result
+        except DocumentProcessingError:
+            raise
+        except Exception as e:
+            error_msg = f"Error processing chunk: {str(e)}"
+            logger.error(error_msg)
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            raise DocumentProcessingError(error_msg) from e
+
+    async def analyze_chunk_routed(self, chunk: str, route: Optional[Route] = None) -> Dict[str, Any]:
+        """
+        Analyze a chunk with the model where it is worth it.
+        Chunks the local analyzer finds almost no clause language in skip the
+        model, and when the model fails or is too slow the local analysis is
+        used instead. Local results carry "engine": "local"; fallbacks also
+        carry "fallback": True.
+        """
+        if self.local_analyzer.score(chunk) < self.prefilter_min_score:
+            logger.debug("Chunk has too little clause language, analyzing locally")
+            return {**self.local_analyzer.analyze(chunk), "engine": ENGINE_LOCAL}
+        try:
+            return await asyncio.wait_for(self.process_chunk(chunk, route), self.model_chunk_timeout)
+        except asyncio.TimeoutError as e:
+            if not self.local_fallback:
+                raise DocumentProcessingError(
+                    f"Chunk analysis timed out after {self.model_chunk_timeout}s", "MODEL_TIMEOUT"
+                ) from e
+            logger.warning(f"Model took over {self.model_chunk_timeout}s on a chunk, using local analysis")
+        except DocumentProcessingError as e:
+            if not self.local_fallback:
+                raise
+            logger.warning(f"Model analysis failed, using local analysis: {str(e)}")
+        return {**self.local_analyzer.analyze(chunk), "engine": ENGINE_LOCAL, "fallback": True}
+
+    async def _routed_completion(self, route: Route, tokens: int, chunks: int, messages: List[Dict[str, str]]) -> Any:
+        """Run a chat completion on the route's model and record its latency and token use"""
+        start_time = time.monotonic()
+        try:
+            response = await chat_completion(
+                self.client, self.rate_limiter, tokens,
+                model=route.model,
+                messages=messages,
+                response_format={"type": "json_object"}
+            )
+        except Exception:
+            self.router.record(route, time.monotonic() - start_time, chunks=chunks, error=True)
+            raise
+        usage = getattr(response, "usage", None)
+        self.router.record(
+            route, time.monotonic() - start_time,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            chunks=chunks
+        )
+        return response
+
+    async def _analyze_chunk(self, chunk: str, route: Route) -> Dict[str, Any]:
+        """Analyze one chunk in its own request"""
+        response = await self._routed_completion(
+            route, self.count_tokens(chunk) + ANALYSIS_COMPLETION_TOKENS, 1,
+            [
+                {"role": "system", "content": route.system_prompt},
+                {"role": "user", "content": f"Analyze this text and provide a JSON response with the following structure: {{'summary': 'brief summary', 'risks': ['list of risks'], 'rights': ['list of rights'], 'responsibilities': ['list of responsibilities']}}\n{route.focus}\nText:\n{chunk}"}
+            ]
+        )
+        try:
+            return json.loads(response.choices[0].message.content)
         except json.JSONDecodeError as e:
             error_msg = f"Failed to parse OpenAI API response: {str(e)}"
             logger.error(error_msg)
             logger.error(f"Raw response: {response.choices[0].message.content}")
             raise DocumentProcessingError(error_msg) from e
+
+    async def _analyze_batch(self, route: Route, chunks: List[str]) -> List[Any]:
+        """
+        Analyze several chunks in one request.
+        The model answers with one entry per numbered section; sections it
+        leaves out, or a reply that cannot be parsed, fall back to separate requests.
+        """
+        if len(chunks) == 1:
+            return [await self._analyze_chunk(chunks[0], route)]
+
+        sections = "\n\n".join(f"Section {i + 1}:\n{chunk}" for i, chunk in enumerate(chunks))
+        results: List[Any] = [None] * len(chunks)
+        try:
+            tokens = sum(self.count_tokens(chunk) + ANALYSIS_COMPLETION_TOKENS for chunk in chunks)
+            response = await self._routed_completion(
+                route, tokens, len(chunks),
+                [
+                    {"role": "system", "content": route.system_prompt},
+                    {"role": "user", "content": f"Analyze each of the following {len(chunks)} sections on its own and provide a JSON response with the following structure: {{'results': [{{'section': section number, 'summary': 'brief summary', 'risks': ['list of risks'], 'rights': ['list of rights'], 'responsibilities': ['list of responsibilities']}}]}}, with exactly one entry per section.\n{route.focus}\n{sections}"}
+                ]
+            )
+            for entry in json.loads(response.choices[0].message.content).get("results", []):
+                index = int(entry.pop("section")) - 1
+                if 0 <= index < len(chunks) and results[index] is None:
+                    results[index] = entry
         except Exception as e:
-            error_msg = f"Error processing chunk: {str(e)}"
+            logger.error(f"Batched analysis of {len(chunks)} chunks failed, retrying separately: {str(e)}")
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            logger.warning(f"Analyzing {len(missing)} of {len(chunks)} batched sections separately")
+            retried = await asyncio.gather(*(self._analyze_chunk(chunks[i], route) for i in missing), return_exceptions=True)
+            for i, result in zip(missing, retried):
+                results[i] = result
+        return results
+
+    async def generate_summary(self, text: str, tenant_id: str = "default",
+                               on_chunk: Optional[Callable[[int, int, Any], None]] = None,
+                               chunks: Optional[List[str]] = None,
+                               engine: str = ENGINE_MODEL,
+                               category: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Generate a comprehensive summary of the document.
+        on_chunk(index, total, result_or_exception) is called as each chunk finishes.
+        chunks may pass in the document's content-defined chunks when the caller already has them;
+        they must be cut at the chunk size of the document's route.
+        engine "local" analyzes without any model call. category selects the model route.
+        """
+        if engine == ENGINE_LOCAL:
+            return await self._generate_local_summary(text, on_chunk, chunks)
+        route = self.route_for(text, category)
+        logger.info(f"Routing {category or 'uncategorized'} document to {route.name} ({route.model}, {route.prompt} prompt)")
+        # Every model call made for this document is attributed to the tenant and shares one deadline
+        with request_context(tenant_id=tenant_id, timeout=self.analysis_deadline):
+            return await self._generate_summary(text, tenant_id, on_chunk, chunks, route)
+
+    async def _generate_local_summary(self, text: str,
+                                      on_chunk: Optional[Callable[[int, int, Any], None]],
+                                      chunks: Optional[List[str]]) -> Dict[str, Any]:
+        try:
+            cache_key = self.cache.versioned_key(
+                f"{self.calculate_document_hash(text)}:local-{LOCAL_ANALYSIS_VERSION}:merge-{MERGE_VERSION}"
+            )
+            cached = self.cache.documents.get(cache_key)
+            if cached is not None:
+                logger.info("Local document analysis served from cache")
+                return cached
+
+            if chunks is None:
+                chunks = self.split_text_into_chunks(text, content_defined=True)
+            logger.info(f"Analyzing {len(chunks)} chunks locally")
+            chunk_results = []
+            for i, chunk in enumerate(chunks):
+                result = {**self.local_analyzer.analyze(chunk), "engine": ENGINE_LOCAL}
+                chunk_results.append((i, result))
+                if on_chunk is not None:
+                    on_chunk(i, len(chunks), result)
+                # Let other requests run between chunks of a long document
+                await asyncio.sleep(0)
+
+            final_result = self.flag_merger.merge_results(chunk_results)
+            final_result["failed_chunks"] = []
+            final_result["engine"] = ENGINE_LOCAL
+            if len(final_result["summary"].split()) > self.summary_tree.max_words:
+                final_result["summary"] = self.local_analyzer.summarize(
+                    final_result["summary"], self.summary_tree.max_words
+                )
+            self.cache.documents.set(cache_key, final_result)
+            return final_result
+        except Exception as e:
+            error_msg = f"Error analyzing document locally: {str(e)}"
             logger.error(error_msg)
             logger.error(f"Traceback: {traceback.format_exc()}")
             raise DocumentProcessingError(error_msg) from e
 
-    async def generate_summary(self, text: str) -> Dict[str, Any]:
-        """Generate a comprehensive summary of the document"""
+    async def _generate_summary(self, text: str, tenant_id: str,
+                                on_chunk: Optional[Callable[[int, int, Any], None]],
+                                chunks: Optional[List[str]], route: Route) -> Dict[str, Any]:
         try:
+            cache_key = self.cache.versioned_key(
+                f"{self.calculate_document_hash(text)}:{route.key}:{route.chunk_tokens}:merge-{MERGE_VERSION}"
+            )
+            cached = self.cache.documents.get(cache_key)
+            if cached is not None:
+                logger.info("Document summary served from cache")
+                return cached
+
             logger.info("Starting document summary generation")
-            chunks = self.split_text_into_chunks(text)
+            # Content-defined boundaries keep unchanged chunks identical across revisions
+            if chunks is None:
+                chunks = self.split_text_into_chunks(text, max_tokens=route.chunk_tokens, content_defined=True)
+            
+            # Process chunks concurrently; results come back in chunk order
+            logger.info(f"Processing {len(chunks)} chunks for tenant {tenant_id}")
+            on_result = (lambda i, result: on_chunk(i, len(chunks), result)) if on_chunk else None
+            results = await self.scheduler.map(
+                partial(self.analyze_chunk_routed, route=route), chunks, tenant_id=tenant_id, on_result=on_result
+            )
             
-            # Process each chunk
             chunk_results = []
-            for i, chunk in enumerate(chunks):
-                try:
-                    logger.info(f"Processing chunk {i+1}/{len(chunks)}")
-                    result = await self.process_chunk(chunk)
-                    chunk_results.append(result)
-                except Exception as e:
-                    logger.error(f"Error processing chunk {i+1}: {str(e)}")
-                    logger.error(f"Traceback: {traceback.format_exc()}")
+            for i, result in enumerate(results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing chunk {i+1}: {str(result)}")
                     # Continue with other chunks even if one fails
                     continue
+                chunk_results.append((i, result))
             
             if not chunk_results:
                 error_msg = "Failed to process any chunks successfully"
                 logger.error(error_msg)
                 raise DocumentProcessingError(error_msg)
             
-            # Combine results
-            combined_summary = ""
-            combined_risks = set()
-            combined_rights = set()
-            combined_responsibilities = set()
+            # Combine results, folding near-duplicate flags and summary sentences together
+            final_result = self.flag_merger.merge_results(chunk_results)
+            # Chunks that still failed after retries are reported rather than silently dropped
+            final_result["failed_chunks"] = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+            final_result["fallback_chunks"] = [i for i, result in chunk_results if result.get("fallback")]
+            final_result["engine"] = ENGINE_MODEL
+            final_result["route"] = route.name
             
-            for result in chunk_results:
-                combined_summary += result.get("summary", "") + " "
-                combined_risks.update(result.get("risks", []))
-                combined_rights.update(result.get("rights", []))
-                combined_responsibilities.update(result.get("responsibilities", []))
+            # Long documents get a tree-reduced summary of bounded size instead of the joined chunk summaries
+            # Fallback analyses stand in for the model only until it can be asked again
+            complete = len(chunk_results) == len(chunks) and not final_result["fallback_chunks"]
+            if len(final_result["summary"].split()) > self.summary_tree.max_words:
+                try:
+                    final_result["summary"] = await self.summary_tree.reduce(
+                        [result.get("summary", "") for _, result in chunk_results], tenant_id=tenant_id
+                    )
+                except Exception as e:
+                    logger.error(f"Summary reduction failed, truncating joined summaries: {str(e)}")
+                    final_result["summary"] = truncate_words(final_result["summary"], self.summary_tree.max_words)
+                    complete = False
             
-            final_result = {
-                "summary": combined_summary.strip(),
-                "risks": list(combined_risks),
-                "rights": list(combined_rights),
-                "responsibilities": list(combined_responsibilities)
-            }
+            # Only cache complete analyses so failed chunks are retried next time
+            if complete:
+                self.cache.documents.set(cache_key, final_result)
             
             logger.info("Successfully generated document summary")
             logger.debug(f"Final analysis result: {json.dumps(final_result, indent=2)}")
@@ -278,6 +581,112 @@ class DocumentProcessor:
             logger.error(f"Traceback: {traceback.format_exc()}")
             raise DocumentProcessingError(error_msg) from e
 
+    async def analyze_revision(self, text: str, document_id: str, tenant_id: str = "default",
+                               on_chunk: Optional[Callable[[int, int, Any], None]] = None,
+                               engine: str = ENGINE_MODEL, category: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Analyze text as the next version of document_id.
+        Chunks whose text is unchanged since the previous version reuse its
+        analysis, so only changed chunks are sent to the model. The result
+        adds a "revision" section with the version number, how many chunks
+        were reused and, from the second version on, which flags are new,
+        removed or unchanged.
+        """
+        previous = self.versions.get(tenant_id, document_id)
+        route = self.route_for(text, category)
+        max_tokens = route.chunk_tokens if engine == ENGINE_MODEL else 3000
+        chunks = self.split_text_into_chunks(text, max_tokens=max_tokens, content_defined=True)
+        hashes = [self.cache.content_hash(chunk) for chunk in chunks]
+        # Results are only reused for the same model and prompt, and never between local and model analyses
+        if engine == ENGINE_MODEL:
+            model_version = f"{self.cache.model_version}:{route.key}"
+        else:
+            model_version = f"{ENGINE_LOCAL}:{LOCAL_ANALYSIS_VERSION}"
+
+        reused = 0
+        if engine == ENGINE_MODEL and previous is not None and previous["model_version"] == model_version:
+            known = {chunk["hash"]: chunk["result"] for chunk in previous["chunks"]}
+            for chunk_hash in hashes:
+                if chunk_hash in known:
+                    # Seed the chunk cache so generate_summary skips these chunks
+                    self.cache.chunks.set(self._chunk_cache_key(chunk_hash, route), known[chunk_hash])
+                    reused += 1
+        logger.info(f"Analyzing revision of {document_id}: {reused}/{len(chunks)} chunks unchanged")
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(chunks)
+
+        def collect(index: int, total: int, result: Any) -> None:
+            # Fallback analyses are not kept, so the next version asks the model again
+            if not isinstance(result, Exception) and not result.get("fallback"):
+                results[index] = result
+            if on_chunk is not None:
+                on_chunk(index, total, result)
+
+        summary = await self.generate_summary(
+            text, tenant_id=tenant_id, on_chunk=collect, chunks=chunks, engine=engine, category=category
+        )
+        for i, chunk_hash in enumerate(hashes):
+            if results[i] is None and engine == ENGINE_MODEL:
+                # Served from the document cache, so no chunk callbacks ran
+                results[i] = self.cache.chunks.get(self._chunk_cache_key(chunk_hash, route))
+
+        flags = {category: summary[category] for category in FLAG_CATEGORIES}
+        record = self.versions.save(
+            tenant_id, document_id, self.calculate_document_hash(text), model_version,
+            [{"hash": h, "result": r} for h, r in zip(hashes, results) if r is not None],
+            flags
+        )
+        revision = {
+            "document_id": document_id,
+            "version": record["version"],
+            "previous_version": previous["version"] if previous is not None else None,
+            "chunks_total": len(chunks),
+            "chunks_reused": reused,
+            "flag_changes": None
+        }
+        if previous is not None:
+            revision["flag_changes"] = {
+                category: self.flag_merger.diff(previous["flags"].get(category, []), flags[category])
+                for category in FLAG_CATEGORIES
+            }
+        return {**summary, "revision": revision}
+
+    async def get_retriever(self, text: str, spans: Optional[List[ChunkSpan]] = None) -> DocumentRetriever:
+        """
+        Get the retrieval index for a document, chunking and indexing it only once.
+        spans may pass in the document's retrieval chunk spans when the caller already has them.
+        """
+        document_hash = self.calculate_document_hash(text)
+        retriever = self.retrieval_indexes.get(document_hash)
+        if retriever is not None:
+            return retriever
+
+        start_time = time.time()
+        if spans is None:
+            spans = self.split_text_into_spans(text, max_tokens=self.retrieval_chunk_tokens)
+        chunks = [span.text(text) for span in spans]
+        retriever = DocumentRetriever(chunks, embedder=self.embedder)
+        try:
+            await retriever.build_embeddings()
+        except Exception as e:
+            logger.error(f"Failed to build embedding index, using lexical index only: {str(e)}")
+            retriever.embeddings = None
+        self.retrieval_indexes.put(document_hash, retriever)
+        logger.info(f"Built retrieval index over {len(chunks)} chunks in {time.time() - start_time:.2f} seconds")
+        return retriever
+
+    def create_session(self, text: str, tenant_id: str = "default") -> DocumentSession:
+        """Keep extracted text server-side and return its session; chat turns then send only the handle"""
+        return self.sessions.create(text, tenant_id, self.calculate_document_hash(text))
+
+    async def get_session_retriever(self, session: DocumentSession) -> DocumentRetriever:
+        """The session's retrieval index, built on first use and kept with the session"""
+        if session.retriever is None:
+            spans = session.spans or self.split_text_into_spans(session.text, max_tokens=self.retrieval_chunk_tokens)
+            retriever = await self.get_retriever(session.text, spans)
+            self.sessions.attach_index(session, spans, retriever)
+        return session.retriever
+
     async def get_trust_score(self, document_hash: str, document_text: str) -> Tuple[float, bool]:
         """
         Get trust score for a document
@@ -303,6 +712,37 @@ class DocumentProcessor:
             # Return default values instead of raising error
             return 0.0, False
 
+    async def get_trust_scores(self, document_hashes: List[str]) -> List[Dict[str, Any]]:
+        """
+        Get trust scores for many documents by hash.
+        Returns one item per unique hash; failed lookups carry an error instead of a score.
+        """
+        items = await self.masumi_client.verify_documents(document_hashes)
+        scores = []
+        for item in items:
+            result = item["result"]
+            if result is None:
+                error = item["error"]
+                scores.append({
+                    "document_hash": item["document_hash"],
+                    "error": {
+                        "error_code": error["error_code"],
+                        "message": error["message"]
+                    }
+                })
+                continue
+            try:
+                trust_score = max(0.0, min(1.0, float(result.get("trust_score", 0.0))))
+            except (TypeError, ValueError):
+                logger.error(f"Invalid trust score format: {result.get('trust_score')}")
+                trust_score = 0.0
+            scores.append({
+                "document_hash": item["document_hash"],
+                "trust_score": trust_score,
+                "is_verified": bool(result.get("is_verified", False))
+            })
+        return scores
+
     def calculate_document_hash(self, text: str) -> str:
         try:
             return hashlib.sha256(text.encode()).hexdigest()
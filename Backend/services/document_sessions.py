@@ -0,0 +1,120 @@
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from .chunker import ChunkSpan
+from .retrieval import DocumentRetriever
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentSession:
+    """An uploaded document kept server-side so chat turns can refer to it by handle"""
+    def __init__(self, handle: str, tenant_id: str, text: str, document_hash: str):
+        self.handle = handle
+        self.tenant_id = tenant_id
+        self.text = text
+        self.document_hash = document_hash
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        # Filled in on the first question
+        self.spans: Optional[List[ChunkSpan]] = None
+        self.retriever: Optional[DocumentRetriever] = None
+
+    @property
+    def size(self) -> int:
+        """Approximate bytes held: the text, plus the chunk copies once it is indexed"""
+        return len(self.text) * (2 if self.retriever is not None else 1)
+
+
+class DocumentSessionStore:
+    """
+    Bounded store of document sessions.
+
+    Sessions are evicted least recently used first once the store holds more
+    than max_entries sessions or max_bytes of text and indexes, and expire
+    after ttl seconds without use. Handles are unguessable and only resolve
+    for the tenant that created them.
+    """
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None):
+        self.max_entries = max_entries or int(os.getenv("DOCUMENT_SESSION_MAX_ENTRIES", "1024"))
+        self.max_bytes = max_bytes or int(os.getenv("DOCUMENT_SESSION_MAX_BYTES", str(512 * 1024 * 1024)))
+        self.ttl = ttl or float(os.getenv("DOCUMENT_SESSION_TTL", "3600"))
+        self._sessions: "OrderedDict[str, DocumentSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def create(self, text: str, tenant_id: str, document_hash: str) -> DocumentSession:
+        session = DocumentSession(secrets.token_urlsafe(24), tenant_id, text, document_hash)
+        with self._lock:
+            self._sessions[session.handle] = session
+            self._bytes += session.size
+            self._evict()
+        logger.info(f"Created document session for tenant {tenant_id} ({len(text)} characters)")
+        return session
+
+    def get(self, handle: str, tenant_id: str) -> Optional[DocumentSession]:
+        """The live session for handle, or None when it is unknown, expired or another tenant's"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(handle)
+            if session is None:
+                return None
+            if now - session.last_used > self.ttl:
+                self._remove(session)
+                self.expirations += 1
+                return None
+            if session.tenant_id != tenant_id:
+                return None
+            session.last_used = now
+            self._sessions.move_to_end(handle)
+            return session
+
+    def attach_index(self, session: DocumentSession, spans: List[ChunkSpan], retriever: DocumentRetriever) -> None:
+        """Keep the session's retrieval chunks and index, counting them against the byte budget"""
+        with self._lock:
+            if self._sessions.get(session.handle) is not session:
+                # Evicted while the index was being built; nothing to account
+                session.spans, session.retriever = spans, retriever
+                return
+            self._bytes -= session.size
+            session.spans, session.retriever = spans, retriever
+            self._bytes += session.size
+            self._evict()
+
+    def delete(self, handle: str, tenant_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.get(handle)
+            if session is None or session.tenant_id != tenant_id:
+                return False
+            self._remove(session)
+            return True
+
+    def _remove(self, session: DocumentSession) -> None:
+        del self._sessions[session.handle]
+        self._bytes -= session.size
+
+    def _evict(self) -> None:
+        # The newest session always stays, even when it alone exceeds the byte budget
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_entries or self._bytes > self.max_bytes):
+            _, session = self._sessions.popitem(last=False)
+            self._bytes -= session.size
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
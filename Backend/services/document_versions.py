@@ -0,0 +1,60 @@
+import hashlib
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from .analysis_cache import CacheBackend, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentVersionStore:
+    """
+    Latest analyzed version of each tenant's documents.
+
+    A record keeps the version number, the hash of every chunk with its
+    analysis, and the merged flags, which is everything needed to reuse
+    unchanged chunks and to diff flags when a revision is uploaded.
+    Records share the analysis cache backend, so with the SQLite backend
+    they survive restarts.
+    """
+    def __init__(self, backend: Optional[CacheBackend] = None, ttl: Optional[float] = None,
+                 max_entries: Optional[int] = None):
+        if ttl is None:
+            ttl = float(os.getenv("DOCUMENT_VERSION_TTL", "7776000"))  # 90 days
+        if max_entries is None:
+            max_entries = int(os.getenv("DOCUMENT_VERSION_MAX_ENTRIES", "1024"))
+        self.records = TTLCache("version", max_entries=max_entries, ttl=ttl, backend=backend)
+
+    @staticmethod
+    def _key(tenant_id: str, document_id: str) -> str:
+        return hashlib.sha256(f"{tenant_id}\0{document_id}".encode()).hexdigest()
+
+    def get(self, tenant_id: str, document_id: str) -> Optional[Dict[str, Any]]:
+        return self.records.get(self._key(tenant_id, document_id))
+
+    def save(self, tenant_id: str, document_id: str, text_hash: str, model_version: str,
+             chunks: List[Dict[str, Any]], flags: Dict[str, List[str]]) -> Dict[str, Any]:
+        """
+        Record a new version and return it.
+        chunks holds {"hash", "result"} per chunk in document order; results
+        are only reused while model_version stays the same.
+        """
+        previous = self.get(tenant_id, document_id)
+        if previous is not None and previous["text_hash"] == text_hash:
+            # Same text uploaded again; keep the version number
+            version = previous["version"]
+        else:
+            version = previous["version"] + 1 if previous is not None else 1
+        record = {
+            "version": version,
+            "text_hash": text_hash,
+            "model_version": model_version,
+            "analyzed_at": time.time(),
+            "chunks": chunks,
+            "flags": flags
+        }
+        self.records.set(self._key(tenant_id, document_id), record)
+        logger.info(f"Stored version {version} of document {document_id} for tenant {tenant_id}")
+        return record
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from .pdf_extraction import PDFSource, SharedPDF, extract_page_range, get_engine
+
+logger = logging.getLogger(__name__)
+
+
+def _timed_job(func: Callable, *args: Any) -> Tuple[float, Any]:
+    """Runs in the worker; reports when the job actually started so queue wait can be measured"""
+    started_at = time.time()
+    return started_at, func(*args)
+
+
+class ExtractionTimeoutError(Exception):
+    """Raised when an extraction job does not finish within its timeout"""
+
+
+class ExtractionPool:
+    """
+    Process pool for CPU-bound PDF extraction.
+
+    Keeps parsing off the event loop. An upload is copied once into a shared
+    memory block that workers map by name, so a job pickles only that name
+    and its page range, and nothing is written to disk.
+    Large documents are split into page ranges that run on several workers
+    at once. A timeout or cancellation cancels the ranges that have not
+    started yet; when ranges are already running, the workers are killed
+    and the pool restarted so they stop holding it. Other requests' ranges
+    lost with those workers are submitted again once.
+    """
+    def __init__(self, max_workers: Optional[int] = None, job_timeout: Optional[float] = None,
+                 pages_per_job: Optional[int] = None, engine: Optional[str] = None):
+        self.max_workers = max_workers or int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+        self.job_timeout = job_timeout or float(os.getenv("EXTRACTION_TIMEOUT", "120"))
+        self.pages_per_job = pages_per_job or int(os.getenv("EXTRACTION_PAGES_PER_JOB", "50"))
+        self.engine = engine or os.getenv("PDF_ENGINE", "auto")
+        # Fail at startup rather than in a worker if the engine name is wrong
+        get_engine(self.engine)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Bumped whenever the workers are killed, to tell that apart from a crash
+        self._generation = 0
+        # Done callbacks run on the executor's management thread
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.restarts = 0
+        self.total_queue_wait = 0.0
+        self.total_run_time = 0.0
+
+    def start(self) -> None:
+        """Create the worker processes (also done lazily on first use)"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                # Forking a threaded server process is unsafe, so start clean workers
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.info(f"Extraction pool started with {self.max_workers} workers")
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            _shutdown_executor(self._executor)
+            self._executor = None
+            logger.info("Extraction pool shut down")
+
+    def _restart(self) -> None:
+        """Kill the workers, including any still running a job, and start afresh on next use"""
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        self._generation += 1
+        self.restarts += 1
+        # ProcessPoolExecutor cannot stop a running job, only the process running it.
+        # Jobs left in the old pool then fail with BrokenProcessPool rather than
+        # being cancelled, so their requests can tell to resubmit them
+        if sys.version_info < (3, 12):
+            # Before 3.12 the pool's management thread dies setting BrokenProcessPool
+            # on a cancelled job, and every other job in the pool is never resolved;
+            # cancelled jobs get a stand-in future nobody waits on
+            for item in list((getattr(executor, "_pending_work_items", None) or {}).values()):
+                if item.future.cancelled():
+                    item.future = Future()
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        for process in processes:
+            process.terminate()
+        executor.shutdown(wait=False)
+        logger.warning(f"Killed {len(processes)} extraction workers still running timed out ranges")
+
+    def _submit(self, func: Callable, *args: Any) -> Tuple[Future, "asyncio.Future[Any]"]:
+        self.start()
+        submitted_at = time.time()
+        future: Future = self._executor.submit(_timed_job, func, *args)
+        with self._lock:
+            self.submitted += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        def _done(f: Future) -> None:
+            with self._lock:
+                self.in_flight -= 1
+                if f.cancelled():
+                    self.cancelled += 1
+                elif f.exception() is not None:
+                    self.failed += 1
+                else:
+                    started_at, _ = f.result()
+                    self.completed += 1
+                    self.total_queue_wait += max(0.0, started_at - submitted_at)
+                    self.total_run_time += time.time() - started_at
+
+        future.add_done_callback(_done)
+        return future, asyncio.wrap_future(future)
+
+    async def _extract(self, jobs: List[Future], source: Union[str, SharedPDF],
+                       start: int, end: int) -> Tuple[int, List[Optional[str]]]:
+        """One page range; resubmitted once when another request's timeout killed its worker"""
+        for attempt in range(2):
+            generation = self._generation
+            job, future = self._submit(extract_page_range, source, start, end, self.engine)
+            jobs.append(job)
+            try:
+                _, result = await future
+                return result
+            except BrokenProcessPool:
+                if attempt or generation == self._generation:
+                    raise
+                logger.info(f"Extraction workers were restarted, resubmitting pages {start}-{end}")
+
+    async def extract_pages(self, data: PDFSource, timeout: Optional[float] = None,
+                            on_progress: Optional[Callable[[int, int], None]] = None) -> Tuple[int, List[Optional[str]]]:
+        """
+        Extract every page of a PDF, given as bytes or a file path, in the pool.
+        Returns (total_pages, texts) with texts in page order.
+        on_progress(pages_extracted, total_pages) is called as each page range finishes.
+        """
+        timeout = timeout or self.job_timeout
+        deadline = time.monotonic() + timeout
+        loop = asyncio.get_running_loop()
+        block = None
+        if isinstance(data, str):
+            source: Union[str, SharedPDF] = data
+        else:
+            block = await loop.run_in_executor(None, _share, data)
+            source = SharedPDF(block.name, len(data))
+        jobs: List[Future] = []
+        pending: List[asyncio.Future] = []
+        abandoned = False
+        try:
+            # Count pages alongside the first range, so large documents fan out without waiting for it
+            first = asyncio.ensure_future(self._extract(jobs, source, 0, self.pages_per_job))
+            count = asyncio.ensure_future(self._extract(jobs, source, 0, 0))
+            pending = [first, count]
+            total_pages, _ = await asyncio.wait_for(count, timeout)
+
+            starts = range(self.pages_per_job, total_pages, self.pages_per_job)
+            pending = [first] + [
+                asyncio.ensure_future(self._extract(jobs, source, start, start + self.pages_per_job))
+                for start in starts
+            ]
+            if len(pending) > 1:
+                logger.info(f"Extracting {total_pages} pages in {len(pending)} parallel ranges")
+            if on_progress is not None:
+                extracted = 0
+
+                def _range_done(f: asyncio.Future) -> None:
+                    nonlocal extracted
+                    if not f.cancelled() and f.exception() is None:
+                        extracted += len(f.result()[1])
+                        on_progress(extracted, total_pages)
+                for future in pending:
+                    future.add_done_callback(_range_done)
+            remaining = max(0.0, deadline - time.monotonic())
+            results = await asyncio.wait_for(asyncio.gather(*pending), remaining)
+            return total_pages, [page for _, range_pages in results for page in range_pages]
+        except asyncio.TimeoutError:
+            abandoned = True
+            self.timed_out += 1
+            raise ExtractionTimeoutError(f"PDF extraction did not finish within {timeout:.0f} seconds")
+        except asyncio.CancelledError:
+            abandoned = True
+            raise
+        finally:
+            for future in pending:
+                if not future.done():
+                    future.cancel()
+                elif not future.cancelled():
+                    # Mark sibling failures as seen; the first one is already propagating
+                    future.exception()
+            for job in jobs:
+                job.cancel()
+            if abandoned and any(job.running() for job in jobs):
+                self._restart()
+            if block is not None:
+                # Workers still running a range keep their mapping until they finish
+                block.close()
+                block.unlink()
+
+    def stats(self) -> Dict[str, Any]:
+        completed = self.completed or 1
+        return {
+            "max_workers": self.max_workers,
+            "engine": self.engine,
+            "running": self._executor is not None,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.max_workers),
+            "peak_in_flight": self.peak_in_flight,
+            "saturation": round(self.in_flight / self.max_workers, 2),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "restarts": self.restarts,
+            "avg_queue_wait_seconds": round(self.total_queue_wait / completed, 4),
+            "avg_run_seconds": round(self.total_run_time / completed, 4)
+        }
+
+
+def _share(data: PDFSource) -> shared_memory.SharedMemory:
+    """Copy an upload into a shared memory block the workers can map"""
+    # A block cannot be empty; the extra byte is outside the SharedPDF size
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        block.buf[:len(data)] = data
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    return block
+
+
+def _shutdown_executor(executor: ProcessPoolExecutor) -> None:
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        # No cancel_futures before 3.9; queued jobs still run, and their results are dropped
+        executor.shutdown(wait=False)
@@ -0,0 +1,273 @@
+"""
+Near-duplicate merging for the flags and summaries produced per chunk.
+
+Each flag is reduced to a set of character shingles and summarized by a
+MinHash signature; locality-sensitive hashing over signature bands finds
+candidate pairs without comparing every flag to every other one. A flag
+joins an earlier cluster when its estimated Jaccard similarity to that
+cluster's leader clears the threshold and both name the same parties and
+negations. Each cluster keeps one representative plus the chunks it came
+from.
+"""
+import logging
+import os
+import re
+import zlib
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump MERGE_VERSION whenever merging changes so cached documents are re-merged
+MERGE_VERSION = "1"
+
+FLAG_CATEGORIES = ("risks", "rights", "responsibilities")
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+_STOPWORDS = frozenset("""
+a an and are as at be by can could do does for from has have if in is it its may
+must of on or shall should that the their them they this to was were which will
+with would you your
+""".split())
+
+# Words two flags must agree on before they can merge, however similar the
+# rest is: who the flag applies to, and whether it is negated
+_ANCHORS = frozenset("""
+tenant landlord lessee lessor owner buyer seller employer employee borrower lender
+licensor licensee provider customer client contractor company user guarantor
+not no non never without nor cannot
+""".split())
+
+# Crude suffix stripping so "payment", "payments" and "pay" share shingles
+_SUFFIXES = ("ments", "ment", "ings", "ing", "ions", "ion", "ed", "es", "ly", "s")
+
+# Shingles hashed per block when building signatures, bounding the working set
+_SIGNATURE_BLOCK = 8192
+
+
+@lru_cache(maxsize=65536)
+def _stem(word: str) -> str:
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def normalize(text: str) -> Tuple[str, ...]:
+    """Stemmed content words of a flag"""
+    return tuple(_stem(w) for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS)
+
+
+def anchors(words: Sequence[str]) -> FrozenSet[str]:
+    return frozenset(word for word in words if word in _ANCHORS)
+
+
+def shingles(word: str, size: int = 3) -> List[int]:
+    """32-bit hashes of the character shingles of a word"""
+    padded = f" {word} "
+    if len(padded) <= size:
+        return [zlib.crc32(padded.encode())]
+    return list({zlib.crc32(padded[i:i + size].encode()) for i in range(len(padded) - size + 1)})
+
+
+class FlagMerger:
+    """
+    Clusters near-identical strings with MinHash and LSH.
+
+    threshold is the estimated Jaccard similarity of shingle sets above which
+    a string joins an existing cluster; bands * rows is the signature length.
+    The default 32 bands of 4 rows catch most pairs from about 0.45
+    similarity upwards.
+    """
+    def __init__(self, threshold: Optional[float] = None, bands: int = 32, rows: int = 4, seed: int = 1):
+        self.threshold = threshold if threshold is not None else float(os.getenv("FLAG_MERGE_THRESHOLD", "0.5"))
+        if not 0 < self.threshold <= 1:
+            raise ValueError("threshold must be in (0, 1]")
+        self.bands = bands
+        self.rows = rows
+        rng = np.random.default_rng(seed)
+        permutations = bands * rows
+        # Multiply-shift hashing: odd 64-bit multipliers, keep the high 32 bits
+        self._a = rng.integers(0, 1 << 63, size=permutations, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, size=permutations, dtype=np.uint64)
+        self._band_mix = rng.integers(0, 1 << 63, size=rows, dtype=np.uint64) | np.uint64(1)
+        self._band_salt = rng.integers(0, 1 << 63, size=bands, dtype=np.uint64)
+
+    def _minhash(self, shingle_sets: List[List[int]]) -> np.ndarray:
+        """MinHash signatures, one column per shingle set"""
+        signatures = np.empty((self.bands * self.rows, len(shingle_sets)), dtype=np.uint32)
+        start = 0
+        while start < len(shingle_sets):
+            # Take whole sets until the block holds about _SIGNATURE_BLOCK shingles
+            stop = start
+            size = 0
+            while stop < len(shingle_sets) and (stop == start or size + len(shingle_sets[stop]) <= _SIGNATURE_BLOCK):
+                size += len(shingle_sets[stop])
+                stop += 1
+            block = shingle_sets[start:stop]
+            lengths = np.fromiter((len(s) for s in block), dtype=np.int64, count=len(block))
+            values = np.fromiter((h for s in block for h in s), dtype=np.uint64, count=size)
+            # One row per permutation keeps the reduction over contiguous memory
+            hashed = np.multiply.outer(self._a, values)
+            hashed += self._b[:, None]
+            hashed >>= np.uint64(32)
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            signatures[:, start:stop] = np.minimum.reduceat(hashed, offsets, axis=1)
+            start = stop
+        return signatures
+
+    def _signatures(self, keys: List[Tuple[str, ...]]) -> np.ndarray:
+        """
+        MinHash signatures of normalized strings.
+        The minimum over a union is the minimum of the parts, so each distinct
+        word is hashed once and a string's signature is the minimum over its
+        words' signatures. Flags share most of their vocabulary, which keeps
+        the hashing work proportional to the vocabulary, not the flag count.
+        """
+        vocabulary: Dict[str, int] = {}
+        word_ids = [vocabulary.setdefault(word, len(vocabulary)) for key in keys for word in key]
+        word_signatures = self._minhash([shingles(word) for word in vocabulary])
+        lengths = np.fromiter((len(key) for key in keys), dtype=np.int64, count=len(keys))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return np.ascontiguousarray(np.minimum.reduceat(word_signatures[:, word_ids], offsets, axis=1).T)
+
+    def _candidates(self, signatures: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        LSH candidate pairs (i, j) with j < i.
+        Within every band bucket each member is paired with the bucket's first
+        member only, which keeps the pair count linear in the number of strings.
+        """
+        count = len(signatures)
+        bands = signatures.reshape(count, self.bands, self.rows).astype(np.uint64)
+        # Salt each band's key so one pass over all bands keeps them apart
+        keys = (bands * self._band_mix).sum(axis=2) + self._band_salt
+        _, first, inverse = np.unique(keys.ravel(), return_index=True, return_inverse=True)
+        # Keys are laid out item by item, so the first occurrence is the lowest item
+        heads = first[inverse.ravel()] // self.bands
+        items = np.repeat(np.arange(count), self.bands)
+        linked = heads != items
+        pairs = np.unique(items[linked] * count + heads[linked])
+        return pairs // count, pairs % count
+
+    def cluster(self, texts: Sequence[str]) -> List[List[int]]:
+        """Group indices of texts into clusters of near duplicates, in order of first appearance"""
+        if not texts:
+            return []
+
+        # Exact duplicates after normalization never need hashing
+        unique: Dict[Tuple[str, ...], List[int]] = {}
+        for i, text in enumerate(texts):
+            unique.setdefault(normalize(text) or (text.strip().lower(),), []).append(i)
+        keys = list(unique)
+        groups = list(unique.values())
+        if len(keys) == 1:
+            return [sorted(groups[0])]
+
+        signatures = self._signatures(keys)
+        permutations = signatures.shape[1]
+        required = self.threshold * permutations
+        items, heads = self._candidates(signatures)
+        anchor_ids: Dict[FrozenSet[str], int] = {}
+        anchor_of = np.array([anchor_ids.setdefault(anchors(key), len(anchor_ids)) for key in keys])
+        agreement = np.count_nonzero(signatures[items] == signatures[heads], axis=1)
+        similar = (agreement >= required) & (anchor_of[items] == anchor_of[heads])
+        # Best match first for every string
+        order = np.lexsort((-agreement[similar], items[similar]))
+        items, heads = items[similar][order].tolist(), heads[similar][order].tolist()
+
+        # Leader clustering: a string joins the cluster of its most similar
+        # earlier leader, so a chain of small rewordings cannot drift into
+        # one giant cluster
+        leader_of = list(range(len(keys)))
+        position = 0
+        for i in range(len(keys)):
+            while position < len(items) and items[position] == i:
+                head = heads[position]
+                position += 1
+                if leader_of[i] != i:
+                    continue
+                leader = leader_of[head]
+                if leader == head or (anchor_of[i] == anchor_of[leader]
+                                      and np.count_nonzero(signatures[i] == signatures[leader]) >= required):
+                    leader_of[i] = leader
+
+        clusters: Dict[int, List[int]] = {}
+        for i, leader in enumerate(leader_of):
+            clusters.setdefault(leader, []).extend(groups[i])
+        return [sorted(members) for members in clusters.values()]
+
+    def merge_flags(self, flags: Sequence[Tuple[str, int]]) -> List[Dict[str, Any]]:
+        """
+        Merge (flag, chunk_index) pairs.
+        Each cluster is represented by its most frequent variant, earliest first on ties.
+        """
+        texts = [text for text, _ in flags]
+        merged = []
+        for members in self.cluster(texts):
+            counts: Dict[str, int] = {}
+            for i in members:
+                counts[texts[i]] = counts.get(texts[i], 0) + 1
+            representative = max(counts, key=counts.get)
+            merged.append({
+                "text": representative,
+                "chunks": sorted({flags[i][1] for i in members}),
+                "variants": len(counts)
+            })
+        return merged
+
+    def diff(self, previous: Sequence[str], current: Sequence[str]) -> Dict[str, List[str]]:
+        """
+        Compare the flags of two versions of a document.
+        A current flag that matches a previous one, even reworded, is unchanged.
+        New and unchanged flags use the current wording, removed ones the previous.
+        """
+        texts = list(previous) + list(current)
+        changes: Dict[str, List[str]] = {"new": [], "removed": [], "unchanged": []}
+        for members in self.cluster(texts):
+            old = [texts[i] for i in members if i < len(previous)]
+            new = [texts[i] for i in members if i >= len(previous)]
+            if old and new:
+                changes["unchanged"].extend(new)
+            elif new:
+                changes["new"].extend(new)
+            else:
+                changes["removed"].extend(old)
+        return changes
+
+    def merge_summaries(self, summaries: Sequence[str]) -> str:
+        """Join chunk summaries, dropping sentences that repeat an earlier one"""
+        sentences = [s.strip() for summary in summaries for s in _SENTENCE_RE.split(summary) if s.strip()]
+        return " ".join(sentences[members[0]] for members in self.cluster(sentences))
+
+    def merge_results(self, chunk_results: Sequence[Tuple[int, Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Combine (chunk_index, result) pairs into one analysis.
+        Flag lists hold one representative per cluster; flag_details adds the
+        source chunks and number of distinct phrasings for each.
+        """
+        details = {}
+        for category in FLAG_CATEGORIES:
+            flags = [
+                (flag, index)
+                for index, result in chunk_results
+                for flag in result.get(category, [])
+                if isinstance(flag, str) and flag.strip()
+            ]
+            details[category] = self.merge_flags(flags)
+
+        merged = {
+            "summary": self.merge_summaries([result.get("summary", "") for _, result in chunk_results]),
+            **{category: [item["text"] for item in details[category]] for category in FLAG_CATEGORIES},
+            "flag_details": details
+        }
+        logger.debug(
+            "Merged flags: " + ", ".join(
+                f"{category} {sum(len(r.get(category, [])) for _, r in chunk_results)} -> {len(details[category])}"
+                for category in FLAG_CATEGORIES
+            )
+        )
+        return merged
@@ -0,0 +1,520 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED_STATES = (COMPLETED, FAILED)
+
+
+class JobQueueFullError(Exception):
+    """Raised when a job is submitted while max_queued jobs are already waiting"""
+
+
+def empty_progress() -> Dict[str, Any]:
+    return {
+        "pages_total": None,
+        "pages_extracted": 0,
+        "chunks_total": None,
+        "chunks_analyzed": 0,
+        "chunks_failed": 0
+    }
+
+
+def new_job(filename: str, category: str, tenant_id: str, engine: str = "model") -> Dict[str, Any]:
+    now = time.time()
+    return {
+        "job_id": str(uuid.uuid4()),
+        "status": QUEUED,
+        "filename": filename,
+        "category": category,
+        "tenant_id": tenant_id,
+        "engine": engine,
+        "created_at": now,
+        "updated_at": now,
+        "progress": empty_progress(),
+        "partial": {"risks": [], "rights": [], "responsibilities": []},
+        "result": None,
+        "error": None
+    }
+
+
+class JobBackend(ABC):
+    """Job state plus the queue of PDFs waiting to be analyzed"""
+
+    @abstractmethod
+    def enqueue(self, job: Dict[str, Any], payload: bytes) -> None:
+        """Queue the job, raising JobQueueFullError when too many are waiting"""
+
+    @abstractmethod
+    async def claim(self) -> Tuple[str, bytes]:
+        """Wait for the next queued job and mark it running"""
+
+    @abstractmethod
+    def save(self, job: Dict[str, Any]) -> None:
+        pass
+
+    @abstractmethod
+    def requeue(self, job: Dict[str, Any]) -> None:
+        """Put a job this worker could not finish back on the queue, keeping its payload"""
+
+    def renew(self, job_id: str) -> bool:
+        """Extend this worker's claim on a running job; False when the claim was lost"""
+        return True
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class InMemoryJobBackend(JobBackend):
+    """
+    Single-process backend; finished jobs are kept up to max_jobs. Payloads
+    stay in memory until their job finishes, so at most max_queued of them
+    wait in the queue.
+    """
+    def __init__(self, max_jobs: int = 1000, max_queued: int = 64):
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._payloads: Dict[str, bytes] = {}
+        self._queue: Optional[asyncio.Queue] = None
+
+    def _get_queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queued)
+        return self._queue
+
+    def enqueue(self, job: Dict[str, Any], payload: bytes) -> None:
+        try:
+            self._get_queue().put_nowait(job["job_id"])
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"{self.max_queued} jobs are already waiting")
+        self._jobs[job["job_id"]] = job
+        self._payloads[job["job_id"]] = payload
+        # Drop the oldest finished jobs once over the limit
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in [j for j, state in self._jobs.items() if state["status"] in FINISHED_STATES][:max(0, excess)]:
+            del self._jobs[job_id]
+
+    async def claim(self) -> Tuple[str, bytes]:
+        job_id = await self._get_queue().get()
+        return job_id, self._payloads[job_id]
+
+    def save(self, job: Dict[str, Any]) -> None:
+        self._jobs[job["job_id"]] = job
+        if job["status"] in FINISHED_STATES:
+            self._payloads.pop(job["job_id"], None)
+
+    def requeue(self, job: Dict[str, Any]) -> None:
+        self._jobs[job["job_id"]] = job
+        # Shutdown path: a full queue would only mean this process drops the job with the rest of its memory
+        try:
+            self._get_queue().put_nowait(job["job_id"])
+        except asyncio.QueueFull:
+            logger.warning(f"Job queue full, job {job['job_id']} cannot be requeued")
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._jobs.get(job_id)
+
+
+class SQLiteJobBackend(JobBackend):
+    """
+    SQLite-backed queue so jobs survive restarts and can be processed by any
+    worker process sharing the database file. Payloads are dropped once a
+    job finishes.
+
+    A claimed job is leased to its worker for lease_seconds and the worker
+    renews the lease while it runs. Another worker only takes a running job
+    over once its lease has run out, i.e. its owner is gone.
+    """
+    def __init__(self, path: str, poll_interval: float = 0.5, lease_seconds: float = 60.0,
+                 max_queued: int = 64):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_queued = max_queued
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, state TEXT NOT NULL, "
+            "payload BLOB, created_at REAL NOT NULL, owner TEXT, lease_until REAL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                # Databases from before leases; their running rows have no lease and are taken over
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+
+    def enqueue(self, job: Dict[str, Any], payload: bytes) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+                if queued >= self.max_queued:
+                    raise JobQueueFullError(f"{queued} jobs are already waiting")
+                self._conn.execute(
+                    "INSERT INTO jobs (job_id, status, state, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (job["job_id"], job["status"], json.dumps(job), sqlite3.Binary(payload), job["created_at"])
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _try_claim(self) -> Optional[Tuple[str, bytes]]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Queued jobs, or running ones whose owner stopped renewing its lease
+                row = self._conn.execute(
+                    "SELECT job_id, payload, status FROM jobs WHERE status = ? "
+                    "OR (status = ? AND payload IS NOT NULL AND (lease_until IS NULL OR lease_until < ?)) "
+                    "ORDER BY created_at LIMIT 1", (QUEUED, RUNNING, now)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, owner = ?, lease_until = ? WHERE job_id = ?",
+                        (RUNNING, self.owner, now + self.lease_seconds, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        if row[2] == RUNNING:
+            logger.warning(f"Taking over job {row[0]}; its worker stopped renewing the lease")
+        return row[0], bytes(row[1])
+
+    async def claim(self) -> Tuple[str, bytes]:
+        loop = asyncio.get_running_loop()
+        while True:
+            claimed = await loop.run_in_executor(None, self._try_claim)
+            if claimed is not None:
+                return claimed
+            await asyncio.sleep(self.poll_interval)
+
+    def renew(self, job_id: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND owner = ? AND status = ?",
+                (time.time() + self.lease_seconds, job_id, self.owner, RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def save(self, job: Dict[str, Any]) -> None:
+        # Only the lease holder writes, so a worker that lost its lease cannot overwrite the new owner's state
+        with self._lock:
+            if job["status"] in FINISHED_STATES:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = ?, state = ?, payload = NULL, lease_until = NULL "
+                    "WHERE job_id = ? AND owner = ?",
+                    (job["status"], json.dumps(job), job["job_id"], self.owner)
+                )
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = ?, state = ? WHERE job_id = ? AND owner = ?",
+                    (job["status"], json.dumps(job), job["job_id"], self.owner)
+                )
+        if cursor.rowcount != 1:
+            logger.warning(f"Not saving job {job['job_id']}: this worker no longer holds it")
+
+    def requeue(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, state = ?, owner = NULL, lease_until = NULL "
+                "WHERE job_id = ? AND owner = ?",
+                (QUEUED, json.dumps(job), job["job_id"], self.owner)
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class _JobEvents:
+    """Event log of a job running in this process, with a wakeup for subscribers"""
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.changed = asyncio.Event()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self.events.append(event)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class JobManager:
+    """
+    Runs document analysis jobs on a pool of asyncio workers.
+
+    Clients submit a PDF and get a job id back straight away, then poll the
+    job or subscribe to its events. Events report pages extracted and
+    chunks analyzed. Each chunk's risks, rights and responsibilities are
+    published as soon as that chunk finishes.
+
+    Events are published at once, but the job's stored state is written at
+    most every save_interval seconds (and on every status change), off the
+    event loop, since each write carries the whole partial result.
+    """
+    def __init__(self, processor, backend: Optional[JobBackend] = None, workers: Optional[int] = None,
+                 save_interval: Optional[float] = None):
+        if backend is None:
+            max_queued = int(os.getenv("JOB_MAX_QUEUED", "64"))
+            if os.getenv("JOB_BACKEND", "memory") == "sqlite":
+                backend = SQLiteJobBackend(
+                    os.getenv("JOB_DB_PATH", os.path.join("cache", "jobs.sqlite3")),
+                    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", "60")),
+                    max_queued=max_queued
+                )
+            else:
+                backend = InMemoryJobBackend(max_jobs=int(os.getenv("JOB_MAX_RETAINED", "1000")),
+                                             max_queued=max_queued)
+        self.processor = processor
+        self.backend = backend
+        self.workers = workers or int(os.getenv("JOB_WORKERS", "2"))
+        self.save_interval = save_interval if save_interval is not None else float(os.getenv("JOB_SAVE_INTERVAL", "1.0"))
+        self._tasks: List[asyncio.Task] = []
+        self._events: Dict[str, _JobEvents] = {}
+        # Per job: the last save (saves of one job run in order), when it was taken, and a pending deferred save
+        self._saves: Dict[str, asyncio.Future] = {}
+        self._saved_at: Dict[str, float] = {}
+        self._deferred: Dict[str, asyncio.TimerHandle] = {}
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker(i)) for i in range(self.workers)]
+            logger.info(f"Job manager started with {self.workers} workers")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.gather(*self._saves.values(), return_exceptions=True)
+        self.backend.close()
+
+    def submit(self, content: bytes, filename: str, category: str, tenant_id: str,
+               engine: str = "model") -> Dict[str, Any]:
+        job = new_job(filename, category, tenant_id, engine)
+        self.backend.enqueue(job, content)
+        logger.info(f"Queued analysis job {job['job_id']} for {filename}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.backend.get(job_id)
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            try:
+                job_id, payload = await self.backend.claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker {number} failed to claim a job: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            await self._run(job_id, payload)
+
+    def _update(self, job: Dict[str, Any], event_type: str, data: Optional[Dict[str, Any]] = None,
+                force: bool = False) -> None:
+        job["updated_at"] = time.time()
+        self._persist(job, force)
+        events = self._events.get(job["job_id"])
+        if events is not None:
+            events.publish({
+                "event": event_type,
+                "status": job["status"],
+                "progress": dict(job["progress"]),
+                **(data or {})
+            })
+
+    def _persist(self, job: Dict[str, Any], force: bool) -> None:
+        """Save job now if forced or save_interval has passed, otherwise once it has"""
+        job_id = job["job_id"]
+        wait = 0.0 if force else self._saved_at.get(job_id, 0.0) + self.save_interval - time.monotonic()
+        if wait > 0:
+            if job_id not in self._deferred:
+                loop = asyncio.get_running_loop()
+                self._deferred[job_id] = loop.call_later(wait, self._persist, job, True)
+            return
+        deferred = self._deferred.pop(job_id, None)
+        if deferred is not None:
+            deferred.cancel()
+        self._saved_at[job_id] = time.monotonic()
+        # Copy what changes while the job runs, so the write thread sees a consistent state
+        snapshot = dict(job, progress=dict(job["progress"]),
+                        partial={key: list(values) for key, values in job["partial"].items()})
+        self._saves[job_id] = asyncio.ensure_future(self._save(snapshot, self._saves.get(job_id)))
+
+    async def _save(self, snapshot: Dict[str, Any], previous: Optional[asyncio.Future]) -> None:
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        save = self.backend.requeue if snapshot["status"] == QUEUED else self.backend.save
+        try:
+            await loop.run_in_executor(None, save, snapshot)
+        except Exception as e:
+            logger.error(f"Failed to save job {snapshot['job_id']}: {str(e)}")
+
+    async def _heartbeat(self, job_id: str) -> None:
+        interval = getattr(self.backend, "lease_seconds", 60.0) / 3
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await loop.run_in_executor(None, self.backend.renew, job_id):
+                    logger.warning(f"Lost the lease on job {job_id}; another worker may take it over")
+            except Exception as e:
+                logger.error(f"Failed to renew the lease on job {job_id}: {str(e)}")
+
+    async def _run(self, job_id: str, payload: bytes) -> None:
+        job = self.backend.get(job_id)
+        if job is None:
+            logger.error(f"Claimed unknown job {job_id}")
+            return
+        self._events.setdefault(job_id, _JobEvents())
+        # A job picked up again after a restart starts over
+        job["progress"] = empty_progress()
+        job["partial"] = {"risks": [], "rights": [], "responsibilities": []}
+        job["error"] = None
+        progress = job["progress"]
+        job["status"] = RUNNING
+        self._update(job, "started", force=True)
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id))
+
+        def on_pages(extracted: int, total: int) -> None:
+            progress["pages_extracted"] = extracted
+            progress["pages_total"] = total
+            self._update(job, "pages")
+
+        def on_chunk(index: int, total: int, result: Any) -> None:
+            progress["chunks_total"] = total
+            if isinstance(result, Exception):
+                progress["chunks_failed"] += 1
+                self._update(job, "chunk_failed", {"chunk": index, "error": str(result)})
+                return
+            progress["chunks_analyzed"] += 1
+            flags = {key: result.get(key, []) for key in ("risks", "rights", "responsibilities")}
+            for key, values in flags.items():
+                job["partial"][key].extend(values)
+            self._update(job, "chunk", {"chunk": index, "summary": result.get("summary", ""), "flags": flags})
+
+        try:
+            text = await self.processor.extract_text_cached(payload, on_progress=on_pages)
+            del payload
+            summary = await self.processor.generate_summary(
+                text, tenant_id=job["tenant_id"], on_chunk=on_chunk, engine=job.get("engine", "model"),
+                category=job["category"]
+            )
+            session = self.processor.create_session(text, tenant_id=job["tenant_id"])
+            job["result"] = {
+                "document_handle": session.handle,
+                "extracted_text": text,
+                "summary": summary["summary"],
+                "flags": {
+                    "risks": summary["risks"],
+                    "rights": summary["rights"],
+                    "responsibilities": summary["responsibilities"]
+                },
+                "flag_details": summary["flag_details"],
+                "failed_chunks": summary.get("failed_chunks", []),
+                "fallback_chunks": summary.get("fallback_chunks", []),
+                "engine": summary.get("engine", "model"),
+                "route": summary.get("route")
+            }
+            job["status"] = COMPLETED
+            self._update(job, "completed", {"result": job["result"]}, force=True)
+            logger.info(f"Job {job_id} completed")
+        except asyncio.CancelledError:
+            # Shutdown: the job keeps its payload and runs again on the next start (or another worker)
+            job["status"] = QUEUED
+            self._update(job, "requeued", force=True)
+            logger.info(f"Job {job_id} requeued on shutdown")
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            job["status"] = FAILED
+            job["error"] = str(e)
+            self._update(job, "failed", {"error": job["error"]}, force=True)
+        finally:
+            heartbeat.cancel()
+            self._saved_at.pop(job_id, None)
+            # Keep the event log briefly so late subscribers still see the ending
+            loop = asyncio.get_running_loop()
+            loop.call_later(60, self._events.pop, job_id, None)
+            loop.call_later(60, self._forget_save, job_id)
+
+    def _forget_save(self, job_id: str) -> None:
+        save = self._saves.get(job_id)
+        if save is not None and save.done():
+            del self._saves[job_id]
+
+    async def subscribe(self, job_id: str, poll_interval: float = 1.0) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield job events until the job finishes.
+        Jobs running in this process stream every event. Jobs running in
+        another process (SQLite backend) fall back to polling snapshots.
+        """
+        cursor = 0
+        last_update = None
+        while True:
+            events = self._events.get(job_id)
+            if events is not None:
+                while cursor < len(events.events):
+                    event = events.events[cursor]
+                    cursor += 1
+                    yield event
+                    if event["status"] in FINISHED_STATES:
+                        return
+                waiter = events.changed
+                try:
+                    await asyncio.wait_for(waiter.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job = self.backend.get(job_id)
+            if job is None:
+                return
+            if job["updated_at"] != last_update:
+                last_update = job["updated_at"]
+                event = {"event": "snapshot", "status": job["status"], "progress": job["progress"],
+                         "partial": job["partial"]}
+                if job["status"] == COMPLETED:
+                    event["result"] = job["result"]
+                elif job["status"] == FAILED:
+                    event["error"] = job["error"]
+                yield event
+                if job["status"] in FINISHED_STATES:
+                    return
+            await asyncio.sleep(poll_interval)
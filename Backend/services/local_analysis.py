@@ -0,0 +1,232 @@
+"""
+Deterministic clause analysis without a model call.
+
+Category lexicons are compiled, together with the sentence boundary rule,
+into one regular expression, so a single scan over the text both splits it
+into sentences and finds every clause term. Lexicon phrases are folded into
+a prefix trie before compiling, which keeps the alternation from retrying
+hundreds of branches at every position. Each sentence is scored per
+category from the weights of the terms it contains, and the best scoring
+sentences become the flags and the extractive summary.
+
+The output has the same shape as a model analysis of a chunk, so it can be
+merged, cached and streamed the same way.
+"""
+import bisect
+import logging
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .flag_merge import FLAG_CATEGORIES
+
+logger = logging.getLogger(__name__)
+
+# Bump LOCAL_ANALYSIS_VERSION whenever lexicons or scoring change so cached results are not reused
+LOCAL_ANALYSIS_VERSION = "1"
+
+# Weighted phrases per category. Strong, specific clause language weighs 3,
+# common but telling wording 2, and weak hints 1.
+LEXICONS: Dict[str, Tuple[Tuple[int, Tuple[str, ...]], ...]] = {
+    "risks": (
+        (3, ("indemnify", "indemnifies", "indemnified", "indemnification", "indemnity",
+             "liquidated damages", "forfeit", "forfeits", "forfeited", "forfeiture",
+             "non-refundable", "nonrefundable", "waive", "waives", "waived", "waiver",
+             "without notice", "without prior notice", "sole discretion", "absolute discretion",
+             "automatically renew", "automatically renews", "automatic renewal",
+             "binding arbitration", "class action", "jury trial", "unlimited liability",
+             "personal guarantee", "joint and several", "eviction", "repossession", "collections")),
+        (2, ("penalty", "penalties", "late fee", "late fees", "liable", "liability", "damages",
+             "breach", "default", "terminate", "terminated", "termination",
+             "interest charge", "interest charges", "deduct", "deducted", "deduction",
+             "at your own risk", "as is", "no warranty", "disclaims", "disclaimer",
+             "not responsible", "not liable", "limitation of liability", "increase", "increased")),
+        (1, ("risk", "risks", "loss", "losses", "fee", "fees", "charge", "charges",
+             "cost", "costs", "deposit", "withhold", "withheld"))
+    ),
+    "rights": (
+        (3, ("entitled to", "has the right to", "have the right to", "right to terminate",
+             "right to cancel", "right to a refund", "may cancel", "may terminate", "may withdraw",
+             "may request", "quiet enjoyment", "cooling-off period", "cooling off period")),
+        (2, ("right to", "rights", "refund", "refunds", "reimburse", "reimbursed", "reimbursement",
+             "option to", "may elect", "permitted to", "allowed to", "at no cost", "free of charge",
+             "privacy", "confidential")),
+        (1, ("may", "permit", "permits", "allow", "allows", "entitle"))
+    ),
+    "responsibilities": (
+        (3, ("shall pay", "must pay", "agrees to pay", "is responsible for", "are responsible for",
+             "is required to", "are required to", "obligated to", "obliged to", "shall maintain",
+             "shall provide", "shall notify", "must notify", "shall not", "must not", "may not")),
+        (2, ("agrees to", "agree to", "shall", "must", "responsible for", "required to",
+             "obligation", "obligations", "duty", "duties", "undertake", "undertakes",
+             "comply with", "in accordance with", "no later than")),
+        (1, ("require", "requires", "maintain", "ensure", "keep"))
+    )
+}
+
+# Sentence ends: terminal punctuation followed by a likely sentence start, or a blank line.
+# The lookbehinds keep common abbreviations and initials from ending a sentence.
+_SENTENCE_END = (
+    r"(?<!\be\.g)(?<!\bi\.e)(?<!\betc)(?<!\bNo)(?<!\bno)(?<!\bSec)(?<!\bArt)(?<!\bInc)(?<!\bLtd)"
+    r"(?<!\bCo)(?<!\bMr)(?<!\bMs)(?<!\bDr)(?<!\bSt)(?<!\bvs)(?<!\b[A-Z])"
+    r"[.!?]+[\"')\]]*(?=\s+[\"'(\[]?[A-Z0-9])"
+    r"|\n[ \t]*\n"
+)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _trie_pattern(phrases: Iterable[str]) -> str:
+    """
+    Regular expression matching any of phrases, built from a prefix trie.
+    Spaces inside a phrase match any run of whitespace, so phrases broken
+    across PDF lines still match.
+    """
+    trie: Dict[str, Any] = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        optional = "" in node
+        branches = []
+        for char in sorted(node):
+            if char == "":
+                continue
+            head = r"\s+" if char == " " else re.escape(char)
+            branches.append(head + build(node[char]))
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if optional:
+            # Greedy, so the longest phrase wins
+            return "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+
+class LocalAnalyzer:
+    """
+    Keyword and phrase based analysis of legal text.
+
+    top_k flags are kept per category, summary_sentences sentences make the
+    summary, and a sentence must score at least min_score in a category to
+    be flagged for it. Sentences longer than max_sentence_chars are cut.
+    """
+    def __init__(self, top_k: int = 5, summary_sentences: int = 3, min_score: Optional[int] = None,
+                 max_sentence_chars: int = 400):
+        self.top_k = top_k
+        self.summary_sentences = summary_sentences
+        self.min_score = min_score if min_score is not None else int(os.getenv("LOCAL_FLAG_MIN_SCORE", "2"))
+        self.max_sentence_chars = max_sentence_chars
+
+        self.categories = FLAG_CATEGORIES
+        self._terms: Dict[str, List[Tuple[int, int]]] = {}
+        for index, category in enumerate(self.categories):
+            for weight, phrases in LEXICONS[category]:
+                for phrase in phrases:
+                    self._terms.setdefault(phrase, []).append((index, weight))
+        self._pattern = re.compile(
+            r"(?P<end>" + _SENTENCE_END + r")"
+            r"|(?i:\b(?P<term>" + _trie_pattern(sorted(self._terms)) + r")(?![\w-]))"
+        )
+
+    def scan(self, text: str) -> Tuple[List[Tuple[int, int]], List[List[int]]]:
+        """
+        Sentence spans of text and, per sentence, its score in each category,
+        from a single pass of the combined pattern.
+        """
+        ends: List[int] = []
+        hits: List[Tuple[int, str]] = []
+        for match in self._pattern.finditer(text):
+            if match.lastgroup == "end":
+                ends.append(match.end())
+            else:
+                hits.append((match.start(), match.group("term")))
+        if not ends or ends[-1] < len(text):
+            ends.append(len(text))
+
+        spans = []
+        start = 0
+        for end in ends:
+            spans.append((start, end))
+            start = end
+
+        scores = [[0] * len(self.categories) for _ in spans]
+        for position, term in hits:
+            sentence = scores[bisect.bisect_right(ends, position)]
+            for index, weight in self._terms[_WHITESPACE_RE.sub(" ", term.lower())]:
+                sentence[index] += weight
+        return spans, scores
+
+    def score(self, text: str) -> int:
+        """Total clause weight of text; low scores mark text with little worth analyzing"""
+        _, scores = self.scan(text)
+        return sum(sum(sentence) for sentence in scores)
+
+    def _sentence(self, text: str, span: Tuple[int, int]) -> str:
+        sentence = _WHITESPACE_RE.sub(" ", text[span[0]:span[1]]).strip()
+        if len(sentence) > self.max_sentence_chars:
+            sentence = sentence[:self.max_sentence_chars].rsplit(" ", 1)[0] + " ..."
+        return sentence
+
+    @staticmethod
+    def _usable(words: int) -> bool:
+        # Headings, page numbers and run-on extraction artifacts make poor flags
+        return 4 <= words <= 120
+
+    def analyze(self, text: str) -> Dict[str, Any]:
+        """Summary and top flags per category, shaped like a model's chunk analysis"""
+        spans, scores = self.scan(text)
+        sentences = [self._sentence(text, span) for span in spans]
+        usable = [self._usable(len(sentence.split())) for sentence in sentences]
+
+        result: Dict[str, Any] = {"summary": self._summarize(sentences, scores, usable, self.summary_sentences)}
+        for index, category in enumerate(self.categories):
+            ranked = sorted(
+                (i for i, sentence_scores in enumerate(scores)
+                 if usable[i] and sentence_scores[index] >= self.min_score),
+                # Highest score first; earlier sentences win ties
+                key=lambda i: (-scores[i][index], i)
+            )
+            flags: List[str] = []
+            seen = set()
+            for i in ranked:
+                if sentences[i].lower() not in seen:
+                    seen.add(sentences[i].lower())
+                    flags.append(sentences[i])
+                if len(flags) == self.top_k:
+                    break
+            result[category] = flags
+        return result
+
+    @staticmethod
+    def _summarize(sentences: Sequence[str], scores: Sequence[Sequence[int]], usable: Sequence[bool],
+                   limit: int, max_words: Optional[int] = None) -> str:
+        """Best scoring sentences in document order; the opening sentences get a bonus"""
+        candidates = [i for i in range(len(sentences)) if usable[i]]
+        if not candidates:
+            return ""
+        salience = {i: sum(scores[i]) + max(0, 3 - rank) for rank, i in enumerate(candidates)}
+        chosen = sorted(sorted(candidates, key=lambda i: (-salience[i], i))[:limit])
+
+        words = 0
+        picked = []
+        for i in chosen:
+            count = len(sentences[i].split())
+            if max_words is not None and picked and words + count > max_words:
+                break
+            picked.append(sentences[i])
+            words += count
+        return " ".join(picked)
+
+    def summarize(self, text: str, max_words: int) -> str:
+        """Extractive summary of text in at most max_words words (the first sentence may exceed it)"""
+        spans, scores = self.scan(text)
+        sentences = [self._sentence(text, span) for span in spans]
+        usable = [bool(sentence) for sentence in sentences]
+        # As many sentences as the word budget can take
+        return self._summarize(sentences, scores, usable, len(sentences), max_words)
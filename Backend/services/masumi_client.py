@@ -1,13 +1,16 @@
 import aiohttp
+import asyncio
 import os
 from dotenv import load_dotenv
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Callable, Awaitable, List
 from logging.handlers import RotatingFileHandler
 import json
+import hashlib
 import traceback
 import time
 from datetime import datetime
+from .analysis_cache import TTLCache
 
 # Set up logging with rotation
 log_dir = "logs"
@@ -36,6 +39,54 @@ console_handler.setFormatter(
 )
 logger.addHandler(console_handler)
 
+# Upper bound on how much of any request/response body goes into the debug log
+LOG_PAYLOAD_CHARS = int(os.getenv("MASUMI_LOG_PAYLOAD_CHARS", "1024"))
+LOG_FIELD_CHARS = 128
+
+# Status codes the API may use to ask for the full text after a hash-only request
+CONTENT_REQUIRED_STATUSES = (409, 428)
+
+def _truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...({len(text)} chars)"
+
+def bounded_json(value: Any, limit: int = LOG_PAYLOAD_CHARS) -> str:
+    """Compact JSON for logging, with long string fields and the total length capped"""
+    if isinstance(value, dict):
+        value = {
+            k: _truncate(v, LOG_FIELD_CHARS) if isinstance(v, str) else v
+            for k, v in value.items()
+        }
+    try:
+        text = json.dumps(value, separators=(",", ":"), default=str)
+    except (TypeError, ValueError):
+        text = repr(value)
+    return _truncate(text, limit)
+
+def document_fingerprint(document_text: str, block_size: int = 64 * 1024) -> Dict[str, Any]:
+    """
+    Compact fingerprint of a document: a Merkle root over SHA-256 hashes of
+    fixed-size blocks of its UTF-8 bytes. Lets the remote compare content
+    without receiving it, and pinpoint changed blocks if it keeps the tree.
+    """
+    data = document_text.encode()
+    level = [
+        hashlib.sha256(data[i:i + block_size]).digest()
+        for i in range(0, len(data), block_size)
+    ] or [hashlib.sha256(b"").digest()]
+    leaves = len(level)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+    return {
+        "merkle_root": level[0].hex(),
+        "block_size": block_size,
+        "blocks": leaves,
+        "length": len(data)
+    }
+
 class MasumiClientError(Exception):
     """Custom exception for Masumi client errors"""
     def __init__(self, message: str, error_code: str = None, status_code: int = None, details: Dict = None):
@@ -53,6 +104,21 @@ class MasumiClient:
         self.network = os.getenv("MASUMI_NETWORK", "preprod")
         self.timeout = aiohttp.ClientTimeout(total=30)  # 30 seconds timeout
         
+        # Connection pool settings for the shared session
+        self.pool_limit = int(os.getenv("MASUMI_POOL_LIMIT", "100"))
+        self.pool_limit_per_host = int(os.getenv("MASUMI_POOL_LIMIT_PER_HOST", "20"))
+        self.keepalive_timeout = float(os.getenv("MASUMI_KEEPALIVE_TIMEOUT", "30"))
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        
+        # Recent verification results, shared by single and batch lookups
+        self.verify_cache = TTLCache(
+            "masumi-verify",
+            max_entries=int(os.getenv("MASUMI_VERIFY_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("MASUMI_VERIFY_CACHE_TTL", "300"))
+        )
+        self.batch_concurrency = int(os.getenv("MASUMI_BATCH_CONCURRENCY", "16"))
+        
         if not self.api_token:
             raise MasumiClientError(
                 message="MASUMI_TOKEN environment variable is required",
@@ -62,6 +128,52 @@ class MasumiClient:
         
         logger.info(f"Masumi client initialized with API URL: {self.api_url}, network: {self.network}")
     
+    async def start(self) -> None:
+        """Open the pooled HTTP session (called on app startup)"""
+        await self._get_session()
+
+    async def close(self) -> None:
+        """Close the pooled HTTP session (called on app shutdown)"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("Masumi client session closed")
+        self._session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the long-lived session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(timeout=self.timeout, connector=connector)
+            logger.info(
+                f"Masumi client session opened (limit: {self.pool_limit}, per host: {self.pool_limit_per_host})"
+            )
+        return self._session
+
+    async def _single_flight(self, key: str, func: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Coalesce concurrent calls with the same key into one request.
+        Callers share the result; one caller being cancelled doesn't cancel the request for the others.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+
+            def _done(t: asyncio.Task) -> None:
+                self._inflight.pop(key, None)
+                if not t.cancelled():
+                    t.exception()  # Mark as retrieved even if every caller went away
+
+            task.add_done_callback(_done)
+        else:
+            logger.debug(f"Joining in-flight request: {key}")
+        return await asyncio.shield(task)
+
     def _get_headers(self) -> Dict[str, str]:
         """Get common headers for API requests"""
         return {
@@ -79,46 +191,50 @@ class MasumiClient:
         
         try:
             logger.info(f"Making {method} request to {url}")
-            logger.debug(f"Request headers: {json.dumps(headers, indent=2)}")
-            logger.debug(f"Request payload: {json.dumps(payload, indent=2)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Request headers: {bounded_json({**headers, 'Authorization': 'Bearer ***'})}")
+                logger.debug(f"Request payload: {bounded_json(payload)}")
             
-            async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                async with session.request(method, url, headers=headers, json=payload) as response:
-                    response_time = time.time() - start_time
-                    logger.info(f"Response received in {response_time:.2f} seconds")
+            session = await self._get_session()
+            async with session.request(method, url, headers=headers, json=payload) as response:
+                response_time = time.time() - start_time
+                logger.info(f"Response received in {response_time:.2f} seconds")
+                
+                response_text = await response.text()
+                logger.debug(f"Response status: {response.status}")
+                logger.debug(f"Response text: {_truncate(response_text, LOG_PAYLOAD_CHARS)}")
+                
+                if response.status != 200:
+                    raise MasumiClientError(
+                        message=f"API error response (status {response.status})",
+                        error_code="API_ERROR",
+                        status_code=response.status,
+                        details={
+                            "response": _truncate(response_text, LOG_PAYLOAD_CHARS),
+                            "request_url": url,
+                            "response_time": response_time
+                        }
+                    )
+                
+                try:
+                    result = await response.json()
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Parsed response: {bounded_json(result)}")
+                    return result
+                except json.JSONDecodeError as e:
+                    raise MasumiClientError(
+                        message="Failed to parse API response",
+                        error_code="RESPONSE_PARSE_ERROR",
+                        status_code=response.status,
+                        details={
+                            "error": str(e),
+                            "response": _truncate(response_text, LOG_PAYLOAD_CHARS),
+                            "response_time": response_time
+                        }
+                    )
                     
-                    response_text = await response.text()
-                    logger.debug(f"Response status: {response.status}")
-                    logger.debug(f"Response text: {response_text}")
-                    
-                    if response.status != 200:
-                        raise MasumiClientError(
-                            message=f"API error response (status {response.status})",
-                            error_code="API_ERROR",
-                            status_code=response.status,
-                            details={
-                                "response": response_text,
-                                "request_url": url,
-                                "response_time": response_time
-                            }
-                        )
-                    
-                    try:
-                        result = await response.json()
-                        logger.debug(f"Parsed response: {json.dumps(result, indent=2)}")
-                        return result
-                    except json.JSONDecodeError as e:
-                        raise MasumiClientError(
-                            message="Failed to parse API response",
-                            error_code="RESPONSE_PARSE_ERROR",
-                            status_code=response.status,
-                            details={
-                                "error": str(e),
-                                "response": response_text,
-                                "response_time": response_time
-                            }
-                        )
-                        
+        except MasumiClientError:
+            raise
         except aiohttp.ClientError as e:
             raise MasumiClientError(
                 message=f"Network error: {str(e)}",
@@ -152,19 +268,37 @@ class MasumiClient:
                 }
             )
         
-        payload = {
-            "document_hash": document_hash,
-            "document_text": document_text,
-            "network": self.network
-        }
+        return await self._hash_first_request(
+            "register", document_hash, document_text, {"network": self.network}
+        )
+
+    async def _hash_first_request(self, endpoint: str, document_hash: str, document_text: Optional[str],
+                                  extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Send only the hash and fingerprint first; upload the full text only if the
+        API answers that it needs it (content_required, or status 409/428)
+        """
+        payload = {"document_hash": document_hash, **(extra or {})}
+        if document_text:
+            payload["fingerprint"] = document_fingerprint(document_text)
         
-        return await self._make_request("POST", "register", payload)
+        try:
+            result = await self._make_request("POST", endpoint, payload)
+            if not (document_text and isinstance(result, dict) and result.get("content_required")):
+                return result
+        except MasumiClientError as e:
+            if not (document_text and e.status_code in CONTENT_REQUIRED_STATUSES):
+                raise
+        
+        logger.info(f"Masumi requested document content for {document_hash}, uploading {len(document_text)} characters")
+        payload["document_text"] = document_text
+        return await self._make_request("POST", endpoint, payload)
 
-    async def verify_document(self, document_hash: str, document_text: str) -> Dict[str, Any]:
+    async def verify_document(self, document_hash: str, document_text: Optional[str] = None) -> Dict[str, Any]:
         """Verify a document using the Masumi API"""
-        if not document_hash or not document_text:
+        if not document_hash:
             raise MasumiClientError(
-                message="Document hash and text are required",
+                message="Document hash is required",
                 error_code="INVALID_INPUT",
                 details={
                     "has_hash": bool(document_hash),
@@ -172,12 +306,53 @@ class MasumiClient:
                 }
             )
         
-        payload = {
-            "document_hash": document_hash,
-            "document_text": document_text
-        }
+        cached = self.verify_cache.get(document_hash)
+        if cached is not None:
+            logger.debug(f"Verification served from cache: {document_hash}")
+            return cached
+        
+        async def _verify() -> Dict[str, Any]:
+            result = await self._hash_first_request("verify", document_hash, document_text)
+            # A hash-only call can get "content_required"; callers that have the text must not be served it
+            if not (isinstance(result, dict) and result.get("content_required")):
+                self.verify_cache.set(document_hash, result)
+            return result
+        
+        # A burst of trust checks for one document shares a single request; callers with
+        # the text never join a text-less flight, whose content would not be uploaded
+        return await self._single_flight(f"verify:{document_hash}:{bool(document_text)}", _verify)
+
+    async def verify_documents(self, document_hashes: List[str],
+                               max_concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Verify many documents by hash.
+        Repeated hashes are verified once, requests fan out with bounded concurrency,
+        and a failure for one hash is reported in its item instead of failing the batch.
+        Returns one item per unique hash, in first-seen order.
+        """
+        unique_hashes = list(dict.fromkeys(document_hashes))
+        semaphore = asyncio.Semaphore(max_concurrency or self.batch_concurrency)
+        start_time = time.time()
+        
+        async def _verify_one(document_hash: str) -> Dict[str, Any]:
+            try:
+                async with semaphore:
+                    result = await self.verify_document(document_hash)
+                return {"document_hash": document_hash, "result": result, "error": None}
+            except MasumiClientError as e:
+                return {
+                    "document_hash": document_hash,
+                    "result": None,
+                    "error": {"error_code": e.error_code, "message": str(e), "status_code": e.status_code}
+                }
         
-        return await self._make_request("POST", "verify", payload)
+        items = await asyncio.gather(*(_verify_one(h) for h in unique_hashes))
+        failed = sum(1 for item in items if item["error"])
+        logger.info(
+            f"Batch verified {len(unique_hashes)} documents ({len(document_hashes)} requested, "
+            f"{failed} failed) in {time.time() - start_time:.2f} seconds"
+        )
+        return items
 
     async def get_trust_score(self, document_hash: str, document_text: str) -> float:
         """Get trust score for a document"""
@@ -0,0 +1,194 @@
+"""
+Reserve/commit/refund token metering on the shared state store.
+
+Tokens leave the balance when they are reserved, before any model work,
+through an atomic conditional update in the store, so concurrent requests in
+any worker can never spend the same tokens twice or take a balance below
+zero. A reservation is then committed, which records the usage, or refunded,
+which puts the tokens back. Open reservations are kept in the store and
+whichever of commit, refund or expiry deletes the record settles it, so each
+reservation is settled exactly once. The debit and the record are written in
+one store transaction, as are the deletion and the settlement, so a failure
+between them cannot lose tokens or settle a reservation twice.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional
+
+from .state_store import StateStore, get_state_store
+
+logger = logging.getLogger(__name__)
+
+RESERVATIONS = "token_reservation"
+
+
+class MeteringError(Exception):
+    """Raised when tokens cannot be reserved"""
+    def __init__(self, message: str, error_code: str = None, details: Dict = None):
+        super().__init__(message)
+        self.error_code = error_code
+        self.details = details or {}
+        self.timestamp = time.time()
+
+
+class Account(ABC):
+    """Where one kind of balance is kept"""
+
+    @abstractmethod
+    def debit(self, store: StateStore, key: str, amount: int) -> None:
+        """Atomically take amount from the balance, or raise MeteringError and take nothing"""
+
+    @abstractmethod
+    def credit(self, store: StateStore, key: str, amount: int) -> None:
+        """Return amount taken by debit"""
+
+    def settle(self, store: StateStore, key: str, amount: int) -> None:
+        """Record that amount was spent for good"""
+
+
+class CounterAccount(Account):
+    """
+    A balance kept in a store counter, with an optional counter of tokens used.
+    With initial_balance set, unknown keys start with that balance.
+    """
+    def __init__(self, balance_namespace: str, used_namespace: Optional[str] = None,
+                 initial_balance: Optional[int] = None):
+        self.balance_namespace = balance_namespace
+        self.used_namespace = used_namespace
+        self.initial_balance = initial_balance
+
+    def debit(self, store: StateStore, key: str, amount: int) -> None:
+        if self.initial_balance is not None:
+            store.init_counter(self.balance_namespace, key, self.initial_balance)
+        if store.try_decrement(self.balance_namespace, key, amount) is not None:
+            return
+        balance = store.get_counter(self.balance_namespace, key)
+        if balance is None:
+            raise MeteringError(f"No token balance for {key}", "account_not_found")
+        raise MeteringError("Insufficient token balance", "insufficient_balance",
+                            {"balance": balance, "requested": amount})
+
+    def credit(self, store: StateStore, key: str, amount: int) -> None:
+        store.add(self.balance_namespace, key, amount)
+
+    def settle(self, store: StateStore, key: str, amount: int) -> None:
+        if self.used_namespace is not None:
+            store.add(self.used_namespace, key, amount)
+
+
+class Reservation(NamedTuple):
+    """Tokens taken from an account and not yet committed or refunded"""
+    reservation_id: str
+    account: str
+    key: str
+    amount: int
+    created_at: float
+
+
+class TokenMeter:
+    """
+    Meters token spending for every registered account.
+
+    Reservations older than reservation_ttl seconds are assumed to belong to
+    a request that died mid-flight and are refunded by expire().
+    """
+    def __init__(self, store: Optional[StateStore] = None, reservation_ttl: Optional[float] = None):
+        self.store = store or get_state_store()
+        self.reservation_ttl = reservation_ttl or float(os.getenv("TOKEN_RESERVATION_TTL", "900"))
+        self.accounts: Dict[str, Account] = {}
+        self._counts = {"reserved": 0, "committed": 0, "refunded": 0, "rejected": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, account: Account) -> None:
+        self.accounts[name] = account
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def reserve(self, account: str, key: str, amount: int) -> Reservation:
+        """Take amount tokens from key's balance in account, raising MeteringError if it cannot"""
+        if amount <= 0:
+            raise MeteringError("Token amount must be positive", "invalid_amount", {"requested": amount})
+        reservation = Reservation(str(uuid.uuid4()), account, key, amount, time.time())
+        try:
+            with self.store.transaction():
+                self.accounts[account].debit(self.store, key, amount)
+                self.store.put(RESERVATIONS, reservation.reservation_id, reservation._asdict())
+        except MeteringError:
+            self._count("rejected")
+            raise
+        self._count("reserved")
+        return reservation
+
+    def commit(self, reservation: Reservation) -> bool:
+        """Keep the reserved tokens; False when the reservation was already settled"""
+        with self.store.transaction():
+            if not self.store.delete(RESERVATIONS, reservation.reservation_id):
+                return False
+            self.accounts[reservation.account].settle(self.store, reservation.key, reservation.amount)
+        self._count("committed")
+        return True
+
+    def refund(self, reservation: Reservation) -> bool:
+        """Return the reserved tokens; False when the reservation was already settled"""
+        with self.store.transaction():
+            if not self.store.delete(RESERVATIONS, reservation.reservation_id):
+                return False
+            self.accounts[reservation.account].credit(self.store, reservation.key, reservation.amount)
+        self._count("refunded")
+        return True
+
+    def charge(self, account: str, key: str, amount: int) -> Reservation:
+        """Reserve and commit at once, for spending with no work that can fail"""
+        reservation = self.reserve(account, key, amount)
+        self.commit(reservation)
+        return reservation
+
+    @asynccontextmanager
+    async def hold(self, account: str, key: str, amount: int) -> AsyncIterator[Reservation]:
+        """Reserve for the block; commit when it completes, refund when it raises or is cancelled"""
+        reservation = self.reserve(account, key, amount)
+        try:
+            yield reservation
+        except BaseException:
+            self.refund(reservation)
+            raise
+        self.commit(reservation)
+
+    def expire(self, max_age: Optional[float] = None) -> int:
+        """Refund reservations older than max_age seconds (reservation_ttl by default)"""
+        cutoff = time.time() - (max_age if max_age is not None else self.reservation_ttl)
+        expired = 0
+        for _, record in self.store.items(RESERVATIONS):
+            reservation = Reservation(**record)
+            if reservation.created_at > cutoff or reservation.account not in self.accounts:
+                continue
+            if self.refund(reservation):
+                expired += 1
+                self._count("expired")
+        if expired:
+            logger.warning(f"Refunded {expired} token reservations that were never settled")
+        return expired
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._counts, accounts=sorted(self.accounts))
+
+
+_meter: Optional[TokenMeter] = None
+_meter_lock = threading.Lock()
+
+
+def get_token_meter() -> TokenMeter:
+    """The process-wide meter, created on first use"""
+    global _meter
+    with _meter_lock:
+        if _meter is None:
+            _meter = TokenMeter()
+        return _meter
@@ -1,28 +1,50 @@
-from typing import Dict
+from typing import Optional
 from Backend.models.document import TokenBalance, UserTier
+from Backend.services.state_store import StateStore, get_state_store
+from Backend.services.metering import CounterAccount, MeteringError, Reservation, TokenMeter, get_token_meter
+from Backend.services.usage_ledger import UsageLedger, get_usage_ledger, usage_entry
+
+# Meter account holding the pro users' token balances
+PRO_TOKENS = "pro_tokens"
 
 class MonetizationService:
-    def __init__(self):
-        # In-memory storage for token balances
-        # In a real implementation, this would be in a database
-        self.token_balances: Dict[str, TokenBalance] = {}
+    def __init__(self, store: Optional[StateStore] = None, meter: Optional[TokenMeter] = None,
+                 ledger: Optional[UsageLedger] = None):
+        # Balances live in the shared state store so every worker sees the same numbers
+        self.store = store or get_state_store()
         self.initial_tokens = 10  # Starting token balance for pro users
+        self.meter = meter or (get_token_meter() if store is None else TokenMeter(self.store))
+        self.ledger = ledger or get_usage_ledger()
+        self.meter.register(PRO_TOKENS, CounterAccount("tokens_remaining", "tokens_used", self.initial_tokens))
 
     def get_token_balance(self, user_id: str) -> TokenBalance:
-        if user_id not in self.token_balances:
-            self.token_balances[user_id] = TokenBalance(
-                tokens_used=0,
-                tokens_remaining=self.initial_tokens
-            )
-        return self.token_balances[user_id]
-
-    def use_tokens(self, user_id: str, amount: int) -> bool:
-        balance = self.get_token_balance(user_id)
-        if balance.tokens_remaining >= amount:
-            balance.tokens_used += amount
-            balance.tokens_remaining -= amount
-            return True
-        return False
+        self.store.init_counter("tokens_remaining", user_id, self.initial_tokens)
+        return TokenBalance(
+            tokens_used=self.store.get_counter("tokens_used", user_id) or 0,
+            tokens_remaining=self.store.get_counter("tokens_remaining", user_id)
+        )
+
+    def reserve_tokens(self, user_id: str, amount: int) -> Optional[Reservation]:
+        """Set amount tokens aside before the work; None when the balance is too low"""
+        try:
+            return self.meter.reserve(PRO_TOKENS, user_id, amount)
+        except MeteringError:
+            return None
+
+    def commit_tokens(self, reservation: Reservation, feature: str) -> None:
+        if self.meter.commit(reservation):
+            self.ledger.record(usage_entry(reservation, feature))
+
+    def refund_tokens(self, reservation: Reservation) -> None:
+        self.meter.refund(reservation)
+
+    def use_tokens(self, user_id: str, amount: int, feature: str = "general") -> bool:
+        try:
+            reservation = self.meter.charge(PRO_TOKENS, user_id, amount)
+        except MeteringError:
+            return False
+        self.ledger.record(usage_entry(reservation, feature))
+        return True
 
     def can_access_feature(self, user_tier: UserTier, feature: str) -> bool:
         if user_tier == UserTier.PRO:
@@ -0,0 +1,165 @@
+"""
+Page-level PDF text extraction engines.
+
+Functions here run inside extraction worker processes, so they only take
+and return plain picklable values and must stay free of service state.
+An extraction source is raw PDF bytes, a path to a PDF file, or a
+SharedPDF naming a shared memory block that holds the bytes.
+"""
+import io
+import logging
+import mmap
+import os
+from abc import ABC, abstractmethod
+from multiprocessing import shared_memory
+from typing import Dict, List, NamedTuple, Optional, Tuple, Type, Union
+
+import fitz
+import PyPDF2
+
+logger = logging.getLogger(__name__)
+
+PDFSource = Union[bytes, bytearray, memoryview, str]
+PageTexts = List[Optional[str]]
+
+
+class SharedPDF(NamedTuple):
+    """PDF bytes in a shared memory block, passed to workers by name"""
+    name: str
+    size: int
+
+
+class PDFParseError(Exception):
+    """Raised when an engine cannot parse a document at all"""
+
+
+class PDFExtractionEngine(ABC):
+    """Extracts the text of a range of pages from a PDF source"""
+    name = "base"
+
+    @abstractmethod
+    def read_pages(self, source: PDFSource, start: int = 0, end: Optional[int] = None) -> Tuple[int, PageTexts]:
+        """
+        Extract text for pages [start, end).
+        Returns (total_pages, texts); a page that fails to extract yields None.
+        """
+
+
+class PyMuPDFEngine(PDFExtractionEngine):
+    """MuPDF-based extraction, much faster than PyPDF2 on most documents"""
+    name = "pymupdf"
+
+    def read_pages(self, source: PDFSource, start: int = 0, end: Optional[int] = None) -> Tuple[int, PageTexts]:
+        try:
+            if isinstance(source, str):
+                doc = fitz.open(source)
+            else:
+                doc = fitz.open(stream=source, filetype="pdf")
+        except Exception as e:
+            raise PDFParseError(f"PyMuPDF could not open document: {str(e)}") from e
+
+        with doc:
+            total_pages = doc.page_count
+            end = total_pages if end is None else min(end, total_pages)
+            texts: PageTexts = []
+            for i in range(start, end):
+                try:
+                    texts.append(doc.load_page(i).get_text())
+                except Exception as page_error:
+                    logger.error(f"Failed to extract text from page {i + 1}: {str(page_error)}")
+                    texts.append(None)
+        return total_pages, texts
+
+
+class PyPDF2Engine(PDFExtractionEngine):
+    """Pure-Python extraction; slower, but parses some files MuPDF rejects"""
+    name = "pypdf2"
+
+    def read_pages(self, source: PDFSource, start: int = 0, end: Optional[int] = None) -> Tuple[int, PageTexts]:
+        if isinstance(source, str):
+            with open(source, "rb") as file:
+                # Map the file instead of reading it into memory
+                try:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError as e:
+                    raise PDFParseError(f"PyPDF2 could not open document: {str(e)}") from e
+                with mapped:
+                    return self._read_stream(mapped, start, end)
+        return self._read_stream(io.BytesIO(source), start, end)
+
+    def _read_stream(self, stream, start: int, end: Optional[int]) -> Tuple[int, PageTexts]:
+        try:
+            reader = PyPDF2.PdfReader(stream)
+            total_pages = len(reader.pages)
+        except Exception as e:
+            raise PDFParseError(f"PyPDF2 could not open document: {str(e)}") from e
+
+        end = total_pages if end is None else min(end, total_pages)
+        texts: PageTexts = []
+        for i in range(start, end):
+            try:
+                texts.append(reader.pages[i].extract_text())
+            except Exception as page_error:
+                logger.error(f"Failed to extract text from page {i + 1}: {str(page_error)}")
+                texts.append(None)
+        return total_pages, texts
+
+
+class FallbackEngine(PDFExtractionEngine):
+    """Tries engines in order, moving on when one cannot parse the document"""
+    def __init__(self, *engines: PDFExtractionEngine):
+        self.engines = engines
+        self.name = "+".join(engine.name for engine in engines)
+
+    def read_pages(self, source: PDFSource, start: int = 0, end: Optional[int] = None) -> Tuple[int, PageTexts]:
+        last_error: Optional[Exception] = None
+        for engine in self.engines:
+            try:
+                return engine.read_pages(source, start, end)
+            except PDFParseError as e:
+                logger.warning(f"{engine.name} failed to parse PDF, trying next engine: {str(e)}")
+                last_error = e
+        raise last_error
+
+
+ENGINES: Dict[str, Type[PDFExtractionEngine]] = {
+    PyMuPDFEngine.name: PyMuPDFEngine,
+    PyPDF2Engine.name: PyPDF2Engine,
+}
+
+
+def get_engine(name: Optional[str] = None) -> PDFExtractionEngine:
+    """
+    Build the engine named by name or PDF_ENGINE.
+    "auto" (the default) uses PyMuPDF and falls back to PyPDF2 on parse failure.
+    """
+    name = (name or os.getenv("PDF_ENGINE", "auto")).lower()
+    if name == "auto":
+        return FallbackEngine(PyMuPDFEngine(), PyPDF2Engine())
+    if name not in ENGINES:
+        raise ValueError(f"Unknown PDF engine: {name}")
+    return ENGINES[name]()
+
+
+def extract_page_range(data: Union[PDFSource, SharedPDF], start: int = 0, end: Optional[int] = None,
+                       engine: Optional[str] = None) -> Tuple[int, PageTexts]:
+    """Process pool entry point: extract a page range with the named engine"""
+    if not isinstance(data, SharedPDF):
+        return get_engine(engine).read_pages(data, start, end)
+    block = shared_memory.SharedMemory(name=data.name)
+    view = block.buf[:data.size]
+    try:
+        return get_engine(engine).read_pages(view, start, end)
+    finally:
+        try:
+            view.release()
+            block.close()
+        except BufferError:
+            # A parser still holds the view; the mapping goes when it is collected
+            logger.warning(f"Could not unmap shared PDF {data.name} after extraction")
+
+
+def join_pages(pages: PageTexts) -> str:
+    """Assemble page texts into a document, skipping pages that failed"""
+    texts = [page for page in pages if page is not None]
+    return "\n".join(texts) + "\n" if texts else ""
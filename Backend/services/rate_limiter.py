@@ -0,0 +1,381 @@
+"""
+Client-side rate limiting for OpenAI calls.
+
+Every model request in the service goes through one AdaptiveRateLimiter.
+Requests wait in per-tenant queues and are admitted round-robin across
+tenants, once both the request and the token bucket have room and the
+adaptive concurrency limit allows another call. The concurrency limit is
+halved on every 429 and grows back by one per limit's worth of successful
+calls (AIMD). Failed calls are retried with jittered exponential backoff
+for as long as the caller's deadline allows.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Tenant and deadline of the request being served, picked up by every call it makes
+_current_tenant: contextvars.ContextVar = contextvars.ContextVar("rate_limit_tenant", default="default")
+_current_deadline: contextvars.ContextVar = contextvars.ContextVar("rate_limit_deadline", default=None)
+
+# Errors worth retrying; anything else (bad request, auth) fails at once
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a call cannot be admitted or retried before its deadline"""
+
+
+def current_request() -> Tuple[str, Optional[float]]:
+    """Tenant and deadline (time.monotonic()) of the enclosing request_context"""
+    return _current_tenant.get(), _current_deadline.get()
+
+
+@contextmanager
+def request_context(tenant_id: Optional[str] = None, timeout: Optional[float] = None,
+                    deadline: Optional[float] = None) -> Iterator[None]:
+    """
+    Attribute model calls made inside the block to tenant_id and give them a
+    shared deadline timeout seconds from now, or at deadline (a
+    time.monotonic() value). An enclosing deadline that is sooner is kept.
+    """
+    tokens = []
+    if tenant_id is not None:
+        tokens.append((_current_tenant, _current_tenant.set(tenant_id)))
+    if timeout is not None:
+        deadline = time.monotonic() + timeout if deadline is None else min(deadline, time.monotonic() + timeout)
+    if deadline is not None:
+        outer = _current_deadline.get()
+        if outer is not None:
+            deadline = min(deadline, outer)
+        tokens.append((_current_deadline, _current_deadline.set(deadline)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class TokenBucket:
+    """Refills at rate units per second up to capacity; may go negative when a call overruns its estimate"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if it can be taken now)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+    def __init__(self, tokens: int, future: asyncio.Future):
+        self.tokens = tokens
+        self.future = future
+
+
+class AdaptiveRateLimiter:
+    """
+    Shared admission control for model requests.
+
+    rpm and tpm are the account's request and token limits per minute.
+    Concurrency starts at max_concurrency, is halved on each 429 down to
+    min_concurrency, and recovers additively. Tenants take turns, so a bulk
+    job with a thousand queued chunks delays an interactive request by at
+    most one admission per other waiting tenant.
+    """
+    def __init__(
+        self,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        min_concurrency: int = 1,
+        max_retries: Optional[int] = None,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0
+    ):
+        rpm = rpm or int(os.getenv("OPENAI_RPM", "500"))
+        tpm = tpm or int(os.getenv("OPENAI_TPM", "150000"))
+        self.requests = TokenBucket(rpm / 60.0, max(1, rpm // 6))
+        self.tokens = TokenBucket(tpm / 60.0, max(1, tpm // 6))
+        self.max_concurrency = max_concurrency or int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+        self.min_concurrency = min_concurrency
+        self.limit = float(self.max_concurrency)
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decrease_interval = 1.0
+        self._last_decrease = float("-inf")
+
+        self.in_flight = 0
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.throttled = 0
+        self.retries = 0
+        self.deadline_misses = 0
+
+    # Admission
+
+    async def acquire(self, tokens: int, tenant_id: str, deadline: Optional[float] = None) -> None:
+        """Wait for a turn; the caller must call release() afterwards"""
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(tokens, future)
+        self._queues.setdefault(tenant_id, deque()).append(waiter)
+        self._dispatch()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Admitted just as we gave up; hand the slot and its budget back
+                self.requests.give_back(1)
+                self.release(tokens, 0)
+            else:
+                future.cancel()
+                self._remove(tenant_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.deadline_misses += 1
+                raise DeadlineExceededError("Deadline passed while waiting for OpenAI capacity") from None
+            raise
+
+    def _remove(self, tenant_id: str, waiter: _Waiter) -> None:
+        queue = self._queues.get(tenant_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[tenant_id]
+
+    def _dispatch(self) -> None:
+        """Admit waiters round-robin across tenants while capacity lasts"""
+        while self._queues and self.in_flight < int(self.limit):
+            tenant_id, queue = next(iter(self._queues.items()))
+            waiter = queue[0]
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(waiter.tokens))
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+                return
+            queue.popleft()
+            # Move this tenant to the back of the line
+            del self._queues[tenant_id]
+            if queue:
+                self._queues[tenant_id] = queue
+            if waiter.future.done():
+                continue
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def release(self, estimated_tokens: int, used_tokens: Optional[int] = None) -> None:
+        """Free the slot and settle the token bucket with what the call really used"""
+        self.in_flight -= 1
+        if used_tokens is not None and used_tokens != estimated_tokens:
+            if used_tokens < estimated_tokens:
+                self.tokens.give_back(estimated_tokens - used_tokens)
+            else:
+                self.tokens.take(used_tokens - estimated_tokens)
+        self._dispatch()
+
+    # Adaptive concurrency
+
+    def _on_success(self) -> None:
+        self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+
+    def _on_throttle(self) -> None:
+        self.throttled += 1
+        now = time.monotonic()
+        # A burst of 429s from the same overload counts as one signal
+        if now - self._last_decrease < self.decrease_interval:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_concurrency), self.limit / 2)
+        logger.warning(f"OpenAI rate limited, concurrency limit now {int(self.limit)}")
+
+    # Calls
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, honouring Retry-After when the API sends one"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    async def call(
+        self,
+        func: Callable[[Optional[float]], Awaitable[Any]],
+        tokens: int,
+        tenant_id: Optional[str] = None,
+        deadline: Optional[float] = None
+    ) -> Any:
+        """
+        Run func(timeout) under the limiter, retrying retryable errors.
+        tokens is the estimated prompt plus completion size. timeout is the
+        time left before the deadline, for the request itself. tenant_id and
+        deadline default to the enclosing request_context.
+        """
+        tenant_id = tenant_id or _current_tenant.get()
+        if deadline is None:
+            deadline = _current_deadline.get()
+
+        attempt = 0
+        while True:
+            await self.acquire(tokens, tenant_id, deadline)
+            used = None
+            try:
+                timeout = None if deadline is None else max(0.1, deadline - time.monotonic())
+                result = await func(timeout)
+                usage = getattr(result, "usage", None)
+                used = getattr(usage, "total_tokens", None)
+                self._on_success()
+                return result
+            except RETRYABLE_ERRORS as e:
+                delay = self._retry_delay(attempt, e, deadline)
+                attempt += 1
+            finally:
+                self.release(tokens, used)
+            await asyncio.sleep(delay)
+
+    async def stream(
+        self,
+        func: Callable[[Optional[float]], Awaitable[AsyncIterator[Any]]],
+        tokens: int,
+        tenant_id: Optional[str] = None,
+        deadline: Optional[float] = None,
+        measure: Optional[Callable[[Any], Optional[int]]] = None
+    ) -> AsyncIterator[Any]:
+        """
+        Like call(), for a func that opens a stream: yields its events and
+        holds the slot until the stream is exhausted or closed. Only opening
+        the stream is retried. measure(event) gives the tokens used so far,
+        and the last value settles the token bucket.
+        """
+        tenant_id = tenant_id or _current_tenant.get()
+        if deadline is None:
+            deadline = _current_deadline.get()
+
+        attempt = 0
+        while True:
+            await self.acquire(tokens, tenant_id, deadline)
+            used = None
+            opened = False
+            try:
+                timeout = None if deadline is None else max(0.1, deadline - time.monotonic())
+                events = await func(timeout)
+                opened = True
+                self._on_success()
+                async for event in events:
+                    if measure is not None:
+                        used = measure(event) or used
+                    yield event
+                return
+            except RETRYABLE_ERRORS as e:
+                if opened:
+                    raise
+                delay = self._retry_delay(attempt, e, deadline)
+                attempt += 1
+            finally:
+                self.release(tokens, used)
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, attempt: int, error: Exception, deadline: Optional[float]) -> float:
+        """Backoff before retrying after error, or re-raise when out of retries or time"""
+        if isinstance(error, openai.RateLimitError):
+            self._on_throttle()
+        if attempt >= self.max_retries:
+            raise error
+        delay = self._backoff(attempt, error)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            self.deadline_misses += 1
+            raise DeadlineExceededError(f"No time left to retry after: {str(error)}") from error
+        self.retries += 1
+        logger.warning(f"OpenAI call failed ({type(error).__name__}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency_limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": sum(len(queue) for queue in self._queues.values()),
+            "waiting_tenants": len(self._queues),
+            "request_bucket": round(self.requests.level, 1),
+            "token_bucket": round(self.tokens.level, 1),
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "deadline_misses": self.deadline_misses
+        }
+
+
+async def chat_completion(client, limiter: AdaptiveRateLimiter, tokens: int, **kwargs) -> Any:
+    """client.chat.completions.create(**kwargs) admitted by limiter, with tokens as the estimate"""
+    async def request(timeout: Optional[float]) -> Any:
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return await client.chat.completions.create(**kwargs)
+    return await limiter.call(request, tokens)
+
+
+def stream_chat_completion(client, limiter: AdaptiveRateLimiter, prompt_tokens: int,
+                           completion_tokens: int, **kwargs) -> AsyncIterator[Any]:
+    """
+    Events of client.chat.completions.create(stream=True, **kwargs), with the
+    limiter slot held until the stream ends. Usage is taken from the stream
+    when it reports it, otherwise counted as one token per content event.
+    """
+    received = 0
+
+    def measure(event: Any) -> int:
+        nonlocal received
+        usage = getattr(event, "usage", None)
+        if usage is not None and getattr(usage, "total_tokens", None):
+            return usage.total_tokens
+        if event.choices and event.choices[0].delta.content:
+            received += 1
+        return prompt_tokens + received
+
+    async def request(timeout: Optional[float]) -> Any:
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        return await client.chat.completions.create(stream=True, **kwargs)
+
+    return limiter.stream(request, prompt_tokens + completion_tokens, measure=measure)
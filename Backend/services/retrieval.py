@@ -0,0 +1,159 @@
+import logging
+import math
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+_STOPWORDS = frozenset("""
+a an and are as at be by can do does for from has have how i if in is it its me my
+of on or our that the their them there these this those to was we what when where
+which who why will with you your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens with common stopwords removed"""
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of chunks"""
+    def __init__(self, chunks: Sequence[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs: List[Counter] = []
+        self.lengths: List[int] = []
+        doc_freqs: Counter = Counter()
+        for chunk in chunks:
+            tf = Counter(tokenize(chunk))
+            self.term_freqs.append(tf)
+            self.lengths.append(sum(tf.values()))
+            doc_freqs.update(tf.keys())
+
+        n = len(chunks)
+        self.avg_length = (sum(self.lengths) / n) if n else 0.0
+        self.idf: Dict[str, float] = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()
+        }
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Return up to k (chunk_index, score) pairs with a positive score, best first"""
+        terms = [t for t in set(tokenize(query)) if t in self.idf]
+        if not terms:
+            return []
+        scores = []
+        for i, tf in enumerate(self.term_freqs):
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / (self.avg_length or 1))
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((i, score))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:k]
+
+
+class Embedder(ABC):
+    """Pluggable source of embedding vectors for the optional dense index"""
+
+    @abstractmethod
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        pass
+
+
+class OpenAIEmbedder(Embedder):
+    """Embeddings from the OpenAI embeddings endpoint"""
+    def __init__(self, client, model: str = "text-embedding-3-small"):
+        self.client = client
+        self.model = model
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        response = await self.client.embeddings.create(model=self.model, input=texts)
+        return [item.embedding for item in response.data]
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class EmbeddingIndex:
+    """Cosine-similarity index over chunk embeddings"""
+    def __init__(self, vectors: List[List[float]]):
+        self.vectors = [_normalize(v) for v in vectors]
+
+    def search(self, query_vector: List[float], k: int) -> List[Tuple[int, float]]:
+        q = _normalize(query_vector)
+        scores = [(i, sum(a * b for a, b in zip(q, v))) for i, v in enumerate(self.vectors)]
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:k]
+
+
+class DocumentRetriever:
+    """Chunks of one document with a BM25 index and an optional embedding index"""
+    def __init__(self, chunks: List[str], embedder: Optional[Embedder] = None):
+        self.chunks = chunks
+        self.bm25 = BM25Index(chunks)
+        self.embedder = embedder
+        self.embeddings: Optional[EmbeddingIndex] = None
+
+    async def build_embeddings(self) -> None:
+        if self.embedder is not None and self.chunks and self.embeddings is None:
+            self.embeddings = EmbeddingIndex(await self.embedder.embed(self.chunks))
+
+    async def top_k(self, question: str, k: int) -> List[str]:
+        """
+        Return the k chunks most relevant to the question, most relevant first.
+        Lexical and dense rankings are merged with reciprocal rank fusion.
+        Falls back to the opening chunks when nothing matches.
+        """
+        ranked = self.bm25.search(question, k * 2)
+        if self.embeddings is not None:
+            try:
+                query_vector = (await self.embedder.embed([question]))[0]
+                dense = self.embeddings.search(query_vector, k * 2)
+                fused: Dict[int, float] = {}
+                for ranking in (ranked, dense):
+                    for rank, (index, _) in enumerate(ranking):
+                        fused[index] = fused.get(index, 0.0) + 1.0 / (60 + rank)
+                ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)
+            except Exception as e:
+                logger.error(f"Embedding search failed, using lexical ranking only: {str(e)}")
+
+        indices = [index for index, _ in ranked[:k]]
+        if not indices:
+            indices = list(range(min(k, len(self.chunks))))
+        return [self.chunks[i] for i in indices]
+
+
+class RetrievalIndexCache:
+    """LRU cache of DocumentRetriever instances keyed by document hash"""
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, DocumentRetriever]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, document_hash: str) -> Optional[DocumentRetriever]:
+        with self._lock:
+            retriever = self._entries.get(document_hash)
+            if retriever is not None:
+                self._entries.move_to_end(document_hash)
+            return retriever
+
+    def put(self, document_hash: str, retriever: DocumentRetriever) -> None:
+        with self._lock:
+            self._entries[document_hash] = retriever
+            self._entries.move_to_end(document_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
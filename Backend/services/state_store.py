@@ -0,0 +1,446 @@
+"""
+Shared state for balances, tiers, organizations and certificates.
+
+Records are JSON values and counters are integers, both addressed by
+(namespace, key). The SQLite store keeps them in one WAL-mode database
+file, so every uvicorn worker on the host sees the same balances; the
+in-memory store is for tests and single-process development.
+
+Token deduction goes through try_decrement, a single conditional UPDATE,
+so two workers can never both spend the last tokens of a balance. Calls
+made inside `with store.transaction():` on the same thread take effect
+together or, if the block raises, not at all.
+
+Every store method is a blocking call. The SQLite statements are short
+single-row reads and writes, but a writer can wait up to
+STATE_STORE_BUSY_TIMEOUT seconds (5 by default) for another process's
+lock. Callers on the event loop accept that stall for balance updates;
+anything that may touch many rows belongs in a thread.
+
+Nothing is opened at import: get_state_store() builds the configured store
+on first call, and the SQLite file is only created by its first statement.
+"""
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(ABC):
+    """Records and counters shared by all workers"""
+
+    # Records
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        pass
+
+    @abstractmethod
+    def put_if_absent(self, namespace: str, key: str, value: Any) -> bool:
+        """Store value unless key exists; True when it was stored"""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def items(self, namespace: str) -> List[Tuple[str, Any]]:
+        pass
+
+    @abstractmethod
+    def update(self, namespace: str, key: str, func: Callable[[Any], Any]) -> Optional[Any]:
+        """
+        Atomically replace a record with func(record) and return the new value.
+        Returns None when the record does not exist; an exception from func
+        leaves the record unchanged and propagates.
+        """
+
+    # Counters
+
+    @abstractmethod
+    def get_counter(self, namespace: str, key: str) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def set_counter(self, namespace: str, key: str, value: int) -> None:
+        pass
+
+    @abstractmethod
+    def init_counter(self, namespace: str, key: str, value: int) -> bool:
+        """Create the counter with value unless it exists; True when it was created"""
+
+    @abstractmethod
+    def add(self, namespace: str, key: str, delta: int) -> int:
+        """Add delta, creating the counter at 0 first if needed; returns the new value"""
+
+    @abstractmethod
+    def try_decrement(self, namespace: str, key: str, amount: int, floor: int = 0) -> Optional[int]:
+        """
+        Subtract amount only if the result stays at or above floor.
+        Returns the new value, or None when the counter is missing or too low.
+        """
+
+    @abstractmethod
+    def transaction(self) -> ContextManager[None]:
+        """
+        Make this thread's store calls within the block one atomic change,
+        undone if the block raises. Nested blocks join the outer one.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class InMemoryStateStore(StateStore):
+    """Process-local store; state is lost on restart and not shared between workers"""
+    def __init__(self):
+        self._records: Dict[Tuple[str, str], str] = {}
+        self._counters: Dict[Tuple[str, str], int] = {}
+        # Reentrant so a transaction can hold it across the calls it makes
+        self._lock = threading.RLock()
+        # Previous values of everything written in the open transaction
+        self._undo: Optional[List[Tuple[Dict, Tuple[str, str], Any]]] = None
+
+    def _write(self, table: Dict, key: Tuple[str, str], value: Any) -> None:
+        """Set (or with None, remove) an entry; called with _lock held"""
+        if self._undo is not None:
+            self._undo.append((table, key, table.get(key)))
+        if value is None:
+            table.pop(key, None)
+        else:
+            table[key] = value
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self._lock:
+            if self._undo is not None:
+                yield
+                return
+            self._undo = []
+            try:
+                yield
+            except BaseException:
+                for table, key, value in reversed(self._undo):
+                    if value is None:
+                        table.pop(key, None)
+                    else:
+                        table[key] = value
+                raise
+            finally:
+                self._undo = None
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            value = self._records.get((namespace, key))
+        # Stored as JSON so callers never share mutable state with the store
+        return json.loads(value) if value is not None else None
+
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        encoded = json.dumps(value)
+        with self._lock:
+            self._write(self._records, (namespace, key), encoded)
+
+    def put_if_absent(self, namespace: str, key: str, value: Any) -> bool:
+        encoded = json.dumps(value)
+        with self._lock:
+            if (namespace, key) in self._records:
+                return False
+            self._write(self._records, (namespace, key), encoded)
+            return True
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            if (namespace, key) not in self._records:
+                return False
+            self._write(self._records, (namespace, key), None)
+            return True
+
+    def items(self, namespace: str) -> List[Tuple[str, Any]]:
+        with self._lock:
+            rows = [(key, value) for (ns, key), value in self._records.items() if ns == namespace]
+        return [(key, json.loads(value)) for key, value in sorted(rows)]
+
+    def update(self, namespace: str, key: str, func: Callable[[Any], Any]) -> Optional[Any]:
+        with self._lock:
+            current = self._records.get((namespace, key))
+            if current is None:
+                return None
+            value = func(json.loads(current))
+            self._write(self._records, (namespace, key), json.dumps(value))
+            return value
+
+    def get_counter(self, namespace: str, key: str) -> Optional[int]:
+        with self._lock:
+            return self._counters.get((namespace, key))
+
+    def set_counter(self, namespace: str, key: str, value: int) -> None:
+        with self._lock:
+            self._write(self._counters, (namespace, key), value)
+
+    def init_counter(self, namespace: str, key: str, value: int) -> bool:
+        with self._lock:
+            if (namespace, key) in self._counters:
+                return False
+            self._write(self._counters, (namespace, key), value)
+            return True
+
+    def add(self, namespace: str, key: str, delta: int) -> int:
+        with self._lock:
+            value = self._counters.get((namespace, key), 0) + delta
+            self._write(self._counters, (namespace, key), value)
+            return value
+
+    def try_decrement(self, namespace: str, key: str, amount: int, floor: int = 0) -> Optional[int]:
+        with self._lock:
+            value = self._counters.get((namespace, key))
+            if value is None or value - amount < floor:
+                return None
+            self._write(self._counters, (namespace, key), value - amount)
+            return value - amount
+
+
+class SQLiteStateStore(StateStore):
+    """
+    SQLite-backed store, safe to share between worker processes.
+
+    Connections are pooled (pool_size per process) and every statement is a
+    fixed SQL string, so each connection's statement cache keeps them
+    prepared. Writers wait up to busy_timeout seconds for the database lock.
+    The database file is created on first use, not when the store is built.
+    """
+    # UPDATE ... RETURNING needs SQLite 3.35
+    _RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+    def __init__(self, path: str, pool_size: int = 8, busy_timeout: float = 5.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._opened = False
+        self._open_lock = threading.Lock()
+        # The connection of this thread's open transaction, used by every call inside it
+        self._local = threading.local()
+
+    def _open(self) -> None:
+        with self._open_lock:
+            if self._opened:
+                return
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            for _ in range(self.pool_size):
+                conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False,
+                                       isolation_level=None, cached_statements=64)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                self._connections.append(conn)
+            conn = self._connections[0]
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value INTEGER NOT NULL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            for conn in self._connections:
+                self._pool.put(conn)
+            self._opened = True
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        if not self._opened:
+            self._open()
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Take the write lock up front so read-modify-write cannot interleave across processes"""
+        if getattr(self._local, "conn", None) is not None:
+            yield self._local.conn
+            return
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            try:
+                yield conn
+                # Inside the try: a COMMIT that fails (SQLITE_BUSY, say) leaves the
+                # transaction open, and the connection must not go back to the pool so
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._local.conn = None
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        with self._transaction():
+            yield
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value FROM records WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO records (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, json.dumps(value))
+            )
+
+    def put_if_absent(self, namespace: str, key: str, value: Any) -> bool:
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO records (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, json.dumps(value))
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._connection() as conn:
+            cursor = conn.execute("DELETE FROM records WHERE namespace = ? AND key = ?", (namespace, key))
+            return cursor.rowcount == 1
+
+    def items(self, namespace: str) -> List[Tuple[str, Any]]:
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT key, value FROM records WHERE namespace = ? ORDER BY key", (namespace,)
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def update(self, namespace: str, key: str, func: Callable[[Any], Any]) -> Optional[Any]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT value FROM records WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            value = func(json.loads(row[0]))
+            conn.execute(
+                "UPDATE records SET value = ? WHERE namespace = ? AND key = ?",
+                (json.dumps(value), namespace, key)
+            )
+            return value
+
+    def get_counter(self, namespace: str, key: str) -> Optional[int]:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value FROM counters WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_counter(self, namespace: str, key: str, value: int) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO counters (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, value)
+            )
+
+    def init_counter(self, namespace: str, key: str, value: int) -> bool:
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO counters (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, value)
+            )
+            return cursor.rowcount == 1
+
+    def add(self, namespace: str, key: str, delta: int) -> int:
+        if self._RETURNING:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "INSERT INTO counters (namespace, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (namespace, key) DO UPDATE SET value = value + excluded.value "
+                    "RETURNING value",
+                    (namespace, key, delta)
+                ).fetchone()
+            return row[0]
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO counters (namespace, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = value + excluded.value",
+                (namespace, key, delta)
+            )
+            return conn.execute(
+                "SELECT value FROM counters WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()[0]
+
+    def try_decrement(self, namespace: str, key: str, amount: int, floor: int = 0) -> Optional[int]:
+        # The balance check and the subtraction are one statement, so no other writer can get between them
+        if self._RETURNING:
+            with self._connection() as conn:
+                row = conn.execute(
+                    "UPDATE counters SET value = value - ? "
+                    "WHERE namespace = ? AND key = ? AND value - ? >= ? RETURNING value",
+                    (amount, namespace, key, amount, floor)
+                ).fetchone()
+            return row[0] if row is not None else None
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE counters SET value = value - ? WHERE namespace = ? AND key = ? AND value - ? >= ?",
+                (amount, namespace, key, amount, floor)
+            )
+            if cursor.rowcount != 1:
+                return None
+            return conn.execute(
+                "SELECT value FROM counters WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()[0]
+
+    def close(self) -> None:
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+
+
+def create_state_store(kind: Optional[str] = None, path: Optional[str] = None) -> StateStore:
+    """Build the store named by STATE_STORE_BACKEND ("sqlite" or "memory")"""
+    kind = kind or os.getenv("STATE_STORE_BACKEND", "sqlite")
+    if kind == "memory":
+        return InMemoryStateStore()
+    if kind == "sqlite":
+        return SQLiteStateStore(
+            path or os.getenv("STATE_STORE_PATH", os.path.join("state", "state.sqlite3")),
+            pool_size=int(os.getenv("STATE_STORE_POOL_SIZE", "8")),
+            busy_timeout=float(os.getenv("STATE_STORE_BUSY_TIMEOUT", "5"))
+        )
+    raise ValueError(f"Unknown state store backend: {kind}")
+
+
+_store: Optional[StateStore] = None
+_store_lock = threading.Lock()
+
+
+def get_state_store() -> StateStore:
+    """The process-wide store, created on first use"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = create_state_store()
+            logger.info(f"Using {type(_store).__name__} for shared state")
+        return _store
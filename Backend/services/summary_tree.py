@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from .analysis_cache import AnalysisCache
+from .chunk_scheduler import ChunkScheduler
+from .rate_limiter import AdaptiveRateLimiter, chat_completion
+
+logger = logging.getLogger(__name__)
+
+# Bump SUMMARY_PROMPT_VERSION whenever the reduce prompt changes so cached nodes are not reused
+SUMMARY_PROMPT_VERSION = "1"
+
+
+class SummaryTree:
+    """
+    Map-reduce summarizer for long documents.
+
+    Chunk summaries are the leaves. Runs of fan_in / 2 to fan_in consecutive nodes
+    are condensed into one summary of at most max_words words, and the
+    results are condensed again level by level until one remains. Leaves
+    longer than max_words are condensed on their own first. Every node
+    starts as soon as its own children are done, so upper levels overlap
+    with lower ones.
+
+    Runs end at content-defined boundaries, as chunks do: each node has a
+    key hashed from its leaves, and a run ends after a node whose key is an
+    anchor. Inserting or deleting a chunk therefore only regroups the nodes
+    next to it, and since nodes are cached by the text of their children,
+    only the nodes on its path to the root are recomputed.
+    """
+    def __init__(self, client, rate_limiter: AdaptiveRateLimiter, model: str, cache: AnalysisCache,
+                 scheduler: ChunkScheduler, count_tokens: Callable[[str], int],
+                 fan_in: Optional[int] = None, max_words: Optional[int] = None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.count_tokens = count_tokens
+        self.model = model
+        self.cache = cache
+        self.scheduler = scheduler
+        self.fan_in = fan_in or int(os.getenv("SUMMARY_FAN_IN", "8"))
+        self.max_words = max_words or int(os.getenv("SUMMARY_MAX_WORDS", "250"))
+        if self.fan_in < 2:
+            raise ValueError("fan_in must be at least 2")
+
+    async def reduce(self, summaries: Sequence[str], tenant_id: str = "default") -> str:
+        """Condense chunk summaries, in document order, into a single summary"""
+        leaves = [summary.strip() for summary in summaries if summary and summary.strip()]
+        if not leaves:
+            return ""
+
+        loop = asyncio.get_running_loop()
+        tasks: List[asyncio.Task] = []
+        # (key, summary) per node of the current level
+        level: List[Tuple[str, Awaitable[str]]] = []
+        for leaf in leaves:
+            node: Awaitable[str] = loop.create_future()
+            node.set_result(leaf)
+            if len(leaf.split()) > self.max_words:
+                node = asyncio.ensure_future(self._node([node], tenant_id))
+                tasks.append(node)
+            level.append((self.cache.content_hash(leaf), node))
+
+        depth = 0
+        while len(level) > 1:
+            next_level = []
+            for first, stop in self._runs([key for key, _ in level]):
+                run = level[first:stop]
+                task = asyncio.ensure_future(self._node([node for _, node in run], tenant_id))
+                tasks.append(task)
+                next_level.append((self.cache.content_hash("".join(key for key, _ in run)), task))
+            level = next_level
+            depth += 1
+        logger.info(f"Reducing {len(leaves)} chunk summaries through {depth} levels ({len(tasks)} nodes)")
+
+        try:
+            # The model may overshoot the word limit it was given
+            return truncate_words(await level[0][1], self.max_words)
+        finally:
+            # A failed node fails the whole tree; drop the work still pending
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # Mark sibling failures as seen; the first one is already propagating
+                    task.exception()
+
+    def _runs(self, keys: List[str]) -> List[Tuple[int, int]]:
+        """
+        Split a level into runs of fan_in / 2 to fan_in nodes (the last may
+        be shorter). Past the minimum, a run ends after an anchor key, so
+        boundaries depend only on the keys around them.
+        """
+        min_size = max(2, self.fan_in // 2)
+        runs = []
+        first = 0
+        for i, key in enumerate(keys):
+            size = i + 1 - first
+            if size >= self.fan_in or (size >= min_size and int(key[:8], 16) % min_size == 0):
+                runs.append((first, i + 1))
+                first = i + 1
+        if first < len(keys):
+            runs.append((first, len(keys)))
+        return runs
+
+    async def _node(self, children: List[Awaitable[str]], tenant_id: str) -> str:
+        texts = await asyncio.gather(*children)
+        if len(texts) == 1 and len(texts[0].split()) <= self.max_words:
+            return texts[0]
+
+        cache_key = self.cache.versioned_key(self.cache.content_hash(
+            json.dumps([SUMMARY_PROMPT_VERSION, self.max_words, texts])
+        ))
+        cached = self.cache.summaries.get(cache_key)
+        if cached is not None:
+            return cached
+
+        summary = await self.scheduler.run(self._summarize, texts, tenant_id=tenant_id)
+        self.cache.summaries.set(cache_key, summary)
+        return summary
+
+    async def _summarize(self, texts: List[str]) -> str:
+        sections = "\n\n".join(f"Section {i + 1}: {text}" for i, text in enumerate(texts))
+        response = await chat_completion(
+            self.client, self.rate_limiter, self.count_tokens(sections) + self.max_words * 2,
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are an expert at analyzing legal documents and contracts. You condense summaries of consecutive sections into one summary."},
+                {"role": "user", "content": f"Combine these consecutive section summaries into a single summary of at most {self.max_words} words. Keep concrete obligations, amounts, deadlines and parties; drop repetition.\n\n{sections}"}
+            ],
+            # Roughly two tokens per word leaves room without letting the output grow
+            max_tokens=self.max_words * 2
+        )
+        return response.choices[0].message.content.strip()
+
+
+def truncate_words(text: str, max_words: int) -> str:
+    """Cut text to at most max_words words"""
+    words = text.split()
+    if len(words) <= max_words:
+        return text
+    return " ".join(words[:max_words]) + " ..."
@@ -0,0 +1,128 @@
+"""
+API-key resolution for B2B tenants.
+
+API keys are never stored or compared in plain text. Each key is reduced
+to an HMAC-SHA256 digest (keyed with TENANT_KEY_PEPPER) and the digest is
+the primary key of an index in the state store, so resolving a key is one
+indexed lookup whatever the number of organizations, and no comparison
+ever runs over secret bytes. Resolved tenant contexts are cached in
+process for a short TTL and replaced whenever this process changes the
+organization; other workers pick up changes when their entry expires.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+from .analysis_cache import TTLCache
+from .state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+ORGANIZATIONS = "organization"
+API_KEY_INDEX = "api_key_hash"
+
+
+class TenantContext(NamedTuple):
+    """Snapshot of an organization taken when its key was resolved"""
+    org_id: str
+    name: str
+    plan: str
+    monthly_limit: int
+    token_balance: int
+    usage_this_month: int
+    resolved_at: float
+
+
+class TenantRegistry:
+    """Hashed API key -> organization index with a TTL cache of tenant contexts"""
+    def __init__(self, store: StateStore, ttl: Optional[float] = None, max_entries: Optional[int] = None,
+                 pepper: Optional[str] = None):
+        self.store = store
+        self._pepper = (pepper if pepper is not None else os.getenv("TENANT_KEY_PEPPER", "")).encode()
+        ttl = ttl if ttl is not None else float(os.getenv("TENANT_CACHE_TTL", "30"))
+        max_entries = max_entries or int(os.getenv("TENANT_CACHE_MAX_ENTRIES", "10000"))
+        # Digest -> org_id, and org_id -> context; process-local only
+        self._keys = TTLCache("tenant_key", max_entries=max_entries, ttl=ttl)
+        self._contexts = TTLCache("tenant_context", max_entries=max_entries, ttl=ttl)
+
+    def hash_key(self, api_key: str) -> str:
+        return hmac.new(self._pepper, api_key.encode(), hashlib.sha256).hexdigest()
+
+    def register_key(self, org_id: str, api_key: str) -> None:
+        self.store.put(API_KEY_INDEX, self.hash_key(api_key), org_id)
+
+    def revoke_key(self, api_key: str) -> bool:
+        digest = self.hash_key(api_key)
+        self._keys.delete(digest)
+        return self.store.delete(API_KEY_INDEX, digest)
+
+    def add_organization(self, org_id: str, organization: Dict[str, Any]) -> bool:
+        """
+        Store an organization unless it exists, indexing its api_key.
+        The plain-text key is dropped from the stored record.
+        """
+        record = {k: v for k, v in organization.items() if k != "api_key"}
+        added = self.store.put_if_absent(ORGANIZATIONS, org_id, record)
+        if added and organization.get("api_key"):
+            self.register_key(org_id, organization["api_key"])
+        return added
+
+    def migrate_plaintext_keys(self) -> int:
+        """Index and strip api_key fields left in organization records by older versions"""
+        migrated = 0
+        for org_id, organization in self.store.items(ORGANIZATIONS):
+            api_key = organization.get("api_key")
+            if not api_key:
+                continue
+            self.register_key(org_id, api_key)
+            self.store.update(ORGANIZATIONS, org_id, lambda org: {k: v for k, v in org.items() if k != "api_key"})
+            migrated += 1
+        if migrated:
+            logger.info(f"Moved {migrated} plain-text API keys into the hashed key index")
+        return migrated
+
+    def _context(self, org_id: str, organization: Dict[str, Any]) -> TenantContext:
+        return TenantContext(
+            org_id=org_id,
+            name=organization["name"],
+            plan=organization["plan"],
+            monthly_limit=organization["monthly_limit"],
+            token_balance=organization["token_balance"],
+            usage_this_month=organization["usage_this_month"],
+            resolved_at=time.time()
+        )
+
+    def resolve(self, api_key: str) -> Optional[TenantContext]:
+        """Tenant context for api_key, or None when the key is unknown or revoked"""
+        digest = self.hash_key(api_key)
+        org_id = self._keys.get(digest)
+        if org_id is None:
+            org_id = self.store.get(API_KEY_INDEX, digest)
+            if org_id is None:
+                return None
+            self._keys.set(digest, org_id)
+        return self.get(org_id)
+
+    def get(self, org_id: str) -> Optional[TenantContext]:
+        context = self._contexts.get(org_id)
+        if context is not None:
+            return context
+        organization = self.store.get(ORGANIZATIONS, org_id)
+        if organization is None:
+            return None
+        context = self._context(org_id, organization)
+        self._contexts.set(org_id, context)
+        return context
+
+    def refresh(self, org_id: str, organization: Optional[Dict[str, Any]]) -> None:
+        """Replace the cached context after the organization changed; None drops it"""
+        if organization is None:
+            self._contexts.delete(org_id)
+        else:
+            self._contexts.set(org_id, self._context(org_id, organization))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"keys": self._keys.stats(), "contexts": self._contexts.stats()}
@@ -0,0 +1,177 @@
+import logging
+import os
+import resource
+import sys
+from typing import Any, Dict, NamedTuple, Optional
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from .document_processor import DocumentProcessingError
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))  # 50MB
+# Multipart boundaries, part headers and the small form fields around the file
+MAX_FORM_OVERHEAD_BYTES = 64 * 1024
+MAX_FORM_FIELD_BYTES = 16 * 1024
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class MultipartUpload(NamedTuple):
+    """The PDF part of a multipart upload, plus its plain form fields"""
+    filename: str
+    content: bytearray
+    fields: Dict[str, str]
+
+
+def _too_large(max_bytes: int, **details) -> DocumentProcessingError:
+    return DocumentProcessingError(
+        message=f"Uploaded file exceeds the {max_bytes} byte limit",
+        error_code="UPLOAD_TOO_LARGE",
+        details={"limit": max_bytes, **details}
+    )
+
+
+def _invalid(message: str) -> DocumentProcessingError:
+    return DocumentProcessingError(message=message, error_code="INVALID_UPLOAD")
+
+
+async def read_multipart_upload(request, max_bytes: int = MAX_UPLOAD_BYTES,
+                                file_field: str = "file") -> MultipartUpload:
+    """
+    Parse a multipart/form-data upload straight from the request body.
+
+    The body is read block by block as it arrives and the upload is rejected
+    as soon as the file passes max_bytes (or the declared Content-Length
+    already does), so an oversized upload is never received in full. The
+    file is appended to one bytearray that grows only as data arrives;
+    Content-Length is never used to size it, so a client that declares a
+    large body and stalls holds no memory. No other copy is made.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise _invalid("Expected a multipart/form-data upload")
+
+    declared = request.headers.get("content-length")
+    declared = int(declared) if declared and declared.isdigit() else None
+    if declared is not None and declared > max_bytes + MAX_FORM_OVERHEAD_BYTES:
+        raise _too_large(max_bytes, declared=declared)
+
+    content = bytearray()
+    size = 0
+    filename: Optional[str] = None
+    fields: Dict[str, str] = {}
+    # State of the part being parsed
+    part: Dict[str, Any] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+
+    def on_part_begin() -> None:
+        part.clear()
+        part["headers"] = {}
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header_value.extend(data[start:end])
+
+    def on_header_end() -> None:
+        part["headers"][bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished() -> None:
+        nonlocal filename
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        name = disposition.get(b"name", b"").decode("utf-8", "replace")
+        part["name"] = name
+        if name == file_field and b"filename" in disposition:
+            if filename is not None:
+                raise _invalid(f"Only one '{file_field}' part is allowed")
+            filename = disposition[b"filename"].decode("utf-8", "replace")
+            part["file"] = True
+        else:
+            part["value"] = bytearray()
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        nonlocal size
+        if part.get("file"):
+            length = end - start
+            if size + length > max_bytes:
+                raise _too_large(max_bytes, read=size + length)
+            content.extend(memoryview(data)[start:end])
+            size += length
+        else:
+            value = part["value"]
+            if len(value) + end - start > MAX_FORM_FIELD_BYTES:
+                raise _invalid(f"Form field '{part['name']}' is too large")
+            value.extend(data[start:end])
+
+    def on_part_end() -> None:
+        if "value" in part:
+            fields[part["name"]] = part["value"].decode("utf-8", "replace")
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end
+    })
+    blocks = 0
+    async for block in request.stream():
+        if block:
+            parser.write(block)
+            blocks += 1
+    parser.finalize()
+
+    if filename is None:
+        raise _invalid(f"The upload has no '{file_field}' file part")
+    logger.info(f"Read upload of {size} bytes in {blocks} blocks")
+    return MultipartUpload(filename, content, fields)
+
+
+def current_rss_kb() -> int:
+    """Resident set size of this process in KB"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE // 1024
+    except (OSError, IndexError, ValueError):
+        # No procfs: fall back to the lifetime peak
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class RSSTracker:
+    """
+    Records the RSS of the whole process at checkpoints of a request and keeps
+    the highest value seen. Concurrent requests all show up in it, so it is a
+    process-wide figure, not this request's memory use.
+    """
+    def __init__(self):
+        self.baseline_kb = current_rss_kb()
+        self.peak_kb = self.baseline_kb
+        self.samples: Dict[str, int] = {}
+
+    def sample(self, label: str) -> int:
+        rss = current_rss_kb()
+        self.samples[label] = rss
+        self.peak_kb = max(self.peak_kb, rss)
+        return rss
+
+    def report(self, label: Optional[str] = None) -> Dict[str, int]:
+        if label:
+            self.sample(label)
+        return {
+            "baseline_rss_kb": self.baseline_kb,
+            "peak_rss_kb": self.peak_kb,
+            "peak_delta_kb": self.peak_kb - self.baseline_kb
+        }
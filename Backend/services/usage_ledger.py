@@ -0,0 +1,418 @@
+"""
+Append-only ledger of token usage, written behind the request path.
+
+record() only appends the entry to an in-memory buffer and one line to this
+process's journal file; a background thread moves the buffer into SQLite in
+batches once it holds batch_size entries or every flush_interval seconds.
+Each batch is one transaction that also adds the entries to per-month
+rollups, so usage queries never scan the ledger.
+
+Crash safety: a journal segment is deleted only after its batch committed.
+A batch that fails to write (a locked database, say) is kept and retried,
+ahead of newer ones, on every following flush. start(), called from the
+app's startup hook, replays journals left by processes that are no longer
+running; entries are keyed by their receipt id, so replaying entries that
+did reach the database changes nothing. USAGE_LEDGER_FSYNC picks how much
+a crash of the whole machine may lose:
+
+    always    fsync the journal on every record; nothing is lost
+    interval  fsync once per flush (default); at most flush_interval seconds
+    off       leave it to the OS; a process crash still loses nothing
+
+Request handlers only call record(), stats() and the queries. None of them
+waits for a flush: queries read the rollups on their own connection, which
+under WAL sees the last committed state while the flusher writes.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from .metering import Reservation
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("always", "interval", "off")
+
+
+class UsageEntry(NamedTuple):
+    """One committed spend, keyed by its receipt id"""
+    entry_id: str
+    account: str
+    key: str
+    feature: str
+    amount: int
+    timestamp: float
+    document_id: Optional[str] = None
+
+    @property
+    def month(self) -> str:
+        return datetime.fromtimestamp(self.timestamp, timezone.utc).strftime("%Y-%m")
+
+
+def usage_entry(reservation: Reservation, feature: str, document_id: Optional[str] = None) -> UsageEntry:
+    """Ledger entry for a committed reservation; the reservation id is the receipt id"""
+    return UsageEntry(reservation.reservation_id, reservation.account, reservation.key, feature,
+                      reservation.amount, time.time(), document_id)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class UsageLedger:
+    """
+    Write-behind usage ledger; see the module docstring.
+
+    When the buffer reaches capacity entries, flushing has fallen far behind:
+    record() logs it and wakes the flusher, but keeps buffering rather than
+    drop entries or write on the caller's thread.
+    """
+    def __init__(self, path: Optional[str] = None, batch_size: Optional[int] = None,
+                 flush_interval: Optional[float] = None, capacity: Optional[int] = None,
+                 fsync: Optional[str] = None):
+        self.path = path or os.getenv("USAGE_LEDGER_PATH", os.path.join("state", "usage_ledger.sqlite3"))
+        self.batch_size = batch_size or int(os.getenv("USAGE_LEDGER_BATCH_SIZE", "512"))
+        self.flush_interval = flush_interval or float(os.getenv("USAGE_LEDGER_FLUSH_INTERVAL", "1.0"))
+        self.capacity = max(capacity or int(os.getenv("USAGE_LEDGER_CAPACITY", "65536")), self.batch_size)
+        self.fsync = fsync or os.getenv("USAGE_LEDGER_FSYNC", "interval")
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown USAGE_LEDGER_FSYNC policy: {self.fsync}")
+        self.journal_dir = self.path + ".journal"
+        # Opened on first use, so building the ledger creates no files
+        self._db: Optional[sqlite3.Connection] = None
+        # Queries get their own connection, so they never wait behind a flush
+        self._reader: Optional[sqlite3.Connection] = None
+        self._read_lock = threading.Lock()
+        self._open_lock = threading.Lock()
+
+        self._buffer: Deque[UsageEntry] = deque()
+        self._lock = threading.Lock()
+        # Serializes flushes, so batches commit in the order they were taken
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._replayed_at_start = False
+        self._segment = 0
+        self._journal_fd: Optional[int] = None
+        self._journal_path: Optional[str] = None
+        # Batches taken from the buffer that have not reached the database, with their segments
+        self._unwritten: Deque[Tuple[List[UsageEntry], str]] = deque()
+        self.recorded = 0
+        self.flushed = 0
+        self.batches = 0
+        self.replayed = 0
+        self.last_flush_seconds = 0.0
+
+    # Database
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._open()
+        return self._db
+
+    def _open(self) -> None:
+        with self._open_lock:
+            if self._db is not None:
+                return
+            os.makedirs(self.journal_dir, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # With the journal covering unflushed entries, only "off" trades batch durability for speed
+            conn.execute(f"PRAGMA synchronous={'OFF' if self.fsync == 'off' else 'FULL'}")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "entry_id TEXT PRIMARY KEY, account TEXT NOT NULL, key TEXT NOT NULL, feature TEXT NOT NULL, "
+                "amount INTEGER NOT NULL, timestamp REAL NOT NULL, month TEXT NOT NULL, document_id TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS usage_key_time ON usage (key, timestamp)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage_monthly ("
+                "account TEXT NOT NULL, key TEXT NOT NULL, month TEXT NOT NULL, "
+                "requests INTEGER NOT NULL, tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (account, key, month)) WITHOUT ROWID"
+            )
+            self._reader = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, isolation_level=None)
+            self._db = conn
+
+    def _read(self, sql: str, params: Any) -> List[Tuple]:
+        if self._db is None:
+            self._open()
+        with self._read_lock:
+            return self._reader.execute(sql, params).fetchall()
+
+    # Journal
+
+    def _open_segment(self) -> None:
+        if not self._segment:
+            os.makedirs(self.journal_dir, exist_ok=True)
+        self._segment += 1
+        self._journal_path = os.path.join(self.journal_dir, f"{os.getpid()}-{self._segment}.log")
+        self._journal_fd = os.open(self._journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+
+    def _rotate_segment(self) -> Optional[Tuple[int, str]]:
+        """Close the active segment for flushing; it holds exactly the entries being taken"""
+        if self._journal_fd is None:
+            return None
+        segment = (self._journal_fd, self._journal_path)
+        self._journal_fd = self._journal_path = None
+        return segment
+
+    def replay(self) -> int:
+        """Write journals left by processes that are no longer running into the ledger"""
+        with self._flush_lock:
+            replayed = self._replay()
+        if replayed:
+            logger.info(f"Replayed {replayed} usage entries from journals of stopped processes")
+        self.replayed += replayed
+        return replayed
+
+    def _replay(self) -> int:
+        replayed = 0
+        with self._lock:
+            # This ledger's own segments are still being written or waiting for a flush
+            own = {self._journal_path} | {path for _, path in self._unwritten}
+        for name in sorted(os.listdir(self.journal_dir)):
+            pid = int(name.split("-", 1)[0])
+            if pid != os.getpid() and _pid_alive(pid):
+                continue
+            path = os.path.join(self.journal_dir, name)
+            if path in own:
+                continue
+            entries = []
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entries.append(UsageEntry(*json.loads(line)))
+                        except (ValueError, TypeError):
+                            # A torn last line from the crash; the spend it described never returned a receipt
+                            logger.warning(f"Skipping unreadable usage journal line in {name}")
+            except FileNotFoundError:
+                # Another worker starting at the same time replayed it
+                continue
+            replayed += self._write(entries)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return replayed
+
+    # Writing
+
+    def start(self) -> None:
+        """
+        Open the database, replay orphaned journals and start the background
+        flusher. This blocks on disk, so it belongs in the startup hook.
+        """
+        self._open()
+        with self._start_lock:
+            if self._closed or self._replayed_at_start:
+                return
+            self._replayed_at_start = True
+            self.replay()
+        self._start_flusher()
+
+    def _start_flusher(self) -> None:
+        with self._start_lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+                self._thread.start()
+
+    def record(self, entry: UsageEntry) -> None:
+        """Buffer and journal entry; never touches the database"""
+        if self._thread is None:
+            # Without start() nothing is replayed, but entries still get flushed
+            self._start_flusher()
+        line = (json.dumps(list(entry)) + "\n").encode("utf-8")
+        with self._lock:
+            if self._journal_fd is None:
+                self._open_segment()
+            os.write(self._journal_fd, line)
+            if self.fsync == "always":
+                os.fsync(self._journal_fd)
+            self._buffer.append(entry)
+            self.recorded += 1
+            pending = len(self._buffer)
+        if pending >= self.batch_size:
+            if pending == self.capacity:
+                logger.warning(f"Usage ledger buffer reached {pending} entries; flushing is falling behind")
+            self._wake.set()
+
+    def flush(self) -> int:
+        """
+        Write everything buffered so far, after any batches earlier flushes
+        failed to write; returns the number of new entries
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._buffer)
+                self._buffer.clear()
+                segment = self._rotate_segment()
+            if segment is not None:
+                fd, path = segment
+                try:
+                    if self.fsync != "off":
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+                self._unwritten.append((batch, path))
+            written = 0
+            # Oldest first; a batch that fails stays at the head for the next flush
+            while self._unwritten:
+                batch, path = self._unwritten[0]
+                start = time.perf_counter()
+                written += self._write(batch)
+                self._unwritten.popleft()
+                os.remove(path)
+                self.last_flush_seconds = time.perf_counter() - start
+                self.batches += 1
+            self.flushed += written
+            return written
+
+    def _write(self, entries: List[UsageEntry]) -> int:
+        """Insert entries not yet in the ledger and add them to the rollups, in one transaction"""
+        if not entries:
+            return 0
+        rollups: Dict[Tuple[str, str, str], List[int]] = {}
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for entry in entries:
+                month = entry.month
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO usage (entry_id, account, key, feature, amount, timestamp, month, document_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (entry.entry_id, entry.account, entry.key, entry.feature, entry.amount,
+                     entry.timestamp, month, entry.document_id)
+                )
+                if cursor.rowcount == 1:
+                    totals = rollups.setdefault((entry.account, entry.key, month), [0, 0])
+                    totals[0] += 1
+                    totals[1] += entry.amount
+            conn.executemany(
+                "INSERT INTO usage_monthly (account, key, month, requests, tokens) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (account, key, month) DO UPDATE SET "
+                "requests = requests + excluded.requests, tokens = tokens + excluded.tokens",
+                [(account, key, month, requests, tokens) for (account, key, month), (requests, tokens) in rollups.items()]
+            )
+            # A failed COMMIT must roll back too, or every later BEGIN on this connection fails
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return sum(requests for requests, _ in rollups.values())
+
+    def _unwritten_count(self) -> int:
+        # Copying the deque is atomic, so this needs no lock
+        return sum(len(batch) for batch, _ in list(self._unwritten))
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # The batch stays queued, and in its journal segment, until a later flush writes it
+                logger.error(f"Usage ledger flush failed, {self._unwritten_count()} entries left to retry: {str(e)}")
+
+    def close(self) -> None:
+        """Stop the flusher and write what is left"""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._reader.close()
+
+    # Queries
+
+    def monthly_usage(self, key: Optional[str] = None, account: Optional[str] = None,
+                      month: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Requests and tokens per account, key and month, from the rollups; covers flushed entries"""
+        clauses, params = [], []
+        for column, value in (("key", key), ("account", account), ("month", month)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._read(
+            f"SELECT account, key, month, requests, tokens FROM usage_monthly{where} "
+            "ORDER BY month, account, key", params
+        )
+        return [
+            {"account": account, "key": key, "month": month, "requests": requests, "tokens": tokens}
+            for account, key, month, requests, tokens in rows
+        ]
+
+    def entries(self, key: str, since: float = 0.0, limit: int = 100) -> List[UsageEntry]:
+        """Latest ledger entries for key, newest first"""
+        rows = self._read(
+            "SELECT entry_id, account, key, feature, amount, timestamp, document_id FROM usage "
+            "WHERE key = ? AND timestamp >= ? ORDER BY timestamp DESC LIMIT ?", (key, since, limit)
+        )
+        return [UsageEntry(*row) for row in rows]
+
+    def rebuild_rollups(self) -> None:
+        """Recompute the monthly rollups from the full ledger"""
+        with self._flush_lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM usage_monthly")
+                conn.execute(
+                    "INSERT INTO usage_monthly (account, key, month, requests, tokens) "
+                    "SELECT account, key, month, COUNT(*), SUM(amount) FROM usage GROUP BY account, key, month"
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = len(self._buffer)
+        pending += self._unwritten_count()
+        return {
+            "recorded": self.recorded,
+            "pending": pending,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "replayed": self.replayed,
+            "last_flush_seconds": round(self.last_flush_seconds, 4),
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "fsync": self.fsync
+        }
+
+
+_ledger: Optional[UsageLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger() -> UsageLedger:
+    """The process-wide ledger, created on first use"""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+        return _ledger
@@ -0,0 +1,68 @@
+"""
+Compare PDF text-extraction engines on a generated corpus.
+
+    python benchmarks/pdf_engines.py [--pages 10 100 300] [--repeat 3]
+
+Each document is generated with PyMuPDF, so the corpus needs no fixtures.
+Reports the best-of-N wall time per engine and the pages/second it implies.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+# Add the project root directory to the Python path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import fitz
+
+from Backend.services.pdf_extraction import ENGINES, join_pages
+
+CLAUSE = (
+    "The tenant shall pay rent on the first day of each month. Late payments incur a fee "
+    "of five percent. The landlord may enter the premises with twenty-four hours notice. "
+    "The tenant has the right to quiet enjoyment of the property. "
+)
+
+
+def generate_pdf(pages: int) -> bytes:
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        rect = fitz.Rect(54, 54, page.rect.width - 54, page.rect.height - 54)
+        page.insert_textbox(rect, f"Section {number + 1}. " + CLAUSE * 12, fontsize=10)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def bench(engine_name: str, data: bytes, repeat: int) -> float:
+    engine = ENGINES[engine_name]()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, pages = engine.read_pages(data)
+        join_pages(pages)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 300])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'size KB':>8} " + " ".join(f"{name + ' s':>12} {'pages/s':>9}" for name in ENGINES))
+    for pages in args.pages:
+        data = generate_pdf(pages)
+        row = f"{pages:>6} {len(data) // 1024:>8} "
+        timings = {name: bench(name, data, args.repeat) for name in ENGINES}
+        row += " ".join(f"{seconds:>12.3f} {pages / seconds:>9.0f}" for seconds in timings.values())
+        fastest = min(timings, key=timings.get)
+        slowest = max(timings, key=timings.get)
+        print(f"{row}   {fastest} {timings[slowest] / timings[fastest]:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Stress token metering with concurrent deductions.
+
+    python benchmarks/token_metering.py [--requests 10000] [--balance 5000] [--workers 1 4]
+
+Every request reserves tokens, awaits a stand-in for the model call and then
+commits, or refunds when the call "fails" (--failure-rate). The balance only
+covers a fraction of the requests, so most of them race for the last tokens.
+The naive row repeats the old check-then-write with the same await in
+between, to show the double-spend the meter prevents. A run fails if any
+metered balance goes negative or does not match what was committed.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add the project root directory to the Python path
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from Backend.services.metering import CounterAccount, MeteringError, TokenMeter
+from Backend.services.state_store import InMemoryStateStore, SQLiteStateStore
+
+ACCOUNT = "bench"
+USER = "user"
+AMOUNT = 1
+
+
+async def metered_request(meter: TokenMeter, failure_rate: float) -> str:
+    try:
+        async with meter.hold(ACCOUNT, USER, AMOUNT):
+            await asyncio.sleep(0)
+            if random.random() < failure_rate:
+                raise RuntimeError("model call failed")
+    except MeteringError:
+        return "rejected"
+    except RuntimeError:
+        return "refunded"
+    return "committed"
+
+
+async def naive_request(store, failure_rate: float) -> str:
+    balance = store.get_counter(ACCOUNT, USER)
+    if balance < AMOUNT:
+        return "rejected"
+    await asyncio.sleep(0)
+    if random.random() < failure_rate:
+        return "refunded"
+    store.set_counter(ACCOUNT, USER, balance - AMOUNT)
+    return "committed"
+
+
+async def run_requests(store, requests: int, failure_rate: float, naive: bool) -> dict:
+    meter = TokenMeter(store)
+    meter.register(ACCOUNT, CounterAccount(ACCOUNT))
+    if naive:
+        coros = [naive_request(store, failure_rate) for _ in range(requests)]
+    else:
+        coros = [metered_request(meter, failure_rate) for _ in range(requests)]
+    outcomes = await asyncio.gather(*coros)
+    return {outcome: outcomes.count(outcome) for outcome in ("committed", "refunded", "rejected")}
+
+
+def worker(path: str, requests: int, failure_rate: float, naive: bool, results) -> None:
+    store = SQLiteStateStore(path, pool_size=1)
+    results.put(asyncio.run(run_requests(store, requests, failure_rate, naive)))
+    store.close()
+
+
+def bench(backend: str, workers: int, requests: int, balance: int, failure_rate: float, naive: bool) -> dict:
+    start = time.perf_counter()
+    if backend == "memory":
+        store = InMemoryStateStore()
+        store.set_counter(ACCOUNT, USER, balance)
+        counts = asyncio.run(run_requests(store, requests, failure_rate, naive))
+        final = store.get_counter(ACCOUNT, USER)
+    else:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "state.sqlite3")
+        store = SQLiteStateStore(path, pool_size=1)
+        store.set_counter(ACCOUNT, USER, balance)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=worker, args=(path, requests // workers, failure_rate, naive, results))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        counts = {"committed": 0, "refunded": 0, "rejected": 0}
+        for _ in processes:
+            for outcome, count in results.get().items():
+                counts[outcome] += count
+        for process in processes:
+            process.join()
+        final = store.get_counter(ACCOUNT, USER)
+        store.close()
+    counts["seconds"] = time.perf_counter() - start
+    counts["final"] = final
+    # Tokens handed out beyond what the balance held
+    counts["overspent"] = max(counts["committed"] * AMOUNT - balance, 0)
+    counts["consistent"] = final >= 0 and final == balance - counts["committed"] * AMOUNT
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--balance", type=int, default=5000)
+    parser.add_argument("--failure-rate", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    runs = [("naive", "memory", 1), ("metered", "memory", 1)]
+    runs += [("metered", "sqlite", workers) for workers in args.workers]
+    print(f"{'mode':>8} {'store':>7} {'procs':>6} {'committed':>10} {'refunded':>9} {'rejected':>9} "
+          f"{'final':>7} {'overspent':>10} {'req/s':>8}  ok")
+    failed = False
+    for mode, backend, workers in runs:
+        result = bench(backend, workers, args.requests, args.balance, args.failure_rate, mode == "naive")
+        ok = result["consistent"] and not result["overspent"]
+        if mode == "metered" and not ok:
+            failed = True
+        print(f"{mode:>8} {backend:>7} {workers:>6} {result['committed']:>10} {result['refunded']:>9} "
+              f"{result['rejected']:>9} {result['final']:>7} {result['overspent']:>10} "
+              f"{args.requests / result['seconds']:>8.0f}  {'yes' if ok else 'NO'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
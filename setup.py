@@ -11,7 +11,9 @@ setup(
         "aiohttp",
         "python-dotenv",
         "PyPDF2",
+        "PyMuPDF",
         "tiktoken",
+        "numpy",
         "openai"
     ],
     python_requires=">=3.8",
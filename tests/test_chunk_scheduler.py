@@ -0,0 +1,54 @@
+import asyncio
+
+from Backend.services.chunk_scheduler import ChunkScheduler
+
+
+def test_limits_hold_per_tenant_and_globally():
+    scheduler = ChunkScheduler(max_in_flight=3, max_in_flight_per_tenant=2)
+    running = {"a": 0, "b": 0, "total": 0}
+    peaks = {"a": 0, "b": 0, "total": 0}
+
+    async def job(tenant):
+        for key in (tenant, "total"):
+            running[key] += 1
+            peaks[key] = max(peaks[key], running[key])
+        await asyncio.sleep(0.01)
+        for key in (tenant, "total"):
+            running[key] -= 1
+        return tenant
+
+    async def main():
+        return await asyncio.gather(*(scheduler.run(job, tenant, tenant_id=tenant) for tenant in "ab" * 5))
+
+    assert asyncio.run(main()) == list("ab" * 5)
+    assert peaks == {"a": 2, "b": 2, "total": 3}
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_release_slot_lets_queued_jobs_start():
+    scheduler = ChunkScheduler(max_in_flight=8, max_in_flight_per_tenant=2)
+    waiting = []
+
+    async def job():
+        scheduler.release_slot()
+        # Released twice, still counted once
+        scheduler.release_slot()
+        future = asyncio.get_running_loop().create_future()
+        waiting.append(future)
+        return await future
+
+    async def main():
+        tasks = [asyncio.ensure_future(scheduler.run(job)) for _ in range(6)]
+        await asyncio.sleep(0.01)
+        # Every job got past the tenant limit of 2 while holding no slot
+        assert len(waiting) == 6
+        assert scheduler.stats()["in_flight"] == 0
+        for i, future in enumerate(waiting):
+            future.set_result(i)
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(main()) == list(range(6))
+    assert scheduler.stats() == {"max_in_flight": 8, "max_in_flight_per_tenant": 2,
+                                 "in_flight": 0, "waiting": 0, "active_tenants": 0}
+    # Outside a job it does nothing
+    scheduler.release_slot()
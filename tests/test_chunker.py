@@ -0,0 +1,104 @@
+import random
+
+import pytest
+import tiktoken
+
+from Backend.services.chunker import TextChunker
+
+WORDS = "the tenant shall pay rent to landlord deposit é 数据 notice".split()
+
+
+def _encoding():
+    """A small BPE encoding over bytes with a few merged words, so tests need no download"""
+    ranks = {bytes([i]): i for i in range(256)}
+
+    def add(token):
+        if token in ranks:
+            return
+        for k in range(1, len(token)):
+            if token[:k] in ranks and token[k:] in ranks:
+                ranks[token] = len(ranks)
+                return
+        add(token[:-1])
+        add(token[-1:])
+        ranks[token] = len(ranks)
+
+    for word in ["the", " the", " tenant", " shall", " pay", " rent", " landlord", " deposit", " notice", ".\n", "\n\n"]:
+        add(word.encode())
+    return tiktoken.Encoding(name="test_bpe", pat_str=r"""'s|'t| ?\w+| ?[^\s\w]+|\s*[\r\n]+|\s+(?!\S)|\s+""",
+                             mergeable_ranks=ranks, special_tokens={})
+
+
+def _document(seed: int = 1, paragraphs: int = 120) -> str:
+    rng = random.Random(seed)
+    result = []
+    for _ in range(paragraphs):
+        size = rng.choice([1, 3, 10, 40])
+        if size == 40 and rng.random() < 0.3:
+            # One long run with no sentence or word breaks
+            result.append("x" * 600 + " 数据" * 20)
+            continue
+        sentences = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))) + rng.choice([".", "!", ""])
+                     for _ in range(size)]
+        result.append(" ".join(sentences))
+    return "\n\n".join(result) + "\n\n  tail"
+
+
+@pytest.fixture(scope="module")
+def encoding():
+    return _encoding()
+
+
+@pytest.fixture(scope="module")
+def chunker(encoding):
+    return TextChunker(encoding)
+
+
+@pytest.mark.parametrize("max_tokens,overlap_tokens,content_defined",
+                         [(200, 0, False), (100, 30, True), (20, 5, True), (7, 0, False)])
+def test_chunks_stay_within_max_tokens(chunker, encoding, max_tokens, overlap_tokens, content_defined):
+    text = _document()
+    spans = chunker.split(text, max_tokens, overlap_tokens, content_defined)
+    assert spans
+    for span in spans:
+        assert 0 <= span.start < span.end <= len(text)
+        actual = len(encoding.encode_ordinary(span.text(text)))
+        assert actual <= span.tokens <= max_tokens
+
+
+def test_chunks_cover_text_in_order(chunker):
+    text = _document(seed=2)
+    spans = chunker.split(text, 50)
+    for previous, span in zip(spans, spans[1:]):
+        assert previous.end <= span.start
+        # Only whitespace is dropped between chunks
+        assert not text[previous.end:span.start].strip()
+    assert not text[:spans[0].start].strip()
+    assert not text[spans[-1].end:].strip()
+
+
+def test_overlap_repeats_trailing_text(chunker):
+    text = "\n".join(f" the tenant shall pay rent {i}." for i in range(60))
+    spans = chunker.split(text, 40, overlap_tokens=15)
+    assert any(previous.end > span.start for previous, span in zip(spans, spans[1:]))
+    for previous, span in zip(spans, spans[1:]):
+        assert previous.start < span.start
+
+
+def test_content_defined_chunks_survive_an_edit(chunker):
+    text = _document(seed=3, paragraphs=200)
+    middle = text.index("\n\n", len(text) // 2)
+    edited = text[:middle] + " The landlord shall pay the deposit." + text[middle:]
+    before = {span.text(text) for span in chunker.split(text, 100, content_defined=True)}
+    after = [span.text(edited) for span in chunker.split(edited, 100, content_defined=True)]
+    changed = [chunk for chunk in after if chunk not in before]
+    assert 1 <= len(changed) <= 3
+    assert len(changed) < len(after) // 4
+
+
+def test_rejects_bad_limits(chunker):
+    assert chunker.split("", 10) == []
+    with pytest.raises(ValueError):
+        chunker.split("text", 0)
+    with pytest.raises(ValueError):
+        chunker.split("text", 10, overlap_tokens=10)
@@ -0,0 +1,181 @@
+import asyncio
+import random
+
+import pytest
+
+from Backend.services.metering import CounterAccount, MeteringError, TokenMeter
+from Backend.services.state_store import InMemoryStateStore, SQLiteStateStore
+
+BALANCES = "test_balance"
+USED = "test_used"
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        store = InMemoryStateStore()
+    else:
+        store = SQLiteStateStore(str(tmp_path / "state.db"), pool_size=4)
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def meter(store):
+    meter = TokenMeter(store, reservation_ttl=60)
+    meter.register("tokens", CounterAccount(BALANCES, USED))
+    return meter
+
+
+def test_concurrent_holds_never_overspend(meter, store):
+    balance, amount, requests = 1000, 30, 200
+    store.set_counter(BALANCES, "user", balance)
+    random.seed(7)
+    failing = {i for i in range(requests) if random.random() < 0.3}
+    outcomes = []
+
+    async def request(i):
+        try:
+            async with meter.hold("tokens", "user", amount):
+                await asyncio.sleep(random.random() / 1000)
+                assert store.get_counter(BALANCES, "user") >= 0
+                if i in failing:
+                    raise RuntimeError("model call failed")
+            outcomes.append("committed")
+        except MeteringError as e:
+            assert e.error_code == "insufficient_balance"
+            outcomes.append("rejected")
+        except RuntimeError:
+            outcomes.append("refunded")
+
+    async def main():
+        await asyncio.gather(*(request(i) for i in range(requests)))
+
+    asyncio.run(main())
+    committed = outcomes.count("committed")
+    final = store.get_counter(BALANCES, "user")
+    assert final >= 0
+    assert final == balance - committed * amount
+    assert store.get_counter(USED, "user") == committed * amount
+    assert committed > 0 and outcomes.count("rejected") > 0
+    stats = meter.stats()
+    assert stats["committed"] == committed
+    assert stats["refunded"] == outcomes.count("refunded")
+    assert store.items("token_reservation") == []
+
+
+def test_hold_refunds_when_block_raises(meter, store):
+    store.set_counter(BALANCES, "user", 100)
+
+    async def main():
+        async with meter.hold("tokens", "user", 40):
+            assert store.get_counter(BALANCES, "user") == 60
+            raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        asyncio.run(main())
+    assert store.get_counter(BALANCES, "user") == 100
+    assert store.get_counter(USED, "user") is None
+    assert meter.stats()["refunded"] == 1
+
+
+def test_hold_refunds_when_cancelled(meter, store):
+    store.set_counter(BALANCES, "user", 100)
+
+    async def held():
+        async with meter.hold("tokens", "user", 40):
+            await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.ensure_future(held())
+        await asyncio.sleep(0.01)
+        assert store.get_counter(BALANCES, "user") == 60
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert store.get_counter(BALANCES, "user") == 100
+
+
+def test_failed_reservation_write_keeps_balance(meter, store, monkeypatch):
+    store.set_counter(BALANCES, "user", 100)
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "put", fail)
+    with pytest.raises(OSError):
+        meter.reserve("tokens", "user", 40)
+    monkeypatch.undo()
+    assert store.get_counter(BALANCES, "user") == 100
+    assert store.items("token_reservation") == []
+
+
+def test_failed_settlement_keeps_reservation_open(meter, store, monkeypatch):
+    store.set_counter(BALANCES, "user", 100)
+    reservation = meter.reserve("tokens", "user", 40)
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "add", fail)
+    with pytest.raises(OSError):
+        meter.commit(reservation)
+    with pytest.raises(OSError):
+        meter.refund(reservation)
+    monkeypatch.undo()
+    assert len(store.items("token_reservation")) == 1
+    assert meter.refund(reservation)
+    assert store.get_counter(BALANCES, "user") == 100
+    assert store.get_counter(USED, "user") is None
+
+
+def test_reservation_is_settled_once(meter, store):
+    store.set_counter(BALANCES, "user", 100)
+    reservation = meter.reserve("tokens", "user", 30)
+    assert meter.commit(reservation)
+    assert not meter.commit(reservation)
+    assert not meter.refund(reservation)
+    assert store.get_counter(BALANCES, "user") == 70
+    assert store.get_counter(USED, "user") == 30
+
+
+def test_expire_refunds_open_reservations(meter, store):
+    store.set_counter(BALANCES, "user", 100)
+    reservation = meter.reserve("tokens", "user", 30)
+    assert meter.expire(max_age=60) == 0
+    assert meter.expire(max_age=0) == 1
+    assert store.get_counter(BALANCES, "user") == 100
+    assert not meter.commit(reservation)
+    assert store.get_counter(USED, "user") is None
+    assert meter.stats()["expired"] == 1
+
+
+def test_rejections_take_nothing(meter, store):
+    store.set_counter(BALANCES, "user", 10)
+    with pytest.raises(MeteringError) as error:
+        meter.reserve("tokens", "user", 11)
+    assert error.value.error_code == "insufficient_balance"
+    assert error.value.details == {"balance": 10, "requested": 11}
+    with pytest.raises(MeteringError) as error:
+        meter.reserve("tokens", "nobody", 1)
+    assert error.value.error_code == "account_not_found"
+    with pytest.raises(MeteringError) as error:
+        meter.reserve("tokens", "user", 0)
+    assert error.value.error_code == "invalid_amount"
+    assert store.get_counter(BALANCES, "user") == 10
+    assert meter.stats()["rejected"] == 2
+
+
+def test_initial_balance_and_charge(store):
+    meter = TokenMeter(store, reservation_ttl=60)
+    meter.register("free", CounterAccount(BALANCES, USED, initial_balance=50))
+    meter.charge("free", "new_user", 20)
+    assert store.get_counter(BALANCES, "new_user") == 30
+    assert store.get_counter(USED, "new_user") == 20
+    # An existing balance is not reset
+    meter.charge("free", "new_user", 30)
+    assert store.get_counter(BALANCES, "new_user") == 0
+    with pytest.raises(MeteringError):
+        meter.charge("free", "new_user", 1)
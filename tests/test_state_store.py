@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+
+from Backend.services.state_store import InMemoryStateStore, SQLiteStateStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        store = InMemoryStateStore()
+    else:
+        store = SQLiteStateStore(str(tmp_path / "state.db"), pool_size=4)
+    yield store
+    store.close()
+
+
+def test_try_decrement_respects_floor(store):
+    assert store.try_decrement("balance", "missing", 1) is None
+    assert store.get_counter("balance", "missing") is None
+    store.set_counter("balance", "user", 10)
+    assert store.try_decrement("balance", "user", 4) == 6
+    assert store.try_decrement("balance", "user", 7) is None
+    assert store.try_decrement("balance", "user", 3, floor=4) is None
+    assert store.try_decrement("balance", "user", 2, floor=4) == 4
+    assert store.get_counter("balance", "user") == 4
+
+
+def test_concurrent_decrements_grant_exactly_the_balance(store):
+    store.set_counter("balance", "user", 500)
+    granted = []
+    lock = threading.Lock()
+
+    def spend():
+        for _ in range(50):
+            if store.try_decrement("balance", "user", 3) is not None:
+                with lock:
+                    granted.append(3)
+
+    threads = [threading.Thread(target=spend) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(granted) == 498
+    assert store.get_counter("balance", "user") == 2
+
+
+def test_init_counter_and_add(store):
+    assert store.init_counter("used", "user", 5)
+    assert not store.init_counter("used", "user", 9)
+    assert store.add("used", "user", 3) == 8
+    assert store.add("used", "other", 2) == 2
+
+
+def test_records(store):
+    assert store.put_if_absent("orgs", "a", {"seats": 1})
+    assert not store.put_if_absent("orgs", "a", {"seats": 2})
+    assert store.update("orgs", "a", lambda org: dict(org, seats=org["seats"] + 1)) == {"seats": 2}
+    assert store.update("orgs", "missing", lambda org: org) is None
+
+    def fail(org):
+        raise ValueError("rejected")
+
+    with pytest.raises(ValueError):
+        store.update("orgs", "a", fail)
+    assert store.get("orgs", "a") == {"seats": 2}
+    assert store.items("orgs") == [("a", {"seats": 2})]
+    assert store.delete("orgs", "a")
+    assert not store.delete("orgs", "a")
+    assert store.get("orgs", "a") is None
+
+
+def test_transaction_rolls_back_every_call(store):
+    store.set_counter("balance", "user", 10)
+    store.put("orgs", "a", {"seats": 1})
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            assert store.try_decrement("balance", "user", 4) == 6
+            store.add("used", "user", 4)
+            store.put("orgs", "b", {"seats": 2})
+            store.delete("orgs", "a")
+            with store.transaction():
+                store.update("orgs", "b", lambda org: dict(org, seats=3))
+            assert store.get("orgs", "b") == {"seats": 3}
+            raise RuntimeError("abort")
+    assert store.get_counter("balance", "user") == 10
+    assert store.get_counter("used", "user") is None
+    assert store.items("orgs") == [("a", {"seats": 1})]
+
+    with store.transaction():
+        store.add("used", "user", 4)
+        store.delete("orgs", "a")
+    assert store.get_counter("used", "user") == 4
+    assert store.items("orgs") == []
+
+
+def test_transaction_isolates_other_threads(store):
+    store.set_counter("balance", "user", 0)
+
+    def top_up():
+        for _ in range(200):
+            with store.transaction():
+                value = store.get_counter("balance", "user")
+                store.set_counter("balance", "user", value + 1)
+
+    threads = [threading.Thread(target=top_up) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get_counter("balance", "user") == 800